@@ -40,6 +40,11 @@ compressor_defaults = {
     'js': lambda: getattr(settings, 'JSCOMP_BACKEND', 'uglifyjs'),
 }
 
+# inputs smaller than the bytes go to the in-process backend instead, 0 disables
+compressor_small = {
+    'js': lambda: (getattr(settings, 'JSCOMP_SMALL_BACKEND', 'jsmin'), getattr(settings, 'JSCOMP_SMALL_BYTES', 0)),
+}
+
 
 class CodeCompressorThreadFactoryImpl(object):
     """
@@ -49,14 +54,11 @@ class CodeCompressorThreadFactoryImpl(object):
     def __init__(self):
         self._klass = {}
         
-    def _setup(self, code_type):
+    def _setup(self, code_backend):
         """
         Load the backend and thread class
         """
         from django.utils.importlib import import_module
-        if code_type not in compressor_defaults:
-            raise AttributeError("The backend type {0} is not configured".format(code_type))
-        code_backend = compressor_defaults[code_type]()
         try:
             mod = import_module(code_backend)
         except:
@@ -69,12 +71,31 @@ class CodeCompressorThreadFactoryImpl(object):
         thread_klass = getattr(mod, 'CompressorThread', None)
         if not thread_klass:
             raise AttributeError("The module {0} does not implement the CompressorThread class".format(mod.__name__))
-        self._klass[code_type] = thread_klass
+        self._klass[code_backend] = thread_klass
+    
+    def get_class(self, code_type='js', size=None):
+        code_backend = self.backend(code_type, size)
+        if code_backend not in self._klass:
+            self._setup(code_backend)
+        return self._klass[code_backend]
+    
+    def backend(self, code_type='js', size=None):
+        """
+        The backend name for the code type. With the size of the input known, small inputs 
+        are routed to the small backend (JSCOMP_SMALL_BACKEND under JSCOMP_SMALL_BYTES).
+        """
+        if code_type not in compressor_defaults:
+            raise AttributeError("The backend type {0} is not configured".format(code_type))
+        if size is not None and code_type in compressor_small:
+            small_backend, small_bytes = compressor_small[code_type]()
+            if small_backend and size < small_bytes:
+                return small_backend
+        return compressor_defaults[code_type]()
     
     def create(self, code_type='js', *args, **kwargs):
-        if code_type not in self._klass:
-            self._setup(code_type)
-        return self._klass[code_type](*args, **kwargs)
+        # the thread arguments are (cache_key, data, job_name, ...)
+        data = args[1] if len(args) > 1 else kwargs.get('data')
+        return self.get_class(code_type, None if data is None else len(data))(*args, **kwargs)
 
 
 CodeCompressorThreadFactory = CodeCompressorThreadFactoryImpl()
@@ -31,13 +31,33 @@ THE SOFTWARE.
 from django.conf import settings
 import os
 
-from staticcomp.compressor import CompressorService, CodeCompressorThread
+from staticcomp.compressor import CompressorService, CodeCompressorThread, BackendException, as_string
+from staticcomp.backends.daemon import get_daemon_pool
 
 
 # Either WHITESPACE_ONLY, SIMPLE_OPTIMIZATIONS 
 #  or ADVANCED_OPTIMIZATIONS (the advanced option is not recommended for this usage)
 COMPILATION_LEVEL = getattr(settings, 'JSCOMP_OPTIMIZATION', 'SIMPLE_OPTIMIZATIONS')
 
+# keeps warm JVMs running (lib/ClosureServer.java) instead of starting java for each job
+CLOSURE_SERVER = getattr(settings, 'JSCOMP_CLOSURE_SERVER', False)
+
+# number of JVMs per worker process, also limits the concurrent jobs
+CLOSURE_SERVERS = getattr(settings, 'JSCOMP_CLOSURE_SERVERS', 1)
+
+# JVM max heap size (-Xmx)
+CLOSURE_SERVER_HEAP = getattr(settings, 'JSCOMP_CLOSURE_SERVER_HEAP', '256m')
+
+# the JVM is recycled after this many jobs, 0 never recycles
+CLOSURE_SERVER_MAX_JOBS = getattr(settings, 'JSCOMP_CLOSURE_SERVER_MAX_JOBS', 500)
+
+# seconds before a job is killed (the JVM is restarted)
+CLOSURE_SERVER_TIMEOUT = getattr(settings, 'JSCOMP_CLOSURE_SERVER_TIMEOUT', 120)
+
+# where the compiled ClosureServer classes are kept, they ship in lib next to the source
+CLOSURE_SERVER_CLASSES = getattr(settings, 
+                                 'JSCOMP_CLOSURE_SERVER_CLASSES', 
+                                 os.path.normpath(os.path.join(os.path.dirname(__file__), 'lib')))
 
 
 class GoogleClosureCommand(CompressorService):
@@ -45,6 +65,9 @@ class GoogleClosureCommand(CompressorService):
     Java command line app for the Google Closure Compiler. 
     More info at http://code.google.com/closure/compiler/docs/gettingstarted_app.html
     """
+    # the files are piped to the command STDIN
+    streaming = True
+    
     def __init__(self, *args, **kwargs):
         super(GoogleClosureCommand, self).__init__(*args, **kwargs)
         self.java_cmd = getattr(settings, 'JAVA_CMD', 'java')
@@ -52,7 +75,36 @@ class GoogleClosureCommand(CompressorService):
                                    'JSCOMP_CLOSURE_JAR_FILE', 
                                    os.path.normpath(os.path.join(os.path.dirname(__file__), 'lib/compiler.jar')))        
 
+    def server_classes(self):
+        """
+        Returns the directory of the compiled lib/ClosureServer.java classes.
+        """
+        if not os.path.exists(os.path.join(CLOSURE_SERVER_CLASSES, 'ClosureServer.class')):
+            raise BackendException("ClosureServer.class not found in {0}".format(CLOSURE_SERVER_CLASSES))
+        return CLOSURE_SERVER_CLASSES
+
+    def compress_server(self, data):
+        """
+        Sends the job to one of the warm JVMs.
+        """
+        server_cmd = "{java} -Xmx{heap} -cp {jar}{sep}{classes} ClosureServer {level} {debug}".format(
+            java=self.java_cmd,
+            heap=CLOSURE_SERVER_HEAP,
+            jar=self.closure_jar,
+            sep=os.pathsep,
+            classes=self.server_classes(),
+            level=COMPILATION_LEVEL,
+            debug="--pretty" if settings.DEBUG else "")
+        daemon_pool = get_daemon_pool(server_cmd, 
+                                      CLOSURE_SERVERS, 
+                                      timeout=CLOSURE_SERVER_TIMEOUT, 
+                                      max_jobs=CLOSURE_SERVER_MAX_JOBS)
+        return daemon_pool.compress(data)
+
     def compress_string(self, data):
+        if CLOSURE_SERVER:
+            return self.apply_header(self.compress_server(as_string(data)))
+        
         closure_cmd = "{java} -jar {jar} --compilation_level {level} {debug}".format(java=self.java_cmd,
                                                                                      jar=self.closure_jar,
                                                                                      level=COMPILATION_LEVEL,
@@ -63,6 +115,10 @@ class GoogleClosureCommand(CompressorService):
 
 class GoogleClosureJavaThread(CodeCompressorThread):
     CompressorClass = GoogleClosureCommand
+    
+    @classmethod
+    def options(cls):
+        return "{level} debug={debug}".format(level=COMPILATION_LEVEL, debug=settings.DEBUG)
 
 
 CompressorThread = GoogleClosureJavaThread
@@ -29,31 +29,142 @@ THE SOFTWARE.
 
 from django.conf import settings
 
-from staticcomp.compressor import CompressorService, CodeCompressorThread, CompressorException
+from staticcomp.compressor import CompressorService, CodeCompressorThread, BackendException, CompressorTimeout
+from staticcomp.stats import Counters
 
 from contextlib import contextmanager
 import httplib
+import os
+import random
+import socket
+import threading
+import time
 import urllib
+import urlparse
+import Queue
 
 
 # Either WHITESPACE_ONLY, SIMPLE_OPTIMIZATIONS 
 #  or ADVANCED_OPTIMIZATIONS (the advanced option is not recommended for this usage)
 COMPILATION_LEVEL = getattr(settings, 'JSCOMP_OPTIMIZATION', 'SIMPLE_OPTIMIZATIONS')
 
+# the compile endpoint, ie. a local closure_web_fake server for testing
+CLOSURE_URL = getattr(settings, 'JSCOMP_CLOSURE_WEB_URL', 'http://closure-compiler.appspot.com/compile')
 
-class ClosureRequestError(CompressorException):
+CONNECT_TIMEOUT = getattr(settings, 'JSCOMP_CLOSURE_WEB_CONNECT_TIMEOUT', 10)
+READ_TIMEOUT = getattr(settings, 'JSCOMP_CLOSURE_WEB_TIMEOUT', 60)
+
+# idle keep-alive connections kept per process
+POOL_SIZE = getattr(settings, 'JSCOMP_CLOSURE_WEB_CONNECTIONS', 4)
+
+# failed requests (connection errors, timeouts, 429 and 5xx) are retried after a random 
+# delay of up to RETRY_DELAY seconds, doubled for every further attempt
+RETRIES = getattr(settings, 'JSCOMP_CLOSURE_WEB_RETRIES', 2)
+RETRY_DELAY = getattr(settings, 'JSCOMP_CLOSURE_WEB_RETRY_DELAY', 1)
+
+retry_statuses = (429, 500, 502, 503, 504)
+
+closure_stats = Counters('closure_web')
+
+
+class ClosureRequestError(BackendException):
+    pass
+
+class ClosureTimeout(ClosureRequestError, CompressorTimeout):
     pass
 
 
+class ConnectionPool(object):
+    """
+    Keep-alive connections to the Closure host. At most size idle connections are kept,
+    the most recently used connection is reused first.
+    """
+    def __init__(self, url, size=POOL_SIZE, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        parts = urlparse.urlsplit(url)
+        self.connection_class = httplib.HTTPSConnection if parts.scheme == 'https' else httplib.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or "/"
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.idle = Queue.LifoQueue()
+    
+    def connect(self):
+        conn = self.connection_class(self.host, self.port, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        closure_stats.incr('connect')
+        return conn
+    
+    def release(self, conn):
+        if self.idle.qsize() < self.size:
+            self.idle.put(conn)
+        else:
+            conn.close()
+    
+    def request(self, body, headers):
+        """
+        POSTs the body, returns the (status, data). A reused connection the server closed
+        in the meantime is replaced by a new connection.
+        """
+        try:
+            conn, reused = self.idle.get_nowait(), True
+        except Queue.Empty:
+            conn, reused = self.connect(), False
+        try:
+            conn.request('POST', self.path, body, headers)
+            res = conn.getresponse()
+            data = res.read()
+        except (socket.error, httplib.HTTPException), e:
+            conn.close()
+            if reused and not isinstance(e, socket.timeout):
+                return self.request(body, headers)
+            raise
+        closure_stats.incr('request')
+        if res.will_close:
+            conn.close()
+        else:
+            self.release(conn)
+        return res.status, data
+    
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                break
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_connection_pool(url):
+    """
+    Returns the process-wide pool for the url, a forked child creates its own.
+    """
+    key = (os.getpid(), url)
+    try:
+        return _pools[key]
+    except KeyError:
+        with _pools_lock:
+            if key not in _pools:
+                _pools[key] = ConnectionPool(url)
+            return _pools[key]
+
+
 class GoogleClosureWebService(CompressorService):
     """
     Web-based Google Closure Compiler Service. Relies on Google's appspot
     web service.
     
     More info at http://closure-compiler.appspot.com/
+    
+    The service compiles one program per request, the js_code of several jobs would be
+    returned as one compiled program, so the jobs are not batched into one request.
     """
-    closure_uri = "/compile"
-    closure_host = "closure-compiler.appspot.com"
+    closure_url = CLOSURE_URL
     
     def __init__(self, *args, **kwargs):
         super(GoogleClosureWebService, self).__init__(*args, **kwargs)
@@ -61,25 +172,36 @@ class GoogleClosureWebService(CompressorService):
             "Content-type": "application/x-www-form-urlencoded",
             "User-Agent": getattr(settings, 'USER_AGENT', settings.URL_VALIDATOR_USER_AGENT)
         }
+    
+    def pool(self):
+        return get_connection_pool(self.closure_url)
+    
+    def post(self, params):
+        """
+        Returns the response data, retries the failed requests with a jittered backoff.
+        """
+        pool = self.pool()
+        for attempt in range(RETRIES + 1):
+            if attempt:
+                closure_stats.incr('retry')
+                time.sleep(random.uniform(0, RETRY_DELAY * 2 ** (attempt - 1)))
+            try:
+                status, data = pool.request(params, self.headers)
+            except socket.timeout, e:
+                error = ClosureTimeout("Closure request timed out: {0}".format(e))
+            except (socket.error, httplib.HTTPException), e:
+                error = ClosureRequestError("Closure request failed: {0!r}".format(e))
+            else:
+                if status == 200:
+                    return data
+                error = ClosureRequestError("Invalid Closure Request Status Code {0}".format(status))
+                if status not in retry_statuses:
+                    break
+        raise error
         
     @contextmanager
     def closure_request(self, params):
-        conn = None
-        try:
-            conn = httplib.HTTPConnection(self.closure_host)
-            conn.request('POST', self.closure_uri, params, self.headers)
-            res = conn.getresponse()
-            res_data = None
-            if res.status == 200:
-                res_data = res.read()
-            else:
-                raise ClosureRequestError("Invalid Closure Request Status Code {0}".format(res.status))
-            yield self.apply_header(res_data)
-        except:
-            raise
-        finally:
-            if conn:
-                conn.close()
+        yield self.apply_header(self.post(params))
     
     def compress_string(self, data):
         params = [
@@ -97,6 +219,10 @@ class GoogleClosureWebService(CompressorService):
 
 class GoogleClosureWebThread(CodeCompressorThread):
     CompressorClass = GoogleClosureWebService
+    
+    @classmethod
+    def options(cls):
+        return "{level} debug={debug}".format(level=COMPILATION_LEVEL, debug=settings.DEBUG)
 
 
 CompressorThread = GoogleClosureWebThread
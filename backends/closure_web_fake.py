@@ -0,0 +1,135 @@
+"""
+A local stand-in for the Closure Compiler web service. Tests and benchmarks the closure_web 
+backend (keep-alive, timeouts, retries) without the network. The "compiled" code is the 
+js_code without the indentation and blank lines.
+
+Usage:
+  python -m staticcomp.backends.closure_web_fake [port]
+  JSCOMP_CLOSURE_WEB_URL = 'http://127.0.0.1:8099/compile'
+
+  server = FakeClosureServer().start()
+  server.url
+  server.fail(2, status=503)   # the next two requests fail
+  server.delay = .5            # seconds before each response
+  server.stop()
+
+Copyright (c) 2011 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import sys
+import threading
+import time
+import urlparse
+
+
+def fake_compile(code):
+    return "\n".join(line.strip() for line in code.splitlines() if line.strip())
+
+
+class FakeClosureHandler(BaseHTTPRequestHandler):
+    # keep-alive
+    protocol_version = "HTTP/1.1"
+    # one write per response, small writes on a kept-alive connection wait for the delayed ACK
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+    
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        self.server.count('requests')
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        status = self.server.next_failure()
+        if status:
+            return self.reply(status, "Error {0}".format(status))
+        params = urlparse.parse_qs(body)
+        if 'js_code' not in params:
+            return self.reply(400, "Missing js_code")
+        self.reply(200, fake_compile("".join(params['js_code'])))
+    
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class FakeClosureServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    
+    def __init__(self, port=0, verbose=False):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeClosureHandler)
+        self.verbose = verbose
+        self.delay = 0
+        self.counts = {'connections': 0, 'requests': 0}
+        self._failures = []
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}/compile".format(self.server_address[1])
+    
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+    
+    def handle_error(self, request, client_address):
+        # ie. the client timed out and closed the connection
+        if self.verbose:
+            HTTPServer.handle_error(self, request, client_address)
+    
+    def fail(self, requests=1, status=503):
+        with self._lock:
+            self._failures.extend([status] * requests)
+    
+    def next_failure(self):
+        with self._lock:
+            return self._failures.pop(0) if self._failures else None
+    
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    server = FakeClosureServer(int(sys.argv[1]) if len(sys.argv) > 1 else 8099, verbose=True)
+    print "Fake Closure Compiler service at {0}".format(server.url)
+    server.serve_forever()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Linear-time engine for `cssmin`.
+
+Produces the same output as `cssmin.cssmin()`. The passes that search the whole
+string again after every match (comments, pseudo-class colons, rgb and hex colors)
+are replaced by single scans, the line wrapping jumps between `}` characters
+instead of iterating each character in Python.
+"""
+
+import re
+
+import cssmin as classic
+
+
+def remove_comments(css):
+    """Remove all CSS comment blocks, in one scan."""
+
+    pieces = []
+    last = 0
+    iemac = False
+    comment_start = css.find("/*")
+    while comment_start >= 0:
+        # Preserve comments that look like `/*!...*/`.
+        preserve = css[comment_start + 2:comment_start + 3] == "!"
+
+        comment_end = css.find("*/", comment_start + 2)
+        if comment_end < 0:
+            if not preserve:
+                pieces.append(css[last:comment_start])
+                last = len(css)
+            # An unterminated `/*!` comment is kept as-is (the classic engine never returns).
+            break
+        elif css[comment_end - 1] == "\\":
+            # This is an IE Mac-specific comment; leave this one and the
+            # following one alone.
+            iemac = True
+        elif iemac:
+            iemac = False
+        elif not preserve:
+            pieces.append(css[last:comment_start])
+            last = comment_end + 2
+        comment_start = css.find("/*", comment_end + 2)
+
+    pieces.append(css[last:])
+    return ''.join(pieces)
+
+
+pseudoclass_re = re.compile(r"(^|\})(([^\{\:])+\:)+([^\{]*\{)")
+
+def pseudoclasscolon(css):
+    """
+    Translates 'p :link' into 'p ___PSEUDOCLASSCOLON___link'.
+
+    Replacing the colons never creates a match before the end of the replaced
+    text, so one `sub()` finds the same matches as searching from the start again.
+    """
+
+    return pseudoclass_re.sub(lambda m: m.group().replace(":", "___PSEUDOCLASSCOLON___"), css)
+
+
+def remove_unnecessary_whitespace(css):
+    """Remove unnecessary whitespace characters."""
+
+    css = pseudoclasscolon(css)
+    # Remove spaces from before things.
+    css = re.sub(r"\s+([!{};:>+\(\)\],])", r"\1", css)
+
+    # If there is a `@charset`, then only allow one, and move to the beginning.
+    css = re.sub(r"^(.*)(@charset \"[^\"]*\";)", r"\2\1", css)
+    css = re.sub(r"^(\s*@charset [^;]+;\s*)+", r"\1", css)
+
+    # Put the space back in for a few cases, such as `@media screen` and
+    # `(-webkit-min-device-pixel-ratio:0)`.
+    css = re.sub(r"\band\(", "and (", css)
+
+    # Put the colons back.
+    css = css.replace('___PSEUDOCLASSCOLON___', ':')
+
+    # Remove spaces from after things.
+    css = re.sub(r"([!{}:;>+\(\[,])\s+", r"\1", css)
+
+    return css
+
+
+def remove_unnecessary_semicolons(css):
+    """Remove unnecessary semicolons, only trying from the start of each run."""
+
+    return re.sub(r"(?<!;);+\}", "}", css)
+
+
+rgb_re = re.compile(r"rgb\s*\(\s*([0-9,\s]+)\s*\)")
+
+def normalize_rgb_colors_to_hex(css):
+    """Convert `rgb(51,102,153)` to `#336699`."""
+
+    def hexcolor(match):
+        colors = map(lambda s: s.strip(), match.group(1).split(","))
+        return '#%.2x%.2x%.2x' % tuple(map(int, colors))
+    return rgb_re.sub(hexcolor, css)
+
+
+hex_re = re.compile(r"([^\"'=\s])(\s*)#([0-9a-fA-F])([0-9a-fA-F])([0-9a-fA-F])([0-9a-fA-F])([0-9a-fA-F])([0-9a-fA-F])")
+
+# a color directly followed by another color, the classic engine skips/rescans these
+adjacent_hex_re = re.compile(r"#[0-9a-fA-F]{6}\s*#[0-9a-fA-F]{6}")
+
+def condense_hex_colors(css):
+    """Shorten colors from #AABBCC to #ABC where possible."""
+
+    if adjacent_hex_re.search(css):
+        return classic.condense_hex_colors(css)
+
+    def shorten(match):
+        first = match.group(3) + match.group(5) + match.group(7)
+        second = match.group(4) + match.group(6) + match.group(8)
+        if first.lower() == second.lower():
+            return match.group(1) + match.group(2) + '#' + first
+        return match.group()
+    return hex_re.sub(shorten, css)
+
+
+def wrap_css_lines(css, line_length):
+    """Wrap the lines of the given CSS to an approximate length."""
+
+    lines = []
+    line_start = 0
+    # It's safe to break after `}` characters.
+    i = css.find('}', line_length)
+    while i >= 0:
+        lines.append(css[line_start:i + 1])
+        line_start = i + 1
+        i = css.find('}', line_start + line_length)
+
+    if line_start < len(css):
+        lines.append(css[line_start:])
+    return '\n'.join(lines)
+
+
+def cssmin(css, wrap=None):
+    css = remove_comments(css)
+    css = classic.condense_whitespace(css)
+    # A pseudo class for the Box Model Hack
+    # (see http://tantek.com/CSS/Examples/boxmodelhack.html)
+    css = css.replace('"\\"}\\""', "___PSEUDOCLASSBMH___")
+    css = remove_unnecessary_whitespace(css)
+    css = remove_unnecessary_semicolons(css)
+    css = classic.condense_zero_units(css)
+    css = classic.condense_multidimensional_zeros(css)
+    css = classic.condense_floating_points(css)
+    css = normalize_rgb_colors_to_hex(css)
+    css = condense_hex_colors(css)
+    if wrap is not None:
+        css = wrap_css_lines(css, wrap)
+    css = css.replace("___PSEUDOCLASSBMH___", '"\\"}\\""')
+    css = classic.condense_semicolons(css)
+    return css.strip()
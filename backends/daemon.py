@@ -0,0 +1,262 @@
+"""
+Persistent compressor processes. Instead of spawning the compressor for every job, one or
+more processes are kept alive and receive length-framed jobs over STDIN/STDOUT:
+
+  request:  "JOB <bytes>\\n<source>"  or  "PING\\n"
+  response: "OK <bytes>\\n<compressed>"  or  "ERR <bytes>\\n<message>"
+
+Used by the uglifyjs (JSCOMP_UGLIFY_DAEMON) and closure_java (JSCOMP_CLOSURE_SERVER) backends.
+
+Copyright (c) 2011 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+from staticcomp.compressor import BackendException, CompressorException, CompressorTimeout, limit_process, limited_cmdline
+
+from functools import partial
+
+import errno
+import fcntl
+import os
+import select
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import Queue
+
+
+class DaemonException(BackendException):
+    pass
+
+class DaemonTimeout(DaemonException, CompressorTimeout):
+    pass
+
+
+class CompressorDaemon(object):
+    """
+    A single long-lived compressor process. The process is (re)started on demand,
+    health checked with a PING after being idle and killed when a job times out.
+    """
+    def __init__(self, cmdline, timeout=60, max_jobs=0, health_interval=30):
+        self.cmdline = cmdline
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+        self.health_interval = health_interval
+        self.process = None
+        self.stderr = None
+        self.jobs = 0
+        self.last_used = 0
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        self.stop()
+        if self.stderr is not None:
+            self.stderr.close()
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            limited_cmdline(self.cmdline),
+            shell=False,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=self.stderr,
+            close_fds=True,
+            # the CPU time adds up over the jobs, the job timeout applies instead
+            preexec_fn=partial(limit_process, cpu_seconds=0)
+        )
+        # writes are bounded by the job timeout
+        fd = self.process.stdin.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.jobs = 0
+        self.last_used = time.time()
+
+    def stop(self):
+        if self.process is not None:
+            try:
+                if self.process.poll() is None:
+                    os.killpg(self.process.pid, signal.SIGKILL)
+                    self.process.wait()
+            except OSError:
+                pass
+            self.process = None
+
+    def error_output(self):
+        """
+        Returns the tail of the process STDERR, useful after a crash.
+        """
+        if self.stderr is None:
+            return ""
+        self.stderr.seek(0, os.SEEK_END)
+        self.stderr.seek(max(self.stderr.tell() - 4096, 0))
+        return self.stderr.read()
+
+    def _write(self, data, deadline):
+        fd = self.process.stdin.fileno()
+        view = buffer(data)
+        while view:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise DaemonTimeout("Compressor daemon write timed out")
+            select.select([], [fd], [], remaining)
+            try:
+                written = os.write(fd, view[:65536])
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    continue
+                raise DaemonException("Compressor daemon write failed: {0}".format(e))
+            view = view[written:]
+
+    def _read(self, size, deadline, line=False):
+        fd = self.process.stdout.fileno()
+        chunks = []
+        received = 0
+        while True:
+            if line and chunks and chunks[-1].endswith("\n"):
+                break
+            if not line and received >= size:
+                break
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise DaemonTimeout("Compressor daemon timed out after {0} seconds".format(self.timeout))
+            readable = select.select([fd], [], [], remaining)[0]
+            if not readable:
+                continue
+            chunk = os.read(fd, 1 if line else min(size - received, 65536))
+            if not chunk:
+                raise DaemonException("Compressor daemon exited: {0}".format(self.error_output()))
+            chunks.append(chunk)
+            received += len(chunk)
+        return "".join(chunks)
+
+    def request(self, header, data="", timeout=None):
+        """
+        Sends one framed request and returns (status, body).
+        """
+        deadline = time.time() + (timeout or self.timeout)
+        try:
+            self._write(header + "\n" + data, deadline)
+            status, size = self._read(0, deadline, line=True).split()
+            body = self._read(int(size), deadline)
+        except DaemonTimeout:
+            # the process can't be trusted mid-job, restart on the next request
+            self.stop()
+            raise
+        except DaemonException:
+            self.stop()
+            raise
+        except ValueError:
+            self.stop()
+            raise DaemonException("Invalid compressor daemon response")
+        self.last_used = time.time()
+        return status, body
+
+    def ping(self, timeout=5):
+        try:
+            return self.request("PING", timeout=timeout)[0] == "OK"
+        except DaemonException:
+            return False
+
+    def ensure_running(self):
+        """
+        Starts or restarts the process when it died, failed the health check
+        or reached the max_jobs limit.
+        """
+        if self.max_jobs and self.jobs >= self.max_jobs:
+            self.stop()
+        if not self.is_alive():
+            self.start()
+            if not self.ping(timeout=self.timeout):
+                raise DaemonException("Compressor daemon failed to start: {0}".format(self.error_output()))
+        elif time.time() - self.last_used > self.health_interval and not self.ping():
+            self.start()
+
+    def compress(self, data):
+        """
+        Compresses the data. A job is retried once on a fresh process if the process
+        died before answering; timeouts and compressor errors are not retried.
+        Unicode data is sent UTF-8 encoded, the frame header counts bytes.
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        for attempt in (1, 2):
+            self.ensure_running()
+            self.jobs += 1
+            try:
+                status, body = self.request("JOB {0}".format(len(data)), data)
+            except DaemonTimeout:
+                raise
+            except DaemonException:
+                if attempt == 2:
+                    raise
+                continue
+            if status != "OK":
+                raise CompressorException("Compressor daemon failed: {0}".format(body))
+            return body
+
+
+class DaemonPool(object):
+    """
+    A fixed number of daemons for one command line. Bounds the concurrent jobs to the
+    number of daemons, callers wait for an idle daemon.
+    """
+    def __init__(self, cmdline, size=1, **kwargs):
+        self.idle = Queue.Queue()
+        for i in range(max(int(size), 1)):
+            self.idle.put(CompressorDaemon(cmdline, **kwargs))
+
+    def compress(self, data, wait=None):
+        try:
+            daemon = self.idle.get(True, wait)
+        except Queue.Empty:
+            raise DaemonTimeout("No idle compressor daemon")
+        try:
+            return daemon.compress(data)
+        finally:
+            self.idle.put(daemon)
+
+    def stop(self):
+        while True:
+            try:
+                self.idle.get_nowait().stop()
+            except Queue.Empty:
+                break
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_daemon_pool(cmdline, size=1, **kwargs):
+    """
+    Returns the process-wide pool for the command line. The daemon pipes are not shared
+    with forked children, a child creates its own pool.
+    """
+    key = (os.getpid(), cmdline)
+    try:
+        return _pools[key]
+    except KeyError:
+        with _pools_lock:
+            if key not in _pools:
+                _pools[key] = DaemonPool(cmdline, size, **kwargs)
+            return _pools[key]
@@ -0,0 +1,179 @@
+"""
+In-process JavaScript minifier backend. Removes the comments and the whitespace, nothing is 
+renamed or rewritten, so it's much weaker than UglifyJS/Closure but runs without starting 
+node/java. Meant for the small {% jscompcode %} blocks, see JSCOMP_SMALL_BACKEND.
+
+The source is split into tokens (strings, template strings, regular expression literals and
+comments are kept intact). A space is kept only where two tokens would otherwise merge and a
+line break only where the automatic semicolon insertion could depend on it. /*! and /*@ 
+comments (licenses, conditional compilation) are kept.
+
+Copyright (c) 2011 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+from staticcomp.compressor import CompressorService, CodeCompressorThread, CompressorException, as_string
+
+import re
+
+
+class JsMinError(CompressorException):
+    pass
+
+
+token_re = re.compile(r"""
+    (?P<ws>[ \t\r\n\f\v]+)
+  | (?P<line_comment>//[^\r\n]*)
+  | (?P<block_comment>/\*.*?\*/)
+  | (?P<string>"(?:[^"\\\r\n]|\\[\s\S])*"|'(?:[^'\\\r\n]|\\[\s\S])*'|`(?:[^`\\]|\\[\s\S])*`)
+  | (?P<number>(?:0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?))
+  | (?P<name>(?:[\w$]|\\u[0-9a-fA-F]{4}|[^\x00-\x7f])+)
+  | (?P<punct>[\s\S])
+""", re.VERBOSE | re.DOTALL)
+
+regex_re = re.compile(r"/(?:[^/\\\[\r\n]|\\.|\[(?:[^\]\\\r\n]|\\.)*\])+/[A-Za-z]*")
+
+# a / after these keywords starts a regular expression, after other names it's a division
+regex_keywords = frozenset(['return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void', 
+                            'throw', 'case', 'do', 'else', 'yield', 'await'])
+
+# a / after the ) of these statement heads starts a regular expression, ie. if (x) /re/.test(y)
+head_keywords = frozenset(['if', 'while', 'for', 'with'])
+
+# tokens that may end a statement and begin the next one, a line break between them is kept
+enders = frozenset(')]}+-')
+starters = frozenset('([{+-!~')
+
+# character pairs that would form another token (++, --, //, /*, <!--, -->) without a space
+merging = frozenset(['++', '--', '//', '/*', '<!', '->'])
+
+word_re = re.compile(r"[\w$\\]|[^\x00-\x7f]")
+
+
+def regex_allowed(prev, closed_head=False, postfix=False):
+    if prev is None:
+        return True
+    kind, text = prev
+    if kind == 'punct':
+        if text == ')':
+            return closed_head
+        if postfix:
+            # a / after a++ or a-- is a division
+            return False
+        return text != ']'
+    return kind == 'name' and text in regex_keywords
+
+
+def is_ender(kind, text):
+    return kind != 'punct' or text in enders
+
+
+def is_starter(kind, text):
+    return kind != 'punct' or text in starters
+
+
+def needs_space(prev, kind, text):
+    prev_kind, prev_text = prev
+    if word_re.match(prev_text[-1]) and word_re.match(text[0]):
+        return True
+    if prev_kind == 'number' and text[0] == '.':
+        return True
+    if prev_kind == 'regex' and word_re.match(text[0]):
+        return True
+    return prev_text[-1] + text[0] in merging
+
+
+def minify(js):
+    """
+    Returns the minified JavaScript, raises JsMinError for unterminated strings/comments.
+    """
+    out = []
+    prev = None
+    # the pending whitespace between two tokens: None, ' ' or '\n'
+    space = None
+    # for every open paren, whether it starts an if/while/for/with head
+    parens = []
+    closed_head = False
+    # the last token is the second +/- of a postfix ++/--, the first +/- followed an operand
+    postfix = False
+    sign_after_operand = False
+    pos = 0
+    end = len(js)
+    while pos < end:
+        match = None
+        if js[pos] == '/' and js[pos + 1:pos + 2] not in ('/', '*') and regex_allowed(prev, closed_head, postfix):
+            match = regex_re.match(js, pos)
+            kind = 'regex'
+        if match is None:
+            match = token_re.match(js, pos)
+            kind = match.lastgroup
+        text = match.group()
+        pos = match.end()
+        
+        if kind == 'ws':
+            space = '\n' if '\n' in text or '\r' in text else space or ' '
+        elif kind == 'line_comment':
+            space = space or ' '
+        elif kind == 'block_comment':
+            if text.startswith('/*!') or text.startswith('/*@'):
+                out.append(text)
+            space = '\n' if '\n' in text or '\r' in text else space or ' '
+        else:
+            if kind == 'punct':
+                if text in '"\'`' or (text == '/' and js[pos:pos + 1] == '*'):
+                    raise JsMinError("Unterminated string or comment at {0}".format(pos - 1))
+            if prev is not None and space:
+                if space == '\n' and is_ender(*prev) and is_starter(kind, text):
+                    out.append('\n')
+                elif needs_space(prev, kind, text):
+                    out.append(' ')
+            out.append(text)
+            operand = not regex_allowed(prev, closed_head, postfix)
+            if kind == 'punct' and text in '+-':
+                postfix = sign_after_operand and not space and prev == (kind, text)
+                sign_after_operand = not postfix and operand and space != '\n'
+            else:
+                postfix = sign_after_operand = False
+            closed_head = False
+            if kind == 'punct' and text == '(':
+                parens.append(prev is not None and prev[0] == 'name' and prev[1] in head_keywords)
+            elif kind == 'punct' and text == ')':
+                closed_head = parens.pop() if parens else False
+            prev = (kind, text)
+            space = None
+    return "".join(out)
+
+
+class JsMin(CompressorService):
+    """
+    Pure-Python whitespace and comment remover, runs in the worker without starting a process.
+    """
+    def compress_string(self, data):
+        return self.apply_header(minify(as_string(data)))
+
+
+class JsMinThread(CodeCompressorThread):
+    CompressorClass = JsMin
+    # fast enough to compress the small groups during the request
+    in_request = True
+
+
+CompressorThread = JsMinThread
@@ -0,0 +1,123 @@
+/*
+ * Long-lived Google Closure Compiler used by the staticcomp closure_java backend (JSCOMP_CLOSURE_SERVER).
+ * Keeps the JVM warm and compresses length-framed jobs read from STDIN:
+ *
+ *   request:  "JOB <bytes>\n<source>"  or  "PING\n"
+ *   response: "OK <bytes>\n<compressed>"  or  "ERR <bytes>\n<message>"
+ *
+ * The compiled classes are shipped next to this file, rebuild them after a change (Java 6 bytecode
+ * like compiler.jar):
+ *   javac -source 1.6 -target 1.6 -cp compiler.jar -d . ClosureServer.java
+ *   java -Xmx256m -cp compiler.jar:. ClosureServer SIMPLE_OPTIMIZATIONS [--pretty]
+ */
+
+import com.google.javascript.jscomp.CommandLineRunner;
+import com.google.javascript.jscomp.CompilationLevel;
+import com.google.javascript.jscomp.Compiler;
+import com.google.javascript.jscomp.CompilerOptions;
+import com.google.javascript.jscomp.JSError;
+import com.google.javascript.jscomp.JSSourceFile;
+import com.google.javascript.jscomp.Result;
+
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.util.ArrayList;
+import java.util.List;
+import java.util.logging.Level;
+
+public class ClosureServer {
+
+    static class CompileException extends Exception {
+        CompileException(String message) {
+            super(message);
+        }
+    }
+
+    private final CompilationLevel level;
+    private final boolean pretty;
+    private final List<JSSourceFile> externs;
+
+    @SuppressWarnings("unchecked")
+    public ClosureServer(CompilationLevel level, boolean pretty) throws IOException {
+        this.level = level;
+        this.pretty = pretty;
+        this.externs = CommandLineRunner.getDefaultExterns();
+    }
+
+    public String compile(String code) throws CompileException {
+        // errors are returned to the caller, the compiler's own output is discarded
+        Compiler compiler = new Compiler(new PrintStream(new ByteArrayOutputStream()));
+        CompilerOptions options = new CompilerOptions();
+        level.setOptionsForCompilationLevel(options);
+        options.prettyPrint = pretty;
+
+        List<JSSourceFile> inputs = new ArrayList<JSSourceFile>();
+        inputs.add(JSSourceFile.fromCode("input.js", code));
+        Result result = compiler.compile(externs, inputs, options);
+        if (!result.success) {
+            StringBuilder buf = new StringBuilder();
+            for (JSError error : result.errors) {
+                buf.append(error.toString()).append("\n");
+            }
+            throw new CompileException(buf.toString());
+        }
+        return compiler.toSource();
+    }
+
+    private static String readLine(InputStream in) throws IOException {
+        ByteArrayOutputStream buf = new ByteArrayOutputStream();
+        int c;
+        while ((c = in.read()) != '\n') {
+            if (c < 0) {
+                return null;
+            }
+            buf.write(c);
+        }
+        return buf.toString("US-ASCII");
+    }
+
+    private static void reply(OutputStream out, String status, String body) throws IOException {
+        byte[] data = body.getBytes("UTF-8");
+        out.write((status + " " + data.length + "\n").getBytes("US-ASCII"));
+        out.write(data);
+        out.flush();
+    }
+
+    public static void main(String[] args) throws IOException {
+        CompilationLevel level = CompilationLevel.valueOf(args.length > 0 ? args[0] : "SIMPLE_OPTIMIZATIONS");
+        boolean pretty = args.length > 1 && "--pretty".equals(args[1]);
+        Compiler.setLoggingLevel(Level.OFF);
+
+        ClosureServer server = new ClosureServer(level, pretty);
+        DataInputStream in = new DataInputStream(new BufferedInputStream(System.in));
+        OutputStream out = new BufferedOutputStream(System.out);
+
+        String line;
+        while ((line = readLine(in)) != null) {
+            if (line.equals("PING")) {
+                reply(out, "OK", "");
+                continue;
+            }
+            if (!line.startsWith("JOB ")) {
+                reply(out, "ERR", "Invalid request " + line);
+                System.exit(1);
+            }
+
+            byte[] code = new byte[Integer.parseInt(line.substring(4).trim())];
+            in.readFully(code);
+            try {
+                reply(out, "OK", server.compile(new String(code, "UTF-8")));
+            } catch (CompileException e) {
+                reply(out, "ERR", e.getMessage());
+            } catch (RuntimeException e) {
+                reply(out, "ERR", e.toString());
+            }
+        }
+    }
+}
@@ -0,0 +1,129 @@
+#! /usr/bin/env node
+// -*- js -*-
+//
+// Long-lived UglifyJS compressor used by the staticcomp uglifyjs backend (JSCOMP_UGLIFY_DAEMON).
+// Loads UglifyJS once and compresses length-framed jobs read from stdin:
+//
+//   request:  "JOB <bytes>\n<source>"  or  "PING\n"
+//   response: "OK <bytes>\n<compressed>"  or  "ERR <bytes>\n<message>"
+//
+// Accepts the same options as bin/uglifyjs used by the backend:
+//   node uglifyjs_server.js [--beautify] [--unsafe] [--max-line-len N]
+
+var uglify = require("./UglifyJS/uglify-js"),
+    jsp = uglify.parser,
+    pro = uglify.uglify;
+
+var options = {
+        beautify: false,
+        unsafe: false,
+        max_line_length: 32 * 1024
+};
+
+var args = process.argv.slice(2);
+while (args.length > 0) {
+        var v = args.shift();
+        switch (v) {
+            case "-b":
+            case "--beautify":
+                options.beautify = true;
+                break;
+            case "--unsafe":
+                options.unsafe = true;
+                break;
+            case "--max-line-len":
+                options.max_line_length = parseInt(args.shift(), 10);
+                break;
+        }
+}
+
+// warnings would otherwise end up on stderr for every job
+jsp.set_logger(function(){});
+pro.set_logger(function(){});
+
+function show_copyright(comments) {
+        var ret = "";
+        for (var i = 0; i < comments.length; ++i) {
+                var c = comments[i];
+                if (c.type == "comment1") {
+                        ret += "//" + c.value + "\n";
+                } else {
+                        ret += "/*" + c.value + "*/";
+                }
+        }
+        return ret;
+};
+
+// same steps as squeeze_it() in bin/uglifyjs
+function squeeze_it(code) {
+        var result = show_copyright(jsp.tokenizer(code)().comments_before);
+        var ast = jsp.parse(code);
+        ast = pro.ast_mangle(ast, { toplevel: false, defines: {}, except: null });
+        ast = pro.ast_squeeze(ast, { make_seqs: true, dead_code: true, keep_comps: !options.unsafe });
+        if (options.unsafe)
+                ast = pro.ast_squeeze_more(ast);
+        result += pro.gen_code(ast, { beautify: options.beautify, indent_level: 4 });
+        if (!options.beautify && options.max_line_length)
+                result = pro.split_lines(result, options.max_line_length);
+        return result;
+};
+
+function to_buffer(text) {
+        return Buffer.from ? Buffer.from(text, "utf8") : new Buffer(text, "utf8");
+};
+
+function reply(status, text) {
+        var body = to_buffer(text);
+        process.stdout.write(status + " " + body.length + "\n");
+        process.stdout.write(body);
+};
+
+var pending = to_buffer("");
+
+function process_pending() {
+        while (true) {
+                var eol = -1;
+                for (var i = 0; i < pending.length; ++i) {
+                        if (pending[i] == 10) {
+                                eol = i;
+                                break;
+                        }
+                }
+                if (eol < 0)
+                        return;
+
+                var header = pending.slice(0, eol).toString("ascii").split(" ");
+                if (header[0] == "PING") {
+                        pending = pending.slice(eol + 1);
+                        reply("OK", "");
+                        continue;
+                }
+                if (header[0] != "JOB") {
+                        reply("ERR", "Invalid request " + header[0]);
+                        process.exit(1);
+                }
+
+                var size = parseInt(header[1], 10);
+                if (pending.length < eol + 1 + size)
+                        return;
+
+                var code = pending.slice(eol + 1, eol + 1 + size).toString("utf8");
+                pending = pending.slice(eol + 1 + size);
+                try {
+                        reply("OK", squeeze_it(code));
+                } catch(ex) {
+                        reply("ERR", String(ex.stack || JSON.stringify(ex)));
+                }
+        }
+};
+
+process.stdin.on("data", function(chunk){
+        pending = Buffer.concat([pending, chunk]);
+        process_pending();
+});
+
+process.stdin.on("end", function(){
+        process.exit(0);
+});
+
+process.stdin.resume();
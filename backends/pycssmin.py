@@ -1,5 +1,14 @@
+from django.conf import settings
+
 from staticcomp.compressor import CompressorService, CodeCompressorThread
-from cssmin import cssmin
+from cssmin import cssmin, fastcssmin
+
+# 'cssmin' or 'fastcssmin', the fastcssmin engine has the same output in linear time
+engines = {
+    'cssmin': cssmin,
+    'fastcssmin': fastcssmin,
+}
+CSSMIN_ENGINE = getattr(settings, 'CSSCOMP_ENGINE', 'cssmin')
 
 
 class PyCssMin(CompressorService):
@@ -8,7 +17,7 @@ class PyCssMin(CompressorService):
     https://github.com/zacharyvoase/cssmin/blob/master/src/cssmin.py
     """
     def compress_string(self, data):
-        return self.apply_header(cssmin.cssmin(data, 4096 * 2))
+        return self.apply_header(engines[CSSMIN_ENGINE].cssmin(data, 4096 * 2))
 
 
 class PyCssMinThread(CodeCompressorThread):
@@ -31,7 +31,18 @@ THE SOFTWARE.
 from django.conf import settings
 import os
 
-from staticcomp.compressor import CompressorService, CodeCompressorThread
+from staticcomp.compressor import CompressorService, CodeCompressorThread, as_string
+from staticcomp.backends.daemon import get_daemon_pool
+
+
+# keeps node.js processes running with UglifyJS loaded instead of starting node for each job
+UGLIFY_DAEMON = getattr(settings, 'JSCOMP_UGLIFY_DAEMON', False)
+
+# number of node.js processes per worker process, also limits the concurrent jobs
+UGLIFY_DAEMONS = getattr(settings, 'JSCOMP_UGLIFY_DAEMONS', 1)
+
+# seconds before a daemon job is killed
+UGLIFY_TIMEOUT = getattr(settings, 'JSCOMP_UGLIFY_TIMEOUT', 60)
 
 
 
@@ -40,17 +51,39 @@ class UglifyJSCommand(CompressorService):
     UglifyJS JavaScript compiler. Required node.js to run. 
     https://github.com/mishoo/UglifyJS
     """
+    # the files are piped to the command STDIN
+    streaming = True
+    
     def __init__(self, *args, **kwargs):
         super(UglifyJSCommand, self).__init__(*args, **kwargs)
         self.nodejs_cmd = getattr(settings, 'NODEJS_CMD', 'node')
         self.uglifyjs = getattr(settings, 
                                 'JSCOMP_UGLIFY', 
                                 os.path.normpath(os.path.join(os.path.dirname(__file__), 'lib/UglifyJS/bin/uglifyjs')))    
+        self.uglifyjs_server = getattr(settings, 
+                                       'JSCOMP_UGLIFY_SERVER', 
+                                       os.path.normpath(os.path.join(os.path.dirname(__file__), 'lib/uglifyjs_server.js')))    
+
+    def options(self):
+        return "{debug} --unsafe --max-line-len 4096".format(debug="--beautify" if settings.DEBUG else "")
+
+    def compress_daemon(self, data):
+        """
+        Sends the job to one of the long-lived node.js processes.
+        """
+        server_cmd = "{node} {server} {options}".format(node=self.nodejs_cmd,
+                                                        server=self.uglifyjs_server,
+                                                        options=self.options())
+        daemon_pool = get_daemon_pool(server_cmd, UGLIFY_DAEMONS, timeout=UGLIFY_TIMEOUT)
+        return daemon_pool.compress(data)
 
     def compress_string(self, data):
-        uglifyjs_cmd = "{node} {bin} {debug} --unsafe --max-line-len 4096".format(node=self.nodejs_cmd,
-                                                                                  bin=self.uglifyjs,
-                                                                                  debug="--beautify" if settings.DEBUG else "")
+        if UGLIFY_DAEMON:
+            return self.apply_header(self.compress_daemon(as_string(data)))
+        
+        uglifyjs_cmd = "{node} {bin} {options}".format(node=self.nodejs_cmd,
+                                                       bin=self.uglifyjs,
+                                                       options=self.options())
         return self.apply_header(self.cmd(uglifyjs_cmd, data))
 
 
@@ -0,0 +1,170 @@
+"""
+Staticcomp circuit breakers. The consecutive failures of a backend and of a cache key are
+tracked in the cache backend (shared by all processes/hosts), while a breaker is open no
+compression jobs are started and the code is served as-is.
+
+Usage:
+  breaker = CircuitBreaker('staticcomp.backends.uglifyjs', threshold=3)
+  if breaker.allow():
+      ...
+      breaker.success()   # or breaker.failure(error)
+  open_breakers()         # see the staticcomp_health command
+
+Copyright (c) 2011 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+
+from staticcomp.stats import Counters
+
+import time
+
+BREAKER_KEY = 'staticcomp_breaker_{name}'
+INDEX_KEY = 'staticcomp_breakers'
+MAIL_KEY = 'staticcomp_breaker_mail'
+UNMAILED_KEY = 'staticcomp_breaker_unmailed'
+
+# consecutive failed jobs (of any group) before a backend breaker opens
+THRESHOLD = getattr(settings, 'STATICCOMP_BREAKER_THRESHOLD', 3)
+
+# seconds a breaker stays open after the first failure, doubled for every further failure
+BASE_DELAY = getattr(settings, 'STATICCOMP_BREAKER_DELAY', 60)
+MAX_DELAY = getattr(settings, 'STATICCOMP_BREAKER_MAX_DELAY', 60 * 60 * 6)
+
+# at most one failure mail to the admins per interval, the others are counted in the next mail
+MAIL_INTERVAL = getattr(settings, 'STATICCOMP_BREAKER_MAIL_INTERVAL', 60 * 60)
+
+breaker_stats = Counters('breaker')
+
+
+class CircuitBreaker(object):
+    """
+    Opens after threshold consecutive failures for base_delay seconds, doubled for every further 
+    failure up to max_delay. Once the delay passed a single probe is allowed (half-open), its 
+    success closes the breaker and its failure opens it again for twice as long.
+    """
+    def __init__(self, name, threshold=1, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+        self.name = name
+        self.key = BREAKER_KEY.format(name=name)
+        self.probe_key = "_".join([self.key, "probe"])
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+    
+    def state(self):
+        return cache.get(self.key) or {'failures': 0, 'open_until': 0, 'error': None}
+    
+    def delay(self, failures):
+        if failures < self.threshold:
+            return 0
+        return min(self.base_delay * 2 ** (failures - self.threshold), self.max_delay)
+    
+    def is_open(self, state=None):
+        return (state or self.state())['failures'] >= self.threshold
+    
+    def remaining(self):
+        """
+        Seconds until the open breaker lets a probe through, 0 when closed or half-open.
+        """
+        return max(self.state()['open_until'] - time.time(), 0)
+    
+    def allow(self):
+        state = self.state()
+        if not self.is_open(state):
+            return True
+        if state['open_until'] <= time.time() and cache.add(self.probe_key, 1, self.base_delay):
+            breaker_stats.incr('probe')
+            return True
+        breaker_stats.incr('rejected')
+        return False
+    
+    def failure(self, error=None):
+        """
+        Records a failure, returns the seconds the breaker is open (0 below the threshold).
+        """
+        state = self.state()
+        state['failures'] += 1
+        delay = self.delay(state['failures'])
+        state['open_until'] = time.time() + delay
+        state['error'] = error and error[-2048:]
+        # outlives the open period so the next failure backs off further
+        cache.set(self.key, state, self.max_delay * 2)
+        cache.delete(self.probe_key)
+        if delay:
+            breaker_stats.incr('opened')
+            _update_index(self.name, True)
+        return delay
+    
+    def success(self):
+        if cache.get(self.key) is not None:
+            cache.delete_many([self.key, self.probe_key])
+            _update_index(self.name, False)
+
+
+def _update_index(name, add):
+    """
+    The names of the opened breakers for open_breakers(), best-effort across processes.
+    """
+    index = cache.get(INDEX_KEY) or set()
+    if add:
+        index.add(name)
+    else:
+        index.discard(name)
+    cache.set(INDEX_KEY, index, MAX_DELAY * 2)
+
+
+def open_breakers():
+    """
+    Returns the (name, state) of the open and half-open breakers.
+    """
+    index = cache.get(INDEX_KEY) or set()
+    states = cache.get_many([BREAKER_KEY.format(name=name) for name in index])
+    return sorted((name, states[BREAKER_KEY.format(name=name)]) for name in index 
+                  if BREAKER_KEY.format(name=name) in states)
+
+
+def notify_admins(subject, message):
+    """
+    Mails the admins unless a mail was sent within MAIL_INTERVAL (by any process), the 
+    coalesced failures are counted in the next mail. Returns True if the mail was sent.
+    """
+    if not cache.add(MAIL_KEY, time.time(), MAIL_INTERVAL):
+        if not cache.add(UNMAILED_KEY, 1, MAIL_INTERVAL * 2):
+            try:
+                cache.incr(UNMAILED_KEY)
+            except ValueError:
+                cache.set(UNMAILED_KEY, 1, MAIL_INTERVAL * 2)
+        breaker_stats.incr('coalesced')
+        return False
+    
+    unmailed = cache.get(UNMAILED_KEY)
+    cache.delete(UNMAILED_KEY)
+    if unmailed:
+        message += "\n\n{0} more failures since the last mail.".format(unmailed)
+    breakers = open_breakers()
+    if breakers:
+        message += "\n\nOpen breakers:\n" + "\n".join(
+            "  {0} ({1} failures)".format(name, state['failures']) for name, state in breakers)
+    from django.core.mail import mail_admins
+    mail_admins(subject, message, fail_silently=True)
+    return True
@@ -29,7 +29,6 @@ THE SOFTWARE.
 
 from django.core.cache import cache
 from django.conf import settings
-from django.utils._os import safe_join
 
 # By default uses the multiprocessing.Process. In my testing with uwsgi, the
 # Thread will hang before the compressor process has a chance to
@@ -47,15 +46,33 @@ else:
 from datetime import datetime
 from StringIO import StringIO
 
+import gzip
 import hashlib
 import hmac
 import base64
 import os
 import re
+import resource
+import signal
 import subprocess
+import sys
 import itertools
+import tempfile
+import threading
+import time
+import uuid
 
 from staticcomp import CodeCompressorThreadFactory
+from staticcomp.breaker import CircuitBreaker, notify_admins, THRESHOLD as BREAKER_THRESHOLD
+from staticcomp.fileindex import file_index
+from staticcomp.pool import get_pool
+from staticcomp.shm import get_shared_cache
+from staticcomp.stats import Counters
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # bad file / file hack regex
 bad_file_re = re.compile(r'(\.\.|\./|\\|[\'%"$~+|<>&\s{}()@,`?])')
@@ -63,10 +80,88 @@ bad_file_re = re.compile(r'(\.\.|\./|\\|[\'%"$~+|<>&\s{}()@,`?])')
 # cache timeout for cached javascript, default of 1 year
 CACHE_TIMEOUT = getattr(settings, 'STATICCOMP_CACHE_SECONDS', 60 * 60 * 24 * 365)
 
+# frontend cache key of the compressed/appended urls
+KEY_FORMAT = getattr(settings, 'STATICCOMP_CACHE_KEY', 'staticcomp_{group}_{hash}')
+
+# cache keys of the inline code blocks by the digest of the code, compressed and as-is
+CODE_KEY_FORMAT = 'staticcomp_code_{digest}'
+CODE_SOURCE_KEY_FORMAT = 'staticcomp_code_source_{digest}'
+
+# precompressed variants stored under sibling keys of the served code, 'gzip' and 'br' (requires brotli)
+ENCODINGS = [e for e in getattr(settings, 'STATICCOMP_ENCODINGS', ()) if e != 'br' or brotli]
+
+# cache key suffix of the variants, ie. staticcomp_[group]_[hash]_gz
+encoding_suffix = {
+    'br': 'br',
+    'gzip': 'gz',
+}
+
+# the files are streamed in chunks of this size
+CHUNK_SIZE = 64 * 1024
+
+# cache timeout for the uncompressed code while the compression job runs
+PROCESSING_TIMEOUT = 60
+
+# the compile lease expires unless renewed by the running job 
+LEASE_TIMEOUT = getattr(settings, 'STATICCOMP_LEASE_SECONDS', 60)
+
+# compress each file of a group on its own and assemble the group from the cached fragments
+FRAGMENTS = getattr(settings, 'STATICCOMP_FRAGMENTS', False)
+
+FRAGMENT_KEY = 'staticcomp_fragment_{hash}'
+
+# already minified files are used as-is in fragment mode
+min_file_re = re.compile(r'\.min\.(js|css)$')
+
+FAILED_HEADER = "/* Compression failed {0} */"
+
+# start of the JsCompressor/CssCompressor processing headers
+PROCESSING_PREFIX = "/* Processing "
+
+# cache a cheap first pass (jsmin/fastcssmin) while the compression job runs instead of the raw code
+PROGRESSIVE = getattr(settings, 'STATICCOMP_PROGRESSIVE', False)
+
+FIRST_PASS_HEADER = "/* Processing {code_type} compression {now}, first pass */"
+
+# 'mtime' versions the payload urls with the latest file modification time, 'content' with
+# a digest of the file contents so identical files have the same urls/keys on every host
+VERSIONING = getattr(settings, 'STATICCOMP_VERSIONING', 'mtime')
+
+# wall-clock seconds of a compressor command before its process group is killed, 0 waits forever
+CMD_TIMEOUT = getattr(settings, 'STATICCOMP_CMD_TIMEOUT', 300)
+
+# rlimits of the compressor commands (CPU seconds, address space bytes), 0 is unlimited
+CMD_CPU_SECONDS = getattr(settings, 'STATICCOMP_CMD_CPU_SECONDS', 0)
+CMD_MEMORY_BYTES = getattr(settings, 'STATICCOMP_CMD_MEMORY_BYTES', 0)
+
+# priority of the compressor commands, a nice increment and an ionice class[:level] (ie. '3' for idle)
+CMD_NICE = getattr(settings, 'STATICCOMP_CMD_NICE', 0)
+CMD_IONICE = getattr(settings, 'STATICCOMP_CMD_IONICE', None)
+
+# duplicate compiles that were prevented by another lease holder, 'suppressed'
+lease_stats = Counters('lease', shared=True)
+
+# requests that found the job running in this process, 'coalesced' (per process, one per request 
+# of a cold url)
+in_flight_stats = Counters('in_flight')
+
+# 'failed' and 'timeout' compression jobs
+job_stats = Counters('job', shared=True)
+
 
 class CompressorException(Exception):
     pass
 
+class BackendException(CompressorException):
+    """
+    The backend itself failed (crashed, missing or unreachable) instead of rejecting the code,
+    counts toward the backend circuit breaker.
+    """
+    pass
+
+class CompressorTimeout(BackendException):
+    pass
+
 class PayloadException(CompressorException):
     pass
 
@@ -77,13 +172,442 @@ class BadFileException(PayloadException):
 
 
 def media_root(name):
-    return safe_join(settings.MEDIA_ROOT, name)
+    return file_index.resolve(name)
+
+
+def read_files(file_paths):
+    """
+    Returns the files as one value in the order given.
+    """
+    files = []
+    for file_path in file_paths:
+        with open(file_path, 'r') as fd:
+            files.append(fd.read())
+    # each file is followed by a newline
+    files.append("")
+    return "\n".join(files)
+
+
+def iter_files(file_paths, chunk_size=CHUNK_SIZE):
+    """
+    Yields the files in chunks in the order given, the same value as read_files() without
+    holding more than one chunk.
+    """
+    for file_path in file_paths:
+        with open(file_path, 'r') as fd:
+            for chunk in iter(lambda: fd.read(chunk_size), ''):
+                yield chunk
+        yield "\n"
+
+
+class FileSource(object):
+    """
+    The files of a compression job. Streaming backends iterate the chunks (ie. into the 
+    compressor STDIN), the others get the joined value.
+    """
+    def __init__(self, file_paths):
+        self.file_paths = file_paths
+    
+    def __iter__(self):
+        return iter_files(self.file_paths)
+    
+    def __len__(self):
+        return sum(os.path.getsize(file_path) + 1 for file_path in self.file_paths)
+    
+    def read(self):
+        return read_files(self.file_paths)
+
+
+def as_string(data):
+    return data.read() if isinstance(data, FileSource) else data
+
+
+def variant_key(cache_key, encoding):
+    return "_".join([cache_key, encoding_suffix[encoding]])
+
+
+def encode_variant(data, encoding):
+    """
+    Compresses the code with the highest compression level, the gzip header has no timestamp
+    so every host creates the same bytes.
+    """
+    if encoding == 'gzip':
+        buf = StringIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as fd:
+            fd.write(data)
+        return buf.getvalue()
+    if encoding == 'br':
+        return brotli.compress(data, quality=11)
+    raise CompressorException("Unknown encoding {0}".format(encoding))
+
+
+def is_final(data):
+    """
+    False for the processing and failed placeholders, they are replaced once the job is done.
+    """
+    return not data.startswith(PROCESSING_PREFIX) and not data.startswith(FAILED_HEADER.split("{0}")[0])
+
+
+class CacheOutputStore(object):
+    """
+    Stores the served (compressed/appended) code and its precompressed variants in the cache backend
+    and the host-local shared memory cache (STATICCOMP_SHM_BYTES). The lineage identifies the payload 
+    (group and files) across its versions.
+    """
+    def save(self, cache_key, data, timeout=CACHE_TIMEOUT, lineage=None):
+        values = dict((variant_key(cache_key, e), encode_variant(data, e)) for e in ENCODINGS)
+        # the variants are stored before the code, a frontend that finds the code also finds the variants
+        if values:
+            cache.set_many(values, timeout)
+        cache.set(cache_key, data, timeout)
+        
+        shared = get_shared_cache()
+        if shared is not None:
+            values[cache_key] = data
+            for key, value in values.items():
+                shared.set(key, value)
+    
+    def load(self, cache_key, encoding=None):
+        key = variant_key(cache_key, encoding) if encoding else cache_key
+        shared = get_shared_cache()
+        if shared is None:
+            return cache.get(key)
+        
+        data = shared.get(key)
+        if data is None:
+            data = cache.get(key)
+            if data is not None and is_final(data):
+                shared.set(key, data)
+        return data
+
+
+class FilesystemOutputStore(CacheOutputStore):
+    """
+    Also writes the served code to STATICCOMP_OUTPUT_ROOT as [cache_key], [cache_key].gz and [cache_key].br 
+    for the frontend (ie. nginx try_files/gzip_static). The files are written to a temp file and renamed, 
+    the previous version of the payload is removed and the oldest files are removed when the directory 
+    exceeds STATICCOMP_OUTPUT_MAX_BYTES. The code is read back from the files when evicted from the cache.
+    
+    The directory size is kept as a running total of this process' writes, the directory is only 
+    listed when the total exceeds the max bytes. Other processes' writes are counted by that listing.
+    """
+    file_suffix = {
+        'br': '.br',
+        'gzip': '.gz',
+    }
+    
+    # files written more recently are never removed, a response may just have referenced them
+    min_age = 10
+    
+    # the oldest files are removed until the directory is below this share of the max bytes
+    prune_ratio = 0.9
+    
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root or getattr(settings, 'STATICCOMP_OUTPUT_ROOT', None)
+        if not self.root:
+            raise CompressorException("The FilesystemOutputStore requires the STATICCOMP_OUTPUT_ROOT")
+        if max_bytes is None:
+            max_bytes = getattr(settings, 'STATICCOMP_OUTPUT_MAX_BYTES', 512 * 1024 * 1024)
+        self.max_bytes = max_bytes
+        self.lineage_root = os.path.join(self.root, '.lineage')
+        for path in (self.root, self.lineage_root):
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # created by another process
+                    pass
+        self._total = None
+        self._total_lock = threading.Lock()
+    
+    def path(self, cache_key, encoding=None):
+        if os.sep in cache_key:
+            raise CompressorException("Invalid output file name {0}".format(cache_key))
+        return os.path.join(self.root, cache_key + (self.file_suffix[encoding] if encoding else ""))
+    
+    def write(self, file_path, data):
+        """
+        Writes the data (a string or chunks) to a temp file renamed to the file path, readers 
+        never see a partial file. Returns the change of the bytes on disk.
+        """
+        if isinstance(data, basestring):
+            data = [data]
+        try:
+            previous_size = os.path.getsize(file_path)
+        except OSError:
+            previous_size = 0
+        fd, tmp_path = tempfile.mkstemp(prefix='.staticcomp_', dir=os.path.dirname(file_path))
+        try:
+            with os.fdopen(fd, 'w') as tmp_fd:
+                for chunk in data:
+                    tmp_fd.write(chunk)
+                size = tmp_fd.tell()
+            # readable by the frontend
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, file_path)
+        except:
+            os.remove(tmp_path)
+            raise
+        return size - previous_size
+    
+    def remove(self, cache_key):
+        """
+        Removes the files of the cache key, returns the bytes removed.
+        """
+        removed = 0
+        for encoding in [None] + self.file_suffix.keys():
+            file_path = self.path(cache_key, encoding)
+            try:
+                size = os.path.getsize(file_path)
+                os.remove(file_path)
+            except OSError:
+                continue
+            removed += size
+        return removed
+    
+    def supersede(self, cache_key, lineage):
+        """
+        Records the cache key as the current version of the payload, removes the previous version.
+        Returns the bytes removed.
+        """
+        lineage_path = os.path.join(self.lineage_root, hashlib.sha1(lineage).hexdigest())
+        try:
+            with open(lineage_path, 'r') as fd:
+                previous_key = fd.read()
+        except IOError:
+            previous_key = None
+        self.write(lineage_path, cache_key)
+        if previous_key and previous_key != cache_key:
+            return self.remove(previous_key)
+        return 0
+    
+    def files(self):
+        """
+        Returns the (mtime, size, file_path) of the output files.
+        """
+        files = []
+        for name in os.listdir(self.root):
+            file_path = os.path.join(self.root, name)
+            if name.startswith('.') or not os.path.isfile(file_path):
+                continue
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, file_path))
+        return files
+    
+    def track(self, delta):
+        """
+        Adds the bytes written to the running total, prunes the directory once it exceeds the max bytes.
+        """
+        if not self.max_bytes:
+            return
+        with self._total_lock:
+            if self._total is None:
+                self._total = sum(size for mtime, size, file_path in self.files())
+            else:
+                self._total += delta
+            if self._total > self.max_bytes:
+                self.limit()
+    
+    def limit(self):
+        """
+        Removes the least recently written files until the directory is below the prune ratio 
+        of the max bytes, the files written in the last min_age seconds are kept.
+        """
+        files = self.files()
+        total = sum(size for mtime, size, file_path in files)
+        if total > self.max_bytes:
+            recent = time.time() - self.min_age
+            for mtime, size, file_path in sorted(files):
+                if total <= self.max_bytes * self.prune_ratio or mtime > recent:
+                    break
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    continue
+                total -= size
+        self._total = total
+    
+    def save(self, cache_key, data, timeout=CACHE_TIMEOUT, lineage=None):
+        delta = 0
+        for encoding in ENCODINGS:
+            delta += self.write(self.path(cache_key, encoding), encode_variant(data, encoding))
+        delta += self.write(self.path(cache_key), data)
+        if lineage:
+            delta -= self.supersede(cache_key, lineage)
+        self.track(delta)
+        super(FilesystemOutputStore, self).save(cache_key, data, timeout, lineage)
+    
+    def save_files(self, cache_key, file_paths, lineage=None):
+        """
+        Writes the files (in chunks) as the file of the cache key, only on disk. Returns the file path.
+        """
+        file_path = self.path(cache_key)
+        delta = self.write(file_path, iter_files(file_paths))
+        if lineage:
+            delta -= self.supersede(cache_key, lineage)
+        self.track(delta)
+        return file_path
+    
+    def load(self, cache_key, encoding=None):
+        data = super(FilesystemOutputStore, self).load(cache_key, encoding)
+        if data is None:
+            try:
+                with open(self.path(cache_key, encoding), 'r') as fd:
+                    data = fd.read()
+            except IOError:
+                return None
+            key = variant_key(cache_key, encoding) if encoding else cache_key
+            cache.set(key, data, CACHE_TIMEOUT)
+            shared = get_shared_cache()
+            if shared is not None:
+                shared.set(key, data)
+        return data
+
+
+_output_store = None
+
+
+def get_output_store():
+    """
+    Returns the output store configured by STATICCOMP_OUTPUT_STORE.
+    """
+    global _output_store
+    if _output_store is None:
+        from django.utils.importlib import import_module
+        store_path = getattr(settings, 'STATICCOMP_OUTPUT_STORE', 'staticcomp.compressor.CacheOutputStore')
+        module_name, klass_name = store_path.rsplit('.', 1)
+        _output_store = getattr(import_module(module_name), klass_name)()
+    return _output_store
+
+
+def store_code(cache_key, data, timeout=CACHE_TIMEOUT, lineage=None):
+    """
+    Caches the code. The code of a served url (with a lineage) is handed to the output store.
+    """
+    if lineage:
+        get_output_store().save(cache_key, data, timeout, lineage)
+    else:
+        cache.set(cache_key, data, timeout)
+
+
+def code_stage(data):
+    """
+    The stage that produced the served code: 'processing' (the raw code), 'first-pass', 
+    'final' or 'failed'.
+    """
+    if data.startswith(FAILED_HEADER.split("{0}")[0]):
+        return 'failed'
+    if data.startswith(PROCESSING_PREFIX):
+        first_line = data[:data.find("*/") + 2]
+        return 'first-pass' if first_line.endswith(", first pass */") else 'processing'
+    return 'final'
+
+
+def first_pass(code_type, data):
+    """
+    The cheap minification of the code served until the compression job is done.
+    """
+    if code_type == 'js':
+        from staticcomp.backends.jsmin import minify
+        return minify(data)
+    from staticcomp.backends.cssmin import fastcssmin
+    return fastcssmin.cssmin(data)
+
+
+def accepted_encoding(accept_encoding):
+    """
+    Returns the preferred variant encoding accepted by the Accept-Encoding header value or None.
+    """
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        params = part.strip().split(";")
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition("=")
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+        accepted[params[0].strip()] = q
+    for encoding in ('br', 'gzip'):
+        if encoding in ENCODINGS and accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def limit_process(cpu_seconds=None, memory_bytes=None, nice=None):
+    """
+    Runs in the forked compressor process before the exec. The process leads a process group 
+    of its own (the whole tree is killed on a timeout) with the rlimits and priority applied,
+    by default the STATICCOMP_CMD_* settings.
+    """
+    cpu_seconds = CMD_CPU_SECONDS if cpu_seconds is None else cpu_seconds
+    memory_bytes = CMD_MEMORY_BYTES if memory_bytes is None else memory_bytes
+    nice = CMD_NICE if nice is None else nice
+    os.setsid()
+    if cpu_seconds:
+        # SIGXCPU at the soft limit, SIGKILL at the hard limit
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 5))
+    if memory_bytes:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+    if nice:
+        os.nice(nice)
+
+
+def limited_cmdline(cmdline):
+    """
+    The command line arguments, run by ionice when STATICCOMP_CMD_IONICE is set.
+    """
+    args = cmdline.split()
+    ionice = CMD_IONICE
+    if ionice:
+        io_class, sep, level = str(ionice).partition(":")
+        args = ["ionice", "-c", io_class] + (["-n", level] if level else []) + args
+    return args
+
+
+class ProcessWatchdog(object):
+    """
+    Kills the process group of the process after timeout seconds, use as a context manager
+    around the communication with the process.
+    """
+    def __init__(self, process, timeout):
+        self.process = process
+        self.timeout = timeout
+        self.expired = False
+        self._timer = None
+    
+    def kill(self):
+        self.expired = True
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    
+    def __enter__(self):
+        if self.timeout:
+            self._timer = threading.Timer(self.timeout, self.kill)
+            self._timer.daemon = True
+            self._timer.start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        if self._timer:
+            self._timer.cancel()
 
 
 class CompressorService(object):
     """
-    Code compressor service interface. 
+    Code compressor service interface. A streaming service's compress_string() also accepts 
+    a FileSource, the files are read in chunks instead of one string.
     """
+    streaming = False
+    timeout = CMD_TIMEOUT
+    
     def __init__(self, cache_key, job_name, *args, **kwargs):
         self.cache_key = cache_key
         self.job_name = job_name
@@ -106,20 +630,145 @@ class CompressorService(object):
         Execute the given command and return the STDOUT as the compressed code. Uses 
         the STDIN for the source.
         """
+        if not isinstance(data, basestring):
+            return self.cmd_stream(cmdline, data)
+        
         p = subprocess.Popen(
-            cmdline.split(),
+            limited_cmdline(cmdline),
             shell=False,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+            stderr=subprocess.PIPE,
+            preexec_fn=limit_process
         )
-        stdout, stderr = p.communicate(data)
+        with ProcessWatchdog(p, self.timeout) as watchdog:
+            stdout, stderr = p.communicate(data)
+        self.check_returncode(p, watchdog, stderr)
+        return stdout
+    
+    def check_returncode(self, p, watchdog, stderr):
+        """
+        Raises CompressorTimeout when the command was killed by the watchdog or the CPU limit, 
+        CompressorException for any other failure.
+        """
+        if watchdog.expired:
+            raise CompressorTimeout("Command timed out after {0} seconds".format(watchdog.timeout))
+        if p.returncode == -signal.SIGXCPU or (CMD_CPU_SECONDS and p.returncode == -signal.SIGKILL):
+            raise CompressorTimeout("Command exceeded {0} CPU seconds".format(CMD_CPU_SECONDS))
+        if p.returncode < 0:
+            raise BackendException("Command killed by signal {0}".format(-p.returncode))
         if p.returncode:
             print stderr
             raise CompressorException("Command failed: {0}".format(p.returncode))
+    
+    def cmd_stream(self, cmdline, chunks):
+        """
+        Same as cmd(), the chunks are written to the STDIN by a separate thread while
+        the STDOUT is read.
+        """
+        stderr = tempfile.TemporaryFile()
+        p = subprocess.Popen(
+            limited_cmdline(cmdline),
+            shell=False,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+            preexec_fn=limit_process
+        )
+        
+        def write():
+            try:
+                for chunk in chunks:
+                    p.stdin.write(chunk)
+            except IOError:
+                # the command exited early, see the return code
+                pass
+            finally:
+                p.stdin.close()
+        
+        writer = threading.Thread(target=write)
+        writer.daemon = True
+        with ProcessWatchdog(p, self.timeout) as watchdog:
+            writer.start()
+            stdout = p.stdout.read()
+            p.wait()
+            writer.join()
+        stderr.seek(0)
+        self.check_returncode(p, watchdog, stderr.read())
         return stdout
 
 
+class CompileLease(object):
+    """
+    Ensures a single compression job per cache key across processes and hosts. The lease
+    is acquired with the atomic cache.add() and renewed by a heartbeat while the job runs.
+    """
+    def __init__(self, cache_key, token=None, timeout=LEASE_TIMEOUT):
+        self.key = "_".join([cache_key, "lease"])
+        self.token = token or uuid.uuid4().hex
+        self.timeout = timeout
+        self._heartbeat = None
+        self._stopped = threading.Event()
+    
+    def acquire(self):
+        return cache.add(self.key, self.token, self.timeout)
+    
+    def is_held(self):
+        return cache.get(self.key) is not None
+    
+    def renew(self):
+        if cache.get(self.key) == self.token:
+            cache.set(self.key, self.token, self.timeout)
+            return True
+        return False
+    
+    def _renew_loop(self):
+        while not self._stopped.wait(max(self.timeout / 3.0, 1)):
+            self.renew()
+    
+    def start_heartbeat(self):
+        self._heartbeat = threading.Thread(target=self._renew_loop)
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+    
+    def release(self):
+        if self._heartbeat:
+            self._stopped.set()
+            self._heartbeat.join()
+            self._heartbeat = None
+        if cache.get(self.key) == self.token:
+            cache.delete(self.key)
+
+
+class InFlight(object):
+    """
+    Cache keys with a job started (or found running elsewhere) by this process. Coalesces the 
+    concurrent requests of a process, entries expire with the lease.
+    """
+    max_keys = 1000
+    
+    def __init__(self, timeout=LEASE_TIMEOUT):
+        self.timeout = timeout
+        self._keys = {}
+        self._lock = threading.Lock()
+    
+    def add(self, key):
+        now = time.time()
+        with self._lock:
+            if self._keys.get(key, 0) > now:
+                return False
+            if len(self._keys) >= self.max_keys:
+                self._keys = dict((k, v) for k, v in self._keys.items() if v > now)
+            self._keys[key] = now + self.timeout
+            return True
+    
+    def discard(self, key):
+        with self._lock:
+            self._keys.pop(key, None)
+
+in_flight = InFlight()
+
+
 class CodeCompressorThread(Thread):
     """
     The compressor service executes the actual compression in a separate Thread/Process
@@ -131,37 +780,166 @@ class CodeCompressorThread(Thread):
         
     cache_timeout = CACHE_TIMEOUT
     
-    def __init__(self, cache_key, data, job_name, *args, **kwargs):
+    # run by the request itself instead of a worker, for fast in-process backends
+    in_request = False
+    
+    @classmethod
+    def options(cls):
+        """
+        The backend options that change the compressed code, part of the fragment cache key.
+        """
+        return "debug={0}".format(settings.DEBUG)
+    
+    @classmethod
+    def backend_breaker(cls):
+        """
+        The consecutive failures of the backend, across all groups.
+        """
+        return CircuitBreaker(cls.__module__, BREAKER_THRESHOLD)
+    
+    def __init__(self, cache_key, data, job_name, lease_token=None, lineage=None, first_pass=None, *args, **kwargs):
         Thread.__init__(self, *args, **kwargs)
         self.cache_key = cache_key      
         self.data = data
         self.job_name = job_name
+        self.lease_token = lease_token
+        self.lineage = lineage
+        # the code type of the first pass (STATICCOMP_PROGRESSIVE)
+        self.first_pass = first_pass
 
     def run(self):
+        lease = None
+        if self.lease_token:
+            # keep the lease while the job runs, however long it takes
+            lease = CompileLease(self.cache_key, self.lease_token)
+            lease.start_heartbeat()
+        key_breaker = CircuitBreaker(self.cache_key)
         try:
+            if self.first_pass and not self.in_request:
+                self.store_first_pass()
             self.run_svc()
         except:
+            import traceback
+            buf = StringIO()
+            traceback.print_exc(file=buf)
+            error = sys.exc_info()[1]
+            timed_out = isinstance(error, CompressorTimeout)
+            job_stats.incr('timeout' if timed_out else 'failed')
+            # a group the backend rejects (ie. a syntax error) doesn't stop the other groups
+            if isinstance(error, (BackendException, EnvironmentError)):
+                self.backend_breaker().failure(buf.getvalue())
+            elif isinstance(error, CompressorException):
+                # the backend answered
+                self.backend_breaker().success()
+            # the failed group isn't compressed again until the (growing) delay passed
+            delay = key_breaker.failure(buf.getvalue())
             if not settings.DEBUG:
-                from django.core.mail import mail_admins
-                import traceback
-                buf = StringIO()
-                traceback.print_exc(file=buf)
-                mail_admins("Code compressor thread failed", buf.getvalue(), fail_silently=False)
+                notify_admins("Code compressor thread {0}".format("timed out" if timed_out else "failed"), 
+                              buf.getvalue())
                 
             # if fails, report in header of code
-            code_header = "/* Compression failed {0} */".format(datetime.now())
-            cache.set(self.cache_key, "\n".join([code_header, self.data]), 60)
+            code_header = FAILED_HEADER.format(datetime.now())
+            cache.set(self.cache_key, "\n".join([code_header, as_string(self.data)]), max(delay, 1))
             raise
+        else:
+            key_breaker.success()
+            self.backend_breaker().success()
+        finally:
+            if lease:
+                lease.release()
+            in_flight.discard(self.cache_key)
         
+    def store_first_pass(self):
+        """
+        Replaces the raw processing code with the cheap first pass, the compressed code 
+        replaces it once run_svc() is done.
+        """
+        try:
+            code = first_pass(self.first_pass, as_string(self.data))
+        except CompressorException:
+            # the backend reports the error
+            return
+        code_header = FIRST_PASS_HEADER.format(code_type=self.first_pass.upper(), now=datetime.now())
+        cache.set(self.cache_key, "\n".join([code_header, code]), PROCESSING_TIMEOUT)
+        job_stats.incr('first_pass')
+    
     def run_svc(self):
         """
         Intended to be overridden by the implementing compression service if the
         behavior differs.
         """
         comp = self.CompressorClass(cache_key=self.cache_key, job_name=self.job_name)
-        compressed_data = comp.compress_string(self.data)
+        compressed_data = comp.compress_string(self.data if comp.streaming else as_string(self.data))
         if compressed_data:
-            cache.set(self.cache_key, compressed_data, self.cache_timeout)
+            store_code(self.cache_key, compressed_data, self.cache_timeout, self.lineage)
+
+
+class CompressorJob(object):
+    """
+    A queued compression request. The job carries the file paths (or a spooled copy of 
+    inline data) instead of the source, the worker loads the data and runs the
+    backend CompressorThread in-place.
+    """
+    def __init__(self, code_type, cache_key, job_name, data=None, files=None, lease_token=None, lineage=None,
+                 first_pass=None):
+        self.code_type = code_type
+        self.cache_key = cache_key
+        self.job_name = job_name
+        self.data = data
+        self.files = files
+        self.lease_token = lease_token
+        self.lineage = lineage
+        self.first_pass = first_pass
+        self.spool_file = None
+    
+    def spool(self):
+        """
+        Writes inline data to a temp file so only the file name is sent to a worker process.
+        """
+        if self.data is not None and not self.files:
+            fd, self.spool_file = tempfile.mkstemp(prefix='staticcomp_')
+            with os.fdopen(fd, 'w') as spool_fd:
+                spool_fd.write(self.data)
+            self.data = None
+    
+    def load(self):
+        if self.files:
+            return FileSource(self.files)
+        if self.spool_file:
+            try:
+                with open(self.spool_file, 'r') as fd:
+                    return fd.read()
+            finally:
+                os.remove(self.spool_file)
+        return self.data
+    
+    def create_thread(self):
+        return CodeCompressorThreadFactory.create(self.code_type, self.cache_key, self.load(), self.job_name,
+                                                  lease_token=self.lease_token, lineage=self.lineage,
+                                                  first_pass=self.first_pass)
+    
+    def run(self):
+        self.create_thread().run()
+    
+    def start(self):
+        """
+        Hands the job to the worker pool. Without a pool (STATICCOMP_POOL_SIZE = 0), a 
+        Thread/Process is started for the job. Returns False if the pool queue is full.
+        """
+        pool = get_pool()
+        if pool is None:
+            self.create_thread().start()
+            return True
+        
+        if not pool.use_threads:
+            self.spool()
+        if pool.submit(self):
+            return True
+        # dropped, no worker will read the spooled data
+        if self.spool_file:
+            os.remove(self.spool_file)
+            self.spool_file = None
+        return False
 
 
 class CodePayload(object):
@@ -175,7 +953,8 @@ class CodePayload(object):
     Payload contents (a base64-encoded comma-delimited list):
      1) a list of relative file names to MEDIA_ROOT
      2) the payload signature
-     3) the payload mod timestamp (represents the most recent file mod time in epoch) 
+     3) the payload version (the most recent file mod time in epoch or, with STATICCOMP_VERSIONING
+        set to 'content', a digest of the file contents) 
     """
     def __init__(self, file_list, group):
         if not file_list or not group:
@@ -190,14 +969,13 @@ class CodePayload(object):
         self.hash = None
         self.b64_code = None
         self.name = ", ".join(self.file_list)
-        self._file_cache = {}
         
     @classmethod
     def signature(cls, files, group, mod_time, *parts):
         """
         Creates a signature request to ensure the data is intact and matches this app instance.  
         The signature is based on the current SECRET_KEY, the file names (in order), 
-        the group name and the latest file modification time.
+        the group name and the payload version (the latest file modification time or the content digest).
         """
         digest = hmac.new(settings.SECRET_KEY, digestmod=hashlib.sha256)
         map(digest.update, map(str, itertools.chain(files, (group, mod_time), parts)))
@@ -226,19 +1004,28 @@ class CodePayload(object):
         Calculates the latest modification time for the files. This will ensure
         the payload signature encoding changes when the one or more of the files are modified.
         """
-        return int(max([os.stat(self._media_root(f)).st_mtime for f in self.file_list]))
+        return int(max([file_index.stat(self._media_root(f)).mtime for f in self.file_list]))
+
+    def _calc_content_digest(self):
+        """
+        Calculates a digest of the file contents (in order). Unlike the modification time, the
+        digest is the same on every host that has the same files.
+        """
+        digest = hashlib.sha1()
+        map(digest.update, [file_index.digest(self._media_root(f)) for f in self.file_list])
+        return digest.hexdigest()[:16]
+
+    def _calc_version(self):
+        if VERSIONING == 'content':
+            return self._calc_content_digest()
+        return self._calc_mod_time()
 
     def _media_root(self, file):
         """
-        Check and join the MEDIA_ROOT and the file name. Keeps a small cache of file paths
-        to prevent unnecessary calls to safe_join()
+        Check and join the MEDIA_ROOT and the file name. The paths are kept in the process-wide 
+        file index to prevent unnecessary calls to safe_join()
         """
-        try:
-            file_path = self._file_cache[file]
-        except KeyError:
-            file_path = media_root(file)
-            self._file_cache[file] = file_path
-        return file_path
+        return media_root(file)
     
     def _check_file_name(self, file_name):
         """
@@ -252,7 +1039,7 @@ class CodePayload(object):
             raise BadFileException("Invalid File Type: {0}".format(file_name))
         
         file_path = self._media_root(file_name)
-        if not os.path.exists(file_path):
+        if not file_index.exists(file_path):
             raise BadFileException("File Does Not Exist: {0}".format(file_path))
         return file_path
 
@@ -265,29 +1052,58 @@ class CodePayload(object):
         """
         map(self._check_file_name, self.file_list)
 
-    def encode(self):
+    def version(self):
+        """
+        The payload version, the latest file modification time or the content digest.
+        """
+        return self._calc_version()
+    
+    def encode(self, version=None):
         """
         Encodes the payload using the instance files and the group name.
         Returns (b64_code, hash) of the payload
         """
-        mod_time = self._calc_mod_time()
-        sig = self.__class__.signature(self.file_list, self.group, mod_time)
-        self.b64_code = self.__class__.url_encode(self.file_list, mod_time)
+        if version is None:
+            version = self._calc_version()
+        sig = self.__class__.signature(self.file_list, self.group, version)
+        self.b64_code = self.__class__.url_encode(self.file_list, version)
         
         # the hash value is used as part of the cache key to ensure the key is small
         self.hash = sig
         return self.b64_code, self.hash
 
+    def lineage(self):
+        """
+        Identifies the payload across its versions.
+        """
+        return "{0}:{1}".format(self.group, ",".join(self.file_list))
+
+    def cache_key(self):
+        """
+        The key is used by the frontend (nginx, apache, etc) then passed to the cache 
+        backend (ie memcached). 
+        
+        Default Format: staticcomp_[group]_[hash]
+        """
+        return KEY_FORMAT.format(group=self.group, hash=self.hash)
+
+    def paths(self):
+        """
+        Returns the full file paths in the order given.
+        """
+        return [self._media_root(f) for f in self.file_list]
+    
     def dump(self):
         """
         Returns the files as one value in the order given.
         """
-        buf = StringIO()
-        for f in self.file_list:
-            with open(self._media_root(f), 'r') as fd:
-                buf.write(fd.read())
-                buf.write("\n")
-        return buf.getvalue()
+        return read_files(self.paths())
+    
+    def stream(self):
+        """
+        Yields the files in chunks in the order given.
+        """
+        return iter_files(self.paths())
     
     @classmethod
     def decode(cls, group, b64_code, hash):
@@ -338,6 +1154,50 @@ class CssPayload(CodePayload):
 class JsPayload(CodePayload):
     def check_file_ext(self, file_name):
         return os.path.splitext(file_name)[-1] == '.js'
+
+
+class InlinePayload(object):
+    """
+    An inline code block served from its own url, identified by the digest of the code.
+    The code is kept in the cache next to the compressed code, the view compresses it
+    again when the compressed code was evicted.
+    """
+    def __init__(self, digest):
+        self.digest = digest
+        self.name = digest
+        self.hash = None
+    
+    @classmethod
+    def signature(cls, digest):
+        return hmac.new(settings.SECRET_KEY, ",".join(["inline", digest]), digestmod=hashlib.sha256).hexdigest()
+    
+    def encode(self):
+        """
+        Returns (digest, hash) of the payload.
+        """
+        self.hash = self.__class__.signature(self.digest)
+        return self.digest, self.hash
+    
+    def lineage(self):
+        return None
+    
+    def cache_key(self):
+        return CODE_KEY_FORMAT.format(digest=self.digest)
+    
+    def source_key(self):
+        return CODE_SOURCE_KEY_FORMAT.format(digest=self.digest)
+    
+    def _calc_mod_time(self):
+        # the code of a digest never changes
+        return None
+    
+    @classmethod
+    def decode(cls, digest, hash):
+        if not cls.signature(digest) == hash:
+            raise PayloadException("Invalid Signature")
+        payload_instance = cls(digest)
+        payload_instance.hash = hash
+        return payload_instance
   
 
 class CodeCompressor(object):
@@ -352,15 +1212,24 @@ class CodeCompressor(object):
     Any calls to compress_string() that have already been compressed will return
     the data from the cache backend.
     """
-    def __init__(self, data, job_name=None, cache_key=None, *args, **kwargs):
+    code_type = None
+    processing_header = "/* Processing compression {0} */"
+    fragment_separator = "\n"
+    
+    def __init__(self, data, job_name=None, cache_key=None, files=None, lineage=None, fragment=False, *args, **kwargs):
         super(CodeCompressor, self).__init__(*args, **kwargs)
         self.cached_data = None
+        self.ran_in_request = False
         self.data = data
+        self.files = files
+        self.lineage = lineage
+        # a fragment of a group (STATICCOMP_FRAGMENTS), its raw file is served until compressed
+        self.fragment = fragment
         self.cache_key = cache_key
         self.job_name = job_name        
         if data and not cache_key:
             data_md5 = self._hash(data)
-            self.cache_key = "_".join(["staticcomp_code", data_md5])
+            self.cache_key = CODE_KEY_FORMAT.format(digest=data_md5)
             if not job_name:
                 self.job_name = data_md5
     
@@ -370,49 +1239,169 @@ class CodeCompressor(object):
     def init(self):
         pass
     
+    def load_data(self):
+        """
+        The files are only read when the code is not cached.
+        """
+        if self.data is None and self.files:
+            self.data = read_files(self.files)
+        return self.data
+    
+    def processing_data(self):
+        return "\n".join([self.processing_header.format(datetime.now()), self.load_data()])
+    
+    def source_size(self):
+        if self.data is None and self.files:
+            return len(FileSource(self.files))
+        return len(self.data or "")
+    
+    def start_job(self, lease_token=None):
+        """
+        Queues the compression job. When the files are known, the job reads them
+        instead of carrying the data. An in-request backend (ie. small inputs routed
+        to jsmin) compresses the code right away.
+        """
+        job = CompressorJob(self.code_type, self.cache_key, self.job_name, data=self.data, files=self.files, 
+                            lease_token=lease_token, lineage=self.lineage, 
+                            first_pass=self.code_type if PROGRESSIVE and not self.fragment else None)
+        if CodeCompressorThreadFactory.get_class(self.code_type, self.source_size()).in_request:
+            self.ran_in_request = True
+            try:
+                job.run()
+            except Exception:
+                # cached as failed by the thread
+                pass
+            return True
+        return job.start()
+    
+    def queue_compression(self):
+        """
+        Starts the compression job unless one is already running for the cache key in
+        this process or, holding the compile lease, in any other process/host. No job is 
+        started while the circuit breaker of the backend or of the cache key is open.
+        """
+        thread_klass = CodeCompressorThreadFactory.get_class(self.code_type)
+        for breaker in (thread_klass.backend_breaker(), CircuitBreaker(self.cache_key)):
+            if not breaker.allow():
+                # serve the code as-is, without a job, while the backend or the group is failing
+                code_header = FAILED_HEADER.format(datetime.now())
+                cache.set(self.cache_key, "\n".join([code_header, self.load_data()]), 
+                          max(int(breaker.remaining()), PROCESSING_TIMEOUT))
+                return False
+        
+        lease = CompileLease(self.cache_key)
+        if not in_flight.add(self.cache_key):
+            if lease.is_held():
+                # the placeholder may have expired while the job runs
+                cache.add(self.cache_key, self.processing_data(), PROCESSING_TIMEOUT)
+                in_flight_stats.incr('coalesced')
+                return False
+            # the job ended without a cached result (evicted or failed), start over
+            in_flight.discard(self.cache_key)
+            in_flight.add(self.cache_key)
+        
+        if not lease.acquire():
+            # the lease holder's placeholder may have expired, add() never replaces compressed code
+            cache.add(self.cache_key, self.processing_data(), PROCESSING_TIMEOUT)
+            lease_stats.incr('suppressed')
+            return False
+        
+        # set the current data to prevent processing from overlapping
+        cache.set(self.cache_key, self.processing_data(), PROCESSING_TIMEOUT)
+        
+        # queue the compression for the worker pool
+        if not self.start_job(lease.token):
+            lease.release()
+            in_flight.discard(self.cache_key)
+            return False
+        return True
+    
+    def fragment_key(self, file_path, data):
+        """
+        The fragment is keyed by the file and its content, the backend and the backend options.
+        """
+        factory = CodeCompressorThreadFactory
+        parts = (file_path, self._hash(data), factory.backend(self.code_type, len(data)), 
+                 factory.get_class(self.code_type, len(data)).options())
+        return FRAGMENT_KEY.format(hash=hashlib.sha1(",".join(parts)).hexdigest())
+    
+    def is_compressed(self, data):
+        """
+        False for missing, processing and failed code.
+        """
+        return bool(data) and code_stage(data) == 'final'
+    
+    def load_cached(self):
+        if self.lineage:
+            return get_output_store().load(self.cache_key)
+        return cache.get(self.cache_key)
+    
+    def compress_fragments(self):
+        """
+        Compresses each file on its own (in parallel on the worker pool) and caches the 
+        fragments by content, a changed file only recompiles that file. The group is 
+        cached once all of its fragments are compressed, until then the missing fragments 
+        are served uncompressed.
+        """
+        self.cached_data = self.load_cached()
+        if self.cached_data:
+            return self.cached_data
+        
+        sources = [(file_path, read_files([file_path])) for file_path in self.files]
+        keys = [None if min_file_re.search(file_path) else self.fragment_key(file_path, data) 
+                for file_path, data in sources]
+        cached = cache.get_many([key for key in keys if key])
+        
+        fragments = []
+        complete = True
+        for (file_path, data), key in zip(sources, keys):
+            fragment = cached.get(key) if key else data
+            if key and not self.is_compressed(fragment):
+                complete = False
+                if fragment is None:
+                    job_name = os.path.relpath(file_path, settings.MEDIA_ROOT)
+                    self.__class__(data, cache_key=key, job_name=job_name, files=[file_path], 
+                                   fragment=True).queue_compression()
+                fragment = data
+            fragments.append(fragment)
+        
+        code = self.fragment_separator.join(fragments)
+        if complete:
+            store_code(self.cache_key, code, CACHE_TIMEOUT, self.lineage)
+            self.cached_data = code
+            return code
+        return "\n".join([self.processing_header.format(datetime.now()), code])
+    
     def compress_code(self):
-        raise NotImplementedError()
+        if FRAGMENTS and self.files and self.cache_key:
+            return self.compress_fragments()
+        
+        if self.cache_key:
+            self.cached_data = self.load_cached()
+            if self.cached_data:
+                return self.cached_data
+            if self.queue_compression() and self.ran_in_request:
+                self.cached_data = self.load_cached()
+                if self.is_compressed(self.cached_data):
+                    return self.cached_data
+        
+        # return the code as-is 
+        return self.load_data() or ""
 
 
 class JsCompressor(CodeCompressor):
     """
     The JsCompressor is the main hook into the JavaScript compression framework.
     """
-    def compress_code(self):
-        if self.cache_key:
-            self.cached_data = cache.get(self.cache_key)
-            if not self.cached_data:
-                js_header = "/* Processing JS compression {0} */".format(datetime.now())
-                # set the current js data to prevent processing from overlapping
-                cache.set(self.cache_key, "\n".join([js_header, self.data]), 60)
-                
-                # execute the compression in a separate thread
-                compressor_thread = CodeCompressorThreadFactory.create('js', self.cache_key, self.data, self.job_name)
-                compressor_thread.start()
-            else:
-                return self.cached_data
-        
-        # return JS as-is 
-        return self.data or ""
+    code_type = 'js'
+    processing_header = "/* Processing JS compression {0} */"
+    # compressed code may not end with a semicolon
+    fragment_separator = "\n;\n"
 
 
 class CssCompressor(CodeCompressor):
     """
     The CssCompressor is the main hook into the CSS compression framework.
     """
-    def compress_code(self):
-        if self.cache_key:
-            self.cached_data = cache.get(self.cache_key)
-            if not self.cached_data:
-                css_header = "/* Processing CSS compression {0} */".format(datetime.now())
-                # set the current css data to prevent processing from overlapping
-                cache.set(self.cache_key, "\n".join([css_header, self.data]), 60)
-                
-                # execute the compression in a separate thread
-                compressor_thread = CodeCompressorThreadFactory.create('css', self.cache_key, self.data, self.job_name)
-                compressor_thread.start()
-            else:
-                return self.cached_data
-        
-        # return CSS as-is 
-        return self.data or ""
+    code_type = 'css'
+    processing_header = "/* Processing CSS compression {0} */"
@@ -24,11 +24,110 @@ THE SOFTWARE.
 """
 
 from functools import wraps
-from staticcomp.compressor import JsPayload, CssPayload
-from staticcomp.models import StaticCompError
+from staticcomp import compressor
+from staticcomp.compressor import (JsPayload, CssPayload, InlinePayload, CACHE_TIMEOUT, accepted_encoding, encoding_suffix, 
+                                   get_output_store, is_final, code_stage)
+from staticcomp.errors import error_recorder
 
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified
 from django.conf import settings
+from django.utils.http import http_date, parse_http_date_safe
+
+# the url changes with the files, the compressed code at a url never changes
+IMMUTABLE_CACHE_CONTROL = "public, max-age={0}, immutable".format(CACHE_TIMEOUT)
+
+# the processing (uncompressed) code is replaced at the same url once compressed
+PROCESSING_MAX_AGE = getattr(settings, 'STATICCOMP_PROCESSING_MAX_AGE', 10)
+
+
+def etag(payload, encoding=None):
+    """
+    Strong etag of the final code, the payload hash (and the encoding of a variant).
+    """
+    if encoding:
+        return '"{0}-{1}"'.format(payload.hash, encoding_suffix[encoding])
+    return '"{0}"'.format(payload.hash)
+
+
+def final_headers(response, payload, encoding=None):
+    response['ETag'] = etag(payload, encoding)
+    mod_time = payload._calc_mod_time()
+    if mod_time is not None:
+        response['Last-Modified'] = http_date(mod_time)
+    response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    if compressor.ENCODINGS:
+        response['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def not_modified(request, payload):
+    """
+    Returns a 304 response when the client has the final code of the url, without 
+    reading the files or the cache. Only final responses have an ETag/Last-Modified.
+    """
+    if getattr(settings, 'STATICCOMP_DISABLE', False):
+        return None
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = set(e.strip().replace('W/', '', 1) for e in if_none_match.split(","))
+        for encoding in [None] + encoding_suffix.keys():
+            if etag(payload, encoding) in etags:
+                return final_headers(HttpResponseNotModified(), payload, encoding)
+        return None
+    
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if if_modified_since:
+        mod_time = payload._calc_mod_time()
+        if mod_time is not None and if_modified_since >= mod_time:
+            return final_headers(HttpResponseNotModified(), payload)
+    return None
+
+
+def encoded_response(request, payload, mimetype):
+    """
+    Returns the precompressed variant of the cached code accepted by the client or None.
+    """
+    if not compressor.ENCODINGS or getattr(settings, 'STATICCOMP_DISABLE', False):
+        return None
+    encoding = accepted_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    if not encoding:
+        return None
+    data = get_output_store().load(payload.cache_key(), encoding)
+    if data is None:
+        return None
+    response = HttpResponse(data, mimetype=mimetype)
+    response['Content-Encoding'] = encoding
+    response['Content-Length'] = len(data)
+    return final_headers(response, payload, encoding)
+
+
+def code_response(request, data, mimetype, status_code, payload=None):
+    """
+    The final code is cached by the clients for the cache timeout, the processing code
+    (or the uncompressed code flagged by the view) only for a few seconds.
+    """
+    if isinstance(data, HttpResponse):
+        # the webserver sends the file (X-Accel-Redirect/X-Sendfile)
+        data['Content-Type'] = mimetype
+        return final_headers(data, payload)
+    
+    response = HttpResponse(data, mimetype=mimetype, status=status_code)
+    if isinstance(data, basestring):
+        # streamed files have no length
+        response['Content-Length'] = len(response.content)
+        if status_code == 200:
+            response['X-Staticcomp-Stage'] = 'processing' if getattr(request, 'staticcomp_processing', False) \
+                else code_stage(data)
+    if status_code != 200:
+        response['Cache-Control'] = 'no-cache'
+    elif payload and not getattr(settings, 'STATICCOMP_DISABLE', False) and is_final(data) \
+            and not getattr(request, 'staticcomp_processing', False):
+        final_headers(response, payload)
+    else:
+        response['Cache-Control'] = "public, max-age={0}".format(PROCESSING_MAX_AGE)
+        if compressor.ENCODINGS:
+            response['Vary'] = 'Accept-Encoding'
+    return response
 
 
 def js_payload(f):
@@ -40,22 +139,22 @@ def js_payload(f):
     @wraps(f)
     def inner(request, group, b64_js, hash, *args, **kwargs):
         status_code = 200
+        payload = None
         try:
             payload = JsPayload.decode(group=group, b64_code=b64_js, hash=hash)
+            response = not_modified(request, payload) or encoded_response(request, payload, "application/javascript")
+            if response:
+                return response
             js_data = f(request, payload, *args, **kwargs)
         except:
             if not settings.DEBUG:
-                from StringIO import StringIO
-                import traceback
-                buf = StringIO()
-                traceback.print_exc(file=buf)
-                # write out error to database for non-debug requests
-                StaticCompError.log_error(request, buf.getvalue())                
+                # aggregated and written to the database for non-debug requests
+                error_recorder.record(request)
                 js_data = "/* Invalid Request */"
                 status_code = 500
             else:
                 raise
-        return HttpResponse(js_data, mimetype="application/javascript", status=status_code)
+        return code_response(request, js_data, "application/javascript", status_code, payload)
     return inner
 
 
@@ -68,20 +167,47 @@ def css_payload(f):
     @wraps(f)
     def inner(request, group, b64_css, hash, *args, **kwargs):
         status_code = 200
+        payload = None
         try:
             payload = CssPayload.decode(group=group, b64_code=b64_css, hash=hash)
+            response = not_modified(request, payload) or encoded_response(request, payload, "text/css")
+            if response:
+                return response
             css_data = f(request, payload, *args, **kwargs)
         except:
             if not settings.DEBUG:
-                from StringIO import StringIO
-                import traceback
-                buf = StringIO()
-                traceback.print_exc(file=buf)
-                # write out error to database for non-debug requests
-                StaticCompError.log_error(request, buf.getvalue())                
+                # aggregated and written to the database for non-debug requests
+                error_recorder.record(request)
                 css_data = "/* Invalid Request */"
                 status_code = 500
             else:
                 raise
-        return HttpResponse(css_data, mimetype="text/css", status=status_code)
+        return code_response(request, css_data, "text/css", status_code, payload)
+    return inner
+
+
+def inline_js_payload(f):
+    """
+    Validates the InlinePayload of an external {% jscompcode %} block, otherwise the same as 
+    js_payload().
+    """
+    @wraps(f)
+    def inner(request, digest, hash, *args, **kwargs):
+        status_code = 200
+        payload = None
+        try:
+            payload = InlinePayload.decode(digest=digest, hash=hash)
+            response = not_modified(request, payload) or encoded_response(request, payload, "application/javascript")
+            if response:
+                return response
+            js_data = f(request, payload, *args, **kwargs)
+        except:
+            if not settings.DEBUG:
+                # aggregated and written to the database for non-debug requests
+                error_recorder.record(request)
+                js_data = "/* Invalid Request */"
+                status_code = 500
+            else:
+                raise
+        return code_response(request, js_data, "application/javascript", status_code, payload)
     return inner
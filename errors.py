@@ -0,0 +1,179 @@
+"""
+Staticcomp error recorder. The failed requests are aggregated in memory by the error signature
+(the exception type and traceback frames) and written to the StaticCompError table in batches,
+one row per signature with the number of occurrences.
+
+Usage:
+  error_recorder.record(request)   # in an except block
+  error_recorder.flush()           # writes the pending errors now
+  prune(days=30, max_rows=10000)   # see the staticcomp_prune_errors command
+
+Copyright (c) 2011 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+
+from staticcomp.models import StaticCompError
+from staticcomp.stats import Counters
+
+from datetime import datetime, timedelta
+import atexit
+import hashlib
+import random
+import sys
+import threading
+import traceback
+
+# seconds the errors are aggregated before they're written, 0 writes on every error
+FLUSH_INTERVAL = getattr(settings, 'STATICCOMP_ERROR_FLUSH_INTERVAL', 60)
+
+# fraction of the failed requests that are recorded, the stored counts are scaled up
+SAMPLE_RATE = getattr(settings, 'STATICCOMP_ERROR_SAMPLE_RATE', 1.0)
+
+# distinct errors kept per process between the flushes, further errors are only counted in the stats
+MAX_PENDING = getattr(settings, 'STATICCOMP_ERROR_MAX_PENDING', 100)
+
+RETENTION_DAYS = getattr(settings, 'STATICCOMP_ERROR_RETENTION_DAYS', 30)
+MAX_ROWS = getattr(settings, 'STATICCOMP_ERROR_MAX_ROWS', 10000)
+
+error_stats = Counters('errors')
+
+
+def error_signature(exc_type, tb):
+    """
+    Digest of the exception type and the traceback frames. The message is left out,
+    it usually contains the request data (ie. the invalid url).
+    """
+    frames = ["{0}:{1}:{2}".format(*frame[:3]) for frame in traceback.extract_tb(tb)]
+    return hashlib.sha1("{0}\n{1}".format(exc_type.__name__, "\n".join(frames))).hexdigest()
+
+
+class ErrorRecorder(object):
+    """
+    Thread-safe error aggregation per process. Only the first occurrence of an error is
+    formatted, the pending errors are written by a timer thread every flush_interval seconds.
+    """
+    def __init__(self, flush_interval=FLUSH_INTERVAL, sample_rate=SAMPLE_RATE, max_pending=MAX_PENDING):
+        self.flush_interval = flush_interval
+        self.sample_rate = sample_rate
+        self.max_pending = max_pending
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._timer = None
+    
+    def record(self, request, exc_info=None):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            error_stats.incr('sampled')
+            return
+        exc_type, exc_value, tb = exc_info or sys.exc_info()
+        signature = error_signature(exc_type, tb)
+        now = datetime.now()
+        with self._lock:
+            error = self._pending.get(signature)
+            if error is None:
+                if len(self._pending) >= self.max_pending:
+                    error_stats.incr('dropped')
+                    return
+                error = self._pending[signature] = {
+                    'stack': "".join(traceback.format_exception(exc_type, exc_value, tb)),
+                    'request': str(request),
+                    'ip_address': request.META.get('REMOTE_ADDR', ''),
+                    'user_agent': request.META.get('HTTP_USER_AGENT', '')[:2048],
+                    'count': 0,
+                }
+            error['count'] += 1.0 / self.sample_rate
+            error['last_seen'] = now
+            if self.flush_interval and self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self._timed_flush)
+                self._timer.daemon = True
+                self._timer.start()
+        error_stats.incr('recorded')
+        if not self.flush_interval:
+            self.flush()
+    
+    def _timed_flush(self):
+        try:
+            self.flush()
+        finally:
+            # the timer thread's own connection
+            connection.close()
+    
+    def pending(self):
+        return len(self._pending)
+    
+    def flush(self):
+        """
+        Writes the pending errors, returns the number of signatures written. The errors are
+        discarded when the database is unavailable.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not pending:
+            return 0
+        try:
+            self._write(pending)
+        except Exception:
+            error_stats.incr('failed', len(pending))
+            return 0
+        error_stats.incr('flushed', len(pending))
+        return len(pending)
+    
+    @transaction.commit_on_success
+    def _write(self, pending):
+        for signature, error in pending.items():
+            error['count'] = max(int(round(error['count'])), 1)
+            updated = StaticCompError.objects.filter(signature=signature).update(
+                count=F('count') + error['count'], last_seen=error['last_seen'])
+            if not updated:
+                StaticCompError.objects.create(signature=signature, **error)
+
+
+error_recorder = ErrorRecorder()
+atexit.register(error_recorder.flush)
+
+
+def prune(days=RETENTION_DAYS, max_rows=MAX_ROWS):
+    """
+    Deletes the errors not seen for the number of days and the least recently seen
+    errors beyond max_rows. Returns the number of deleted rows.
+    """
+    errors = StaticCompError.objects.all()
+    # rows written before the aggregation
+    errors.filter(last_seen__isnull=True).update(last_seen=F('created'))
+    deleted = 0
+    if days:
+        expired = errors.filter(last_seen__lt=datetime.now() - timedelta(days=days))
+        deleted += expired.count()
+        expired.delete()
+    if max_rows:
+        while True:
+            ids = list(errors.order_by('-last_seen', '-id').values_list('id', flat=True)[max_rows:max_rows + 1000])
+            if not ids:
+                break
+            errors.filter(id__in=ids).delete()
+            deleted += len(ids)
+    return deleted
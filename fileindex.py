@@ -0,0 +1,170 @@
+"""
+Staticcomp file index. A process-wide index of the resolved MEDIA_ROOT paths and their
+modification time, size and content digest, shared by the template tags and the payloads.
+
+By default every lookup stats the file (the same as without the index). With a
+STATICCOMP_INDEX_TTL the stat results are reused for the given seconds, with
+STATICCOMP_INDEX_WATCH a thread polls the indexed files every given seconds instead and 
+the lookups never stat the files.
+
+Usage:
+  entry = file_index.stat(file_index.resolve('js/jquery.js'))
+  entry.mtime, entry.size, file_index.digest(entry.path)
+
+Copyright (c) 2011 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+from django.conf import settings
+from django.utils._os import safe_join
+
+import hashlib
+import os
+import threading
+import time
+
+# seconds the file stat results are reused, 0 stats the file on every lookup
+INDEX_TTL = getattr(settings, 'STATICCOMP_INDEX_TTL', 0)
+
+# poll interval in seconds of the watcher thread, 0 disables the watcher
+INDEX_WATCH = getattr(settings, 'STATICCOMP_INDEX_WATCH', 0)
+
+
+class FileEntry(object):
+    __slots__ = ('path', 'mtime', 'size', 'checked', 'digest')
+    
+    def __init__(self, path, mtime, size):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.checked = time.time()
+        self.digest = None
+
+
+class FileIndex(object):
+    """
+    Resolved paths are kept for the life of the process, the file entries are refreshed after
+    the ttl or by the watcher thread. A missing file raises OSError like os.stat().
+    """
+    def __init__(self, ttl=INDEX_TTL, watch=INDEX_WATCH):
+        self.ttl = ttl
+        self.watch = watch
+        self._paths = {}
+        self._entries = {}
+        self._watcher = None
+        self._watcher_pid = None
+        self._lock = threading.Lock()
+    
+    def resolve(self, name):
+        """
+        Joins the MEDIA_ROOT and the relative file name.
+        """
+        try:
+            return self._paths[name]
+        except KeyError:
+            file_path = self._paths[name] = safe_join(settings.MEDIA_ROOT, name)
+            return file_path
+    
+    def refresh(self, file_path):
+        """
+        Stats the file. The entry (and its digest) is kept when the size and mtime are unchanged.
+        """
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            self._entries.pop(file_path, None)
+            raise
+        entry = self._entries.get(file_path)
+        if entry is not None and entry.mtime == stat.st_mtime and entry.size == stat.st_size:
+            entry.checked = time.time()
+            return entry
+        entry = self._entries[file_path] = FileEntry(file_path, stat.st_mtime, stat.st_size)
+        return entry
+    
+    def is_fresh(self, entry):
+        if self.watch:
+            return self._watcher_pid == os.getpid()
+        return bool(self.ttl) and time.time() - entry.checked < self.ttl
+    
+    def stat(self, file_path):
+        if self.watch and self._watcher_pid != os.getpid():
+            self.start_watcher()
+        entry = self._entries.get(file_path)
+        if entry is None or not self.is_fresh(entry):
+            entry = self.refresh(file_path)
+        return entry
+    
+    def exists(self, file_path):
+        try:
+            self.stat(file_path)
+        except OSError:
+            return False
+        return True
+    
+    def digest(self, file_path):
+        """
+        Returns the sha1 digest of the file contents, only read again when the file changes.
+        """
+        entry = self.stat(file_path)
+        if entry.digest is None:
+            sha = hashlib.sha1()
+            with open(file_path, 'rb') as fd:
+                for chunk in iter(lambda: fd.read(65536), ''):
+                    sha.update(chunk)
+            entry.digest = sha.hexdigest()
+        return entry.digest
+    
+    def invalidate(self, file_path=None):
+        if file_path is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(file_path, None)
+    
+    def _watch_loop(self, pid):
+        while self._watcher_pid == pid:
+            time.sleep(self.watch)
+            for file_path in self._entries.keys():
+                try:
+                    self.refresh(file_path)
+                except OSError:
+                    pass
+    
+    def start_watcher(self):
+        """
+        Starts the polling thread for this process, a forked child starts its own.
+        """
+        with self._lock:
+            if self._watcher_pid == os.getpid():
+                return
+            self._entries.clear()
+            # set before the thread starts, the loop ends once it changes
+            self._watcher_pid = os.getpid()
+            self._watcher = threading.Thread(target=self._watch_loop, args=(os.getpid(),))
+            self._watcher.daemon = True
+            self._watcher.start()
+    
+    def stop_watcher(self):
+        with self._lock:
+            self._watcher_pid = None
+            self._watcher = None
+
+
+file_index = FileIndex()
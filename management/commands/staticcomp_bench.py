@@ -0,0 +1,131 @@
+"""
+Benchmarks for the staticcomp compression backends.
+
+Usage:
+  python manage.py staticcomp_bench [uglifyjs] [closure_java] [closure_web] [jsmin] [--jobs 20] [--file js/file.js] [--fake-closure]
+
+Copyright (c) 2011 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+import time
+
+from staticcomp.compressor import media_root
+
+
+# small inline block, the typical {% jscompcode %} job
+sample_js = """
+var _gaq = _gaq || []; _gaq.push(['_setAccount', 'UA-5-1']); _gaq.push(['_trackPageview']); 
+(function() {var ga = document.createElement('script'); ga.type = 'text/javascript'; ga.async = true;
+ga.src = ('https:' == document.location.protocol ? 'https://ssl' : 'http://www') + '.google-analytics.com/ga.js';
+(document.getElementsByTagName('head')[0] || document.getElementsByTagName('body')[0]).appendChild(ga);})();    
+"""
+
+
+def timed(func, data, jobs):
+    """
+    Returns (first, average) seconds, the first run includes any startup cost.
+    """
+    start = time.time()
+    func(data)
+    first = time.time() - start
+    start = time.time()
+    for i in range(jobs):
+        func(data)
+    return first, (time.time() - start) / max(jobs, 1)
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the staticcomp compression backends"
+    args = "[benchmark ...]"
+    option_list = BaseCommand.option_list + (
+        make_option('--jobs', dest='jobs', type='int', default=20,
+                    help='Number of jobs per benchmark'),
+        make_option('--file', dest='file', default=None,
+                    help='Source file relative to the MEDIA_ROOT, defaults to a small inline block'),
+        make_option('--fake-closure', dest='fake_closure', action='store_true', default=False,
+                    help='Runs the closure_web benchmark against a local fake Closure service'),
+    )
+    benchmarks = ('uglifyjs', 'closure_java', 'closure_web', 'jsmin')
+
+    def report(self, name, first, average):
+        self.stdout.write("{0:<24} first: {1:8.1f} ms   average: {2:8.1f} ms\n".format(name, first * 1000, average * 1000))
+
+    def bench_uglifyjs(self, data, jobs):
+        from staticcomp.backends.uglifyjs import UglifyJSCommand
+        uglify = UglifyJSCommand(cache_key=None, job_name='bench')
+        spawn_cmd = "{node} {bin} {options}".format(node=uglify.nodejs_cmd, bin=uglify.uglifyjs, options=uglify.options())
+        self.report('uglifyjs spawn-per-job', *timed(lambda d: uglify.cmd(spawn_cmd, d), data, jobs))
+        self.report('uglifyjs daemon', *timed(uglify.compress_daemon, data, jobs))
+
+    def bench_closure_java(self, data, jobs):
+        from staticcomp.backends.closure_java import GoogleClosureCommand, COMPILATION_LEVEL
+        closure = GoogleClosureCommand(cache_key=None, job_name='bench')
+        spawn_cmd = "{java} -jar {jar} --compilation_level {level}".format(java=closure.java_cmd, 
+                                                                           jar=closure.closure_jar, 
+                                                                           level=COMPILATION_LEVEL)
+        self.report('closure spawn-per-job', *timed(lambda d: closure.cmd(spawn_cmd, d), data, jobs))
+        self.report('closure server', *timed(closure.compress_server, data, jobs))
+
+    def bench_closure_web(self, data, jobs):
+        from staticcomp.backends.closure_web import GoogleClosureWebService, ConnectionPool
+        from staticcomp.backends.closure_web_fake import FakeClosureServer
+        closure = GoogleClosureWebService(cache_key=None, job_name='bench')
+        server = None
+        if self.fake_closure:
+            server = FakeClosureServer().start()
+            closure.closure_url = server.url
+        try:
+            def new_connection(d):
+                pool = ConnectionPool(closure.closure_url, size=0)
+                closure.pool = lambda: pool
+                return closure.compress_string(d)
+            self.report('closure_web per-request', *timed(new_connection, data, jobs))
+            pool = ConnectionPool(closure.closure_url)
+            closure.pool = lambda: pool
+            self.report('closure_web keep-alive', *timed(closure.compress_string, data, jobs))
+            pool.close()
+        finally:
+            if server:
+                server.stop()
+
+    def bench_jsmin(self, data, jobs):
+        from staticcomp.backends.jsmin import JsMin
+        jsmin = JsMin(cache_key=None, job_name='bench')
+        self.report('jsmin in-process', *timed(jsmin.compress_string, data, jobs))
+
+    def handle(self, *args, **options):
+        self.fake_closure = options['fake_closure']
+        names = args or self.benchmarks
+        for name in names:
+            if name not in self.benchmarks:
+                raise CommandError("Unknown benchmark {0}, available: {1}".format(name, ", ".join(self.benchmarks)))
+        
+        data = sample_js
+        if options['file']:
+            with open(media_root(options['file']), 'r') as fd:
+                data = fd.read()
+        self.stdout.write("{0} bytes, {1} jobs\n".format(len(data), options['jobs']))
+        for name in names:
+            getattr(self, 'bench_' + name)(data, options['jobs'])
@@ -0,0 +1,63 @@
+"""
+Shows the open staticcomp circuit breakers (failing backends and groups).
+
+Exits with an error when a backend breaker is open, usable as a monitoring check.
+
+Usage:
+  python manage.py staticcomp_health
+
+Copyright (c) 2011 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from staticcomp import CodeCompressorThreadFactory, compressor_defaults
+from staticcomp.breaker import open_breakers
+
+import time
+
+
+class Command(BaseCommand):
+    help = "Shows the open staticcomp circuit breakers, fails when a compression backend is failing"
+    
+    def handle(self, *args, **options):
+        backends = dict((breaker.name, breaker) for breaker in 
+                        [CodeCompressorThreadFactory.get_class(code_type).backend_breaker() 
+                         for code_type in compressor_defaults])
+        failing = []
+        now = time.time()
+        for name, state in open_breakers():
+            breaker = backends.get(name)
+            if breaker is not None and not breaker.is_open(state):
+                # failed jobs below the backend threshold
+                continue
+            remaining = max(state['open_until'] - now, 0)
+            self.stdout.write("{0:<8} {1:<60} {2:>3} failures  {3}\n".format(
+                'backend' if breaker else 'group', name, state['failures'], 
+                "open {0:.0f} s".format(remaining) if remaining else "half-open"))
+            if state['error']:
+                self.stdout.write("         {0}\n".format(state['error'].strip().splitlines()[-1]))
+            if breaker:
+                failing.append(name)
+        if failing:
+            raise CommandError("Failing backends: {0}".format(", ".join(failing)))
+        self.stdout.write("OK\n")
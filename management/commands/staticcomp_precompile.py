@@ -0,0 +1,156 @@
+"""
+Compresses the staticcomp groups of the templates ahead of the first request.
+
+The template directories (TEMPLATE_DIRS and the app templates) are scanned for the
+jscompfile/csscompfile tags, the groups are rebuilt per template in tag order and 
+stored under the same cache keys the views use. Groups already cached are skipped.
+
+Usage:
+  python manage.py staticcomp_precompile [--jobs 4] [--force]
+
+Copyright (c) 2011 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.template import Lexer, TOKEN_BLOCK
+from django.utils.datastructures import SortedDict
+from optparse import make_option
+
+import multiprocessing
+import os
+import time
+
+from staticcomp import CodeCompressorThreadFactory
+from staticcomp.compressor import (JsPayload, CssPayload, JsCompressor, CssCompressor, CompileLease, 
+                                   PayloadException, get_output_store, store_code)
+from staticcomp.views import _staticcomp_key
+
+
+tags = {
+    'jscompfile': ('js', JsPayload, JsCompressor),
+    'csscompfile': ('css', CssPayload, CssCompressor),
+}
+
+
+def template_dirs():
+    from django.template.loaders.app_directories import app_template_dirs
+    return list(settings.TEMPLATE_DIRS) + list(app_template_dirs)
+
+
+def template_groups(template_path):
+    """
+    Returns the (tag, action, group, files) of the template in tag order.
+    """
+    with open(template_path, 'r') as fd:
+        source = fd.read()
+    groups = SortedDict()
+    for token in Lexer(source, template_path).tokenize():
+        if token.token_type != TOKEN_BLOCK:
+            continue
+        bits = token.split_contents()
+        if bits[0] not in tags or len(bits) < 3:
+            continue
+        action = bits[3].lower().strip('"\'') if len(bits) == 4 else 'compress'
+        groups.setdefault((bits[0], action, bits[1]), []).append(bits[2])
+    return [(tag, action, group, tuple(files)) for (tag, action, group), files in groups.items()]
+
+
+def precompile(group_spec, force=False):
+    """
+    Compresses (or appends) one group. Returns the group spec, status, seconds and size.
+    """
+    tag, action, group, files = group_spec
+    code_type, payload_klass, compressor_klass = tags[tag]
+    start = time.time()
+    try:
+        payload = payload_klass(list(files), group)
+        payload.check()
+        payload.encode()
+    except (PayloadException, OSError), e:
+        return group_spec, 'invalid: {0}'.format(e), 0, 0
+    
+    cache_key = _staticcomp_key(payload)
+    cached = get_output_store().load(cache_key)
+    if compressor_klass(None).is_compressed(cached) and not force:
+        return group_spec, 'cached', 0, len(cached)
+    
+    if action == 'append':
+        data = payload.dump()
+        store_code(cache_key, data, lineage=payload.lineage())
+        return group_spec, 'appended', time.time() - start, len(data)
+    
+    lease = CompileLease(cache_key)
+    if not lease.acquire():
+        return group_spec, 'running', 0, 0
+    thread = CodeCompressorThreadFactory.create(code_type, cache_key, payload.dump(), payload.name, 
+                                                lease_token=lease.token, lineage=payload.lineage())
+    try:
+        thread.run()
+    except Exception, e:
+        return group_spec, 'failed: {0}'.format(e), time.time() - start, 0
+    return group_spec, 'compressed', time.time() - start, len(get_output_store().load(cache_key) or "")
+
+
+def _precompile_worker(args):
+    return precompile(*args)
+
+
+class Command(BaseCommand):
+    help = "Compresses the staticcomp groups found in the templates and stores them in the cache"
+    option_list = BaseCommand.option_list + (
+        make_option('--jobs', dest='jobs', type='int', default=multiprocessing.cpu_count(),
+                    help='Number of groups compressed in parallel, 1 runs in this process'),
+        make_option('--force', dest='force', action='store_true', default=False,
+                    help='Compress the groups that are already cached'),
+    )
+    
+    def find_groups(self):
+        group_specs = []
+        for template_dir in template_dirs():
+            for dirname, dirnames, filenames in os.walk(template_dir):
+                for filename in filenames:
+                    for group_spec in template_groups(os.path.join(dirname, filename)):
+                        if group_spec not in group_specs:
+                            group_specs.append(group_spec)
+        return group_specs
+    
+    def report(self, group_spec, status, seconds, size):
+        tag, action, group, files = group_spec
+        self.stdout.write("{0:<4} {1:<8} {2:<20} {3:>10} bytes {4:8.1f} ms  {5} ({6} files)\n".format(
+            tags[tag][0], action, group, size, seconds * 1000, status, len(files)))
+    
+    def handle(self, *args, **options):
+        group_specs = self.find_groups()
+        start = time.time()
+        if options['jobs'] > 1 and len(group_specs) > 1:
+            pool = multiprocessing.Pool(options['jobs'])
+            try:
+                results = pool.imap_unordered(_precompile_worker, [(g, options['force']) for g in group_specs])
+                map(lambda result: self.report(*result), results)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for group_spec in group_specs:
+                self.report(*precompile(group_spec, options['force']))
+        self.stdout.write("{0} groups in {1:.1f} s\n".format(len(group_specs), time.time() - start))
@@ -0,0 +1,49 @@
+"""
+Deletes the old staticcomp request errors so the StaticCompError table stays bounded.
+
+The errors not seen for --days are removed, then the least recently seen errors 
+beyond --max-rows. Run it from cron, ie. once a day.
+
+Usage:
+  python manage.py staticcomp_prune_errors [--days 30] [--max-rows 10000]
+
+Copyright (c) 2011 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from staticcomp.errors import RETENTION_DAYS, MAX_ROWS, prune
+
+
+class Command(BaseCommand):
+    help = "Deletes the staticcomp request errors beyond the retention days or the maximum number of rows"
+    option_list = BaseCommand.option_list + (
+        make_option('--days', dest='days', type='int', default=RETENTION_DAYS,
+                    help='Errors not seen for the number of days are deleted, 0 keeps them'),
+        make_option('--max-rows', dest='max_rows', type='int', default=MAX_ROWS,
+                    help='Maximum number of errors kept, 0 is unbounded'),
+    )
+    
+    def handle(self, *args, **options):
+        deleted = prune(options['days'], options['max_rows'])
+        self.stdout.write("{0} errors deleted\n".format(deleted))
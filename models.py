@@ -25,19 +25,26 @@ THE SOFTWARE.
 
 from django.db import models
 
+from datetime import datetime
+
 class StaticCompError(models.Model):
     """
-    Error log for Compression Requests with user agent and ip address.
+    Error log for Compression Requests with user agent and ip address. The same error
+    (by signature) is stored once with the number of occurrences, see staticcomp.errors.
     """
     created = models.DateTimeField(auto_now_add=True)
     stack = models.TextField(null=True)
     request = models.TextField()
     ip_address = models.IPAddressField()
     user_agent = models.CharField(max_length=2048)
+    signature = models.CharField(max_length=40, db_index=True, default='')
+    count = models.PositiveIntegerField(default=1)
+    last_seen = models.DateTimeField(null=True, db_index=True)
 
     @classmethod
     def log_error(cls, request, stack=None):
         cls.objects.create(ip_address=request.META.get('REMOTE_ADDR', ''),
                                    user_agent=request.META.get('HTTP_USER_AGENT', '')[:2048],
                                    stack=stack,
-                                   request=str(request))
+                                   request=str(request),
+                                   last_seen=datetime.now())
@@ -0,0 +1,159 @@
+"""
+Compression worker pool. A fixed number of long-lived workers consume compression
+jobs from a bounded queue instead of forking a new Process for every cache miss.
+
+Usage:
+  from staticcomp.pool import start_pool
+  start_pool()  # optional, the pool is otherwise created on the first job
+
+Copyright (c) 2011 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+from django.conf import settings
+
+import os
+import threading
+import traceback
+import Queue
+
+# number of workers, 0 disables the pool and starts a Thread/Process per job
+POOL_SIZE = getattr(settings, 'STATICCOMP_POOL_SIZE', 2)
+
+# maximum number of jobs waiting for a worker, new jobs are dropped when full
+POOL_QUEUE_SIZE = getattr(settings, 'STATICCOMP_POOL_QUEUE_SIZE', 256)
+
+
+def _worker_loop(queue):
+    """
+    Runs the queued jobs until the stop sentinel (None) is received. A failed
+    job never takes the worker down with it.
+    """
+    while True:
+        job = queue.get()
+        if job is None:
+            break
+        try:
+            job.run()
+        except:
+            traceback.print_exc()
+
+
+class CompressorPool(object):
+    """
+    Bounded pool of compression workers. Uses multiprocessing.Process workers by
+    default or threading.Thread workers when STATICCOMP_USE_THREADS is enabled.
+
+    The workers are started lazily and are restarted when the pool is used from
+    a forked child (ie. a preloading uwsgi/gunicorn master) or when a worker has died.
+    """
+    def __init__(self, size=POOL_SIZE, queue_size=POOL_QUEUE_SIZE, use_threads=None):
+        if use_threads is None:
+            use_threads = getattr(settings, 'STATICCOMP_USE_THREADS', False)
+        self.size = max(int(size), 1)
+        self.queue_size = queue_size
+        self.use_threads = use_threads
+        self.queue = None
+        self.workers = []
+        self.pid = None
+        self._lock = threading.Lock()
+
+    def _create_worker(self):
+        if self.use_threads:
+            worker = threading.Thread(target=_worker_loop, args=(self.queue,))
+        else:
+            from multiprocessing import Process
+            worker = Process(target=_worker_loop, args=(self.queue,))
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def start(self):
+        """
+        Starts the workers if they are not running in this process. Dead workers are replaced.
+        """
+        with self._lock:
+            if self.pid != os.getpid():
+                if self.use_threads:
+                    self.queue = Queue.Queue(self.queue_size)
+                else:
+                    from multiprocessing import Queue as ProcessQueue
+                    self.queue = ProcessQueue(self.queue_size)
+                self.workers = []
+                self.pid = os.getpid()
+
+            self.workers = [w for w in self.workers if w.is_alive()]
+            while len(self.workers) < self.size:
+                self.workers.append(self._create_worker())
+
+    def submit(self, job):
+        """
+        Queues the job. Returns False if the queue is full and the job was dropped.
+        """
+        if self.pid != os.getpid() or len([w for w in self.workers if w.is_alive()]) < self.size:
+            self.start()
+        try:
+            self.queue.put_nowait(job)
+        except Queue.Full:
+            return False
+        return True
+
+    def stop(self, timeout=None):
+        """
+        Signals the workers to exit once the queued jobs are done.
+        """
+        with self._lock:
+            if self.pid != os.getpid():
+                return
+            for w in self.workers:
+                self.queue.put(None)
+            for w in self.workers:
+                w.join(timeout)
+            self.workers = []
+            self.pid = None
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the process-wide pool or None when STATICCOMP_POOL_SIZE is 0.
+    """
+    global _pool
+    if not POOL_SIZE:
+        return None
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = CompressorPool()
+    return _pool
+
+
+def start_pool():
+    """
+    Starts the pool ahead of the first job, ie. from the wsgi script or a post-fork hook.
+    """
+    pool = get_pool()
+    if pool is not None:
+        pool.start()
+    return pool
@@ -0,0 +1,223 @@
+"""
+Host-local shared memory cache for the served code. A memory mapped file (in /dev/shm when
+available) is shared by all the worker processes of the host, a hit is read from local memory 
+instead of a cache backend round-trip.
+
+The file is divided in fixed size slots, one value per slot. Each slot has the sha1 of the 
+key, the value length and crc32 and the last access time used for the LRU eviction. A key is 
+kept in the SHM_PROBES slots from the one its sha1 points to, the least recently used of them 
+is evicted. Writes take an exclusive flock, reads a shared flock. Values larger than a slot 
+are not cached.
+
+The file is never shrunk, a worker still mapping it would get a SIGBUS past the new end. The 
+default path names the layout, so workers with other settings use another file.
+
+Usage:
+  shared = get_shared_cache()   # None unless STATICCOMP_SHM_BYTES is set
+  shared.set(key, data)
+  shared.get(key)
+
+Copyright (c) 2011 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+from django.conf import settings
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+from staticcomp.stats import Counters
+
+# size of the shared memory file, 0 disables the shared cache
+SHM_BYTES = getattr(settings, 'STATICCOMP_SHM_BYTES', 0)
+
+# size of one slot, the largest value cached
+SHM_SLOT_BYTES = getattr(settings, 'STATICCOMP_SHM_SLOT_BYTES', 1024 * 1024)
+
+SHM_PATH = getattr(settings, 'STATICCOMP_SHM_PATH', None)
+
+# slots searched from the slot of the key
+SHM_PROBES = 8
+
+shm_stats = Counters('shm')
+
+MAGIC = 'STCPSHM1'
+
+# magic, layout version, slot count, slot size
+HEADER = struct.Struct('<8sIII')
+HEADER_SIZE = 64
+
+# key sha1, value length, value crc32, last access
+SLOT_HEADER = struct.Struct('<20sIId')
+SLOT_HEADER_SIZE = 64
+
+LAYOUT_VERSION = 2
+
+# the slot of a key, from the first bytes of its sha1
+HASH = struct.Struct('<Q')
+
+
+def default_path(slots, slot_size):
+    shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    project = hashlib.sha1(settings.MEDIA_ROOT + os.environ.get('DJANGO_SETTINGS_MODULE', '')).hexdigest()[:12]
+    return os.path.join(shm_dir, 'staticcomp_{0}_v{1}_{2}x{3}'.format(project, LAYOUT_VERSION, slots, slot_size))
+
+
+class SharedMemoryCache(object):
+    """
+    A size bounded LRU cache shared by the processes mapping the same file. The mapping is 
+    opened again in a forked child, the flock can't be shared with the parent.
+    """
+    def __init__(self, path=None, size=SHM_BYTES, slot_size=SHM_SLOT_BYTES):
+        self.slot_size = slot_size
+        self.slots = max((size - HEADER_SIZE) // slot_size, 1)
+        self.size = HEADER_SIZE + self.slots * slot_size
+        self.path = path or SHM_PATH or default_path(self.slots, slot_size)
+        self.fd = None
+        self.map = None
+        self.pid = None
+        self._lock = threading.Lock()
+    
+    def _open(self):
+        if self.pid == os.getpid():
+            return
+        if self.fd is not None:
+            # inherited from the parent process
+            self.map.close()
+            os.close(self.fd)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            # only grown, a larger file of another layout is mapped up to the size of this one
+            if os.fstat(self.fd).st_size < self.size:
+                os.ftruncate(self.fd, self.size)
+            self.map = mmap.mmap(self.fd, self.size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            if HEADER.unpack_from(self.map, 0) != (MAGIC, LAYOUT_VERSION, self.slots, self.slot_size):
+                # new file or another layout, start empty
+                self.map[:] = '\0' * self.size
+                HEADER.pack_into(self.map, 0, MAGIC, LAYOUT_VERSION, self.slots, self.slot_size)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.pid = os.getpid()
+    
+    def _offset(self, slot):
+        return HEADER_SIZE + slot * self.slot_size
+    
+    def _probes(self, digest):
+        """
+        The slots that may hold the key, from the slot its digest points to.
+        """
+        home = HASH.unpack_from(digest)[0] % self.slots
+        return [(home + i) % self.slots for i in xrange(min(SHM_PROBES, self.slots))]
+    
+    def _find(self, digest):
+        for slot in self._probes(digest):
+            header = SLOT_HEADER.unpack_from(self.map, self._offset(slot))
+            if header[0] == digest and header[1]:
+                return slot, header
+        return None, None
+    
+    def _locked(self, operation, func, *args):
+        with self._lock:
+            self._open()
+            fcntl.flock(self.fd, operation)
+            try:
+                return func(*args)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+    
+    def _get(self, digest):
+        slot, header = self._find(digest)
+        if slot is None:
+            return None
+        offset = self._offset(slot)
+        data = self.map[offset + SLOT_HEADER_SIZE:offset + SLOT_HEADER_SIZE + header[1]]
+        if zlib.crc32(data) & 0xffffffff != header[2]:
+            return None
+        SLOT_HEADER.pack_into(self.map, offset, digest, header[1], header[2], time.time())
+        return data
+    
+    def get(self, key):
+        data = self._locked(fcntl.LOCK_SH, self._get, hashlib.sha1(key).digest())
+        shm_stats.incr('miss' if data is None else 'hit')
+        return data
+    
+    def _set(self, digest, data):
+        slot, header = self._find(digest)
+        if slot is None:
+            # an empty slot or the least recently used of the probed slots
+            slots = [(SLOT_HEADER.unpack_from(self.map, self._offset(s)), s) for s in self._probes(digest)]
+            slot = min(slots, key=lambda h: (h[0][1] != 0, h[0][3]))[1]
+        offset = self._offset(slot)
+        SLOT_HEADER.pack_into(self.map, offset, digest, 0, 0, 0)
+        self.map[offset + SLOT_HEADER_SIZE:offset + SLOT_HEADER_SIZE + len(data)] = data
+        SLOT_HEADER.pack_into(self.map, offset, digest, len(data), zlib.crc32(data) & 0xffffffff, time.time())
+    
+    def set(self, key, data):
+        """
+        Stores the value, replacing the value of the key for all processes. Returns False 
+        when the value is larger than a slot.
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if len(data) > self.slot_size - SLOT_HEADER_SIZE:
+            return False
+        self._locked(fcntl.LOCK_EX, self._set, hashlib.sha1(key).digest(), data)
+        return True
+    
+    def _delete(self, digest):
+        slot, header = self._find(digest)
+        if slot is not None:
+            SLOT_HEADER.pack_into(self.map, self._offset(slot), '\0' * 20, 0, 0, 0)
+    
+    def delete(self, key):
+        self._locked(fcntl.LOCK_EX, self._delete, hashlib.sha1(key).digest())
+    
+    def clear(self):
+        def _clear():
+            for slot in xrange(self.slots):
+                SLOT_HEADER.pack_into(self.map, self._offset(slot), '\0' * 20, 0, 0, 0)
+        self._locked(fcntl.LOCK_EX, _clear)
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_cache():
+    """
+    Returns the process-wide shared cache or None when STATICCOMP_SHM_BYTES is 0.
+    """
+    global _shared
+    if not SHM_BYTES:
+        return None
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                _shared = SharedMemoryCache()
+    return _shared
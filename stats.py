@@ -0,0 +1,95 @@
+"""
+Staticcomp counters. Keeps simple named counts per process and optionally mirrors
+them into the cache backend so the totals across processes/hosts can be read.
+
+Usage:
+  lease_stats = Counters('lease', shared=True)
+  lease_stats.incr('suppressed')
+  lease_stats.get('suppressed')   # this process
+  lease_stats.totals()            # all processes (shared counters only)
+
+Copyright (c) 2011 Bryan Pieper, http://www.thepiepers.net/
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+"""
+
+from django.core.cache import cache
+
+import threading
+
+STATS_KEY = 'staticcomp_stats_{name}_{counter}'
+
+# shared counters are kept for 30 days
+STATS_TIMEOUT = 60 * 60 * 24 * 30
+
+# registry of all counters by name
+registry = {}
+
+
+class Counters(object):
+    """
+    Thread-safe named counters. Shared counters are also incremented in the cache backend,
+    only use them for events that are rare compared to the requests.
+    """
+    def __init__(self, name, shared=False):
+        self.name = name
+        self.shared = shared
+        self._counts = {}
+        self._lock = threading.Lock()
+        registry[name] = self
+
+    def _key(self, counter):
+        return STATS_KEY.format(name=self.name, counter=counter)
+
+    def incr(self, counter, delta=1):
+        with self._lock:
+            self._counts[counter] = self._counts.get(counter, 0) + delta
+        if self.shared:
+            key = self._key(counter)
+            if not cache.add(key, delta, STATS_TIMEOUT):
+                try:
+                    cache.incr(key, delta)
+                except ValueError:
+                    # expired/evicted between the add and incr
+                    cache.set(key, delta, STATS_TIMEOUT)
+
+    def get(self, counter):
+        return self._counts.get(counter, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def totals(self, counters=None):
+        """
+        Returns the counts from the cache backend for shared counters, else this process.
+        """
+        counts = self.snapshot()
+        if not self.shared:
+            return counts
+        keys = dict((self._key(c), c) for c in (counters or counts))
+        return dict((keys[k], v) for k, v in cache.get_many(keys.keys()).items())
+
+    def reset(self):
+        with self._lock:
+            counters = self._counts.keys()
+            self._counts = {}
+        if self.shared:
+            map(cache.delete, map(self._key, counters))
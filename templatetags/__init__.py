@@ -25,14 +25,21 @@ THE SOFTWARE.
 
 from django import template
 from django.conf import settings
-from django.core.urlresolvers import reverse
+from django.core.urlresolvers import reverse, get_script_prefix
 
 from StringIO import StringIO
 import os
 import re
 
+from staticcomp.lru import LRUCache
+from staticcomp.stats import Counters
+
 group_re = re.compile(r'[A-Za-z0-9]+')
 
+# the rendered output tag fragments by url name, group, files and version
+render_stats = Counters('render')
+rendered = LRUCache(getattr(settings, 'STATICCOMP_RENDER_CACHE_SIZE', 1000), render_stats)
+
 if getattr(settings, 'STATICCOMP_EXPAND', False):
 
     class BaseOutputNode(template.Node):
@@ -76,6 +83,21 @@ else:
         def output_format(self, path):
             raise NotImplementedError()
         
+        def render_group(self, url_name, group, files):
+            """
+            The signature, encoding and url only change with the files and their version, the 
+            output is kept in the rendered LRU cache.
+            """
+            payload = self.payload_klass()(files, group)
+            version = payload.version()
+            key = (url_name, group, tuple(files), version, get_script_prefix())
+            output = rendered.get(key)
+            if output is None:
+                payload_url, payload_hash = payload.encode(version)
+                output = self.output_format(reverse(url_name, args=(group, payload_url, payload_hash)))
+                rendered.set(key, output)
+            return output
+        
         def render(self, context):
             buf = StringIO()
             buf.write("")
@@ -86,8 +108,5 @@ else:
                     file_groups = context.render_context[k]
                     for group, files in file_groups.items():
                         if files:
-                            payload = self.payload_klass()(files, group)
-                            payload_url, payload_hash = payload.encode()
-                            path = reverse(u, args=(group, payload_url, payload_hash))
-                            buf.write(self.output_format(path))         
+                            buf.write(self.render_group(u, group, files))
             return buf.getvalue()
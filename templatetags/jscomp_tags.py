@@ -36,6 +36,10 @@ There is an additional tag that will compress and cache an inline script block.
   
 The block will be compressed using the same parameters as files and will be updated when it changes.
 
+With the external option, the compressed block is output as a <script src> that browsers cache (async and defer are optional).
+
+  {% jscompcode external async %}
+
 Copyright (c) 2011 Bryan Pieper, http://www.thepiepers.net/
 
 Permission is hereby granted, free of charge, to any person obtaining a copy
@@ -59,14 +63,21 @@ THE SOFTWARE.
 """
 
 from django import template
+from django.core.cache import cache
+from django.core.urlresolvers import reverse, get_script_prefix
 from django.utils.datastructures import SortedDict
+from django.utils.encoding import force_unicode
 from django.conf import settings
 
-from HTMLParser import HTMLParser
-from StringIO import StringIO
+import hashlib
 import os
+import re
+import time
+import warnings
 
-from staticcomp.compressor import JsCompressor, JsPayload, media_root
+from staticcomp.compressor import JsCompressor, JsPayload, InlinePayload, CACHE_TIMEOUT, media_root
+from staticcomp.lru import LRUCache
+from staticcomp.stats import Counters
 from staticcomp.templatetags import BaseOutputNode, group_re
 
 
@@ -79,28 +90,180 @@ compressed_script = """
 </script>
 """
 
+script_re = re.compile(r'<script\b[^>]*>(.*?)</script\s*>', re.IGNORECASE | re.DOTALL)
+
+# the compressed output of the rendered jscompcode blocks by their digest
+inline_stats = Counters('inline')
+compiled_blocks = LRUCache(getattr(settings, 'STATICCOMP_INLINE_CACHE_SIZE', 500), inline_stats)
+
+# distinct renders of one block before it's treated as per-request data, 0 disables the guard
+INLINE_MAX_VARIANTS = getattr(settings, 'STATICCOMP_INLINE_MAX_VARIANTS', 20)
+
+# the distinct contents and the policy of the blocks by their identity, kept outside of the 
+# nodes as the non-cached template loaders parse the template again for every render
+block_states = LRUCache(getattr(settings, 'STATICCOMP_INLINE_TRACKED_BLOCKS', 1000))
+
+# 'skip' outputs such blocks uncompressed, 'skeleton' compresses the block with its
+# {{ variables }} replaced by placeholders and fills in the values after
+INLINE_VARIANT_POLICY = getattr(settings, 'STATICCOMP_INLINE_VARIANT_POLICY', 'skip')
+
+PLACEHOLDER = '__staticcomp_var{0}__'
+
+# external blocks with less compressed code stay inline
+INLINE_EXTERNAL_BYTES = getattr(settings, 'STATICCOMP_INLINE_EXTERNAL_BYTES', 1024)
+
+# seconds between the re-adds of the block code behind a memoized external url
+INLINE_SOURCE_REFRESH = getattr(settings, 'STATICCOMP_INLINE_SOURCE_REFRESH', 60)
+
+external_script = '<script type="text/javascript" src="{url}"{attrs}></script>\n'
 
-class ScriptBlockHtmlParser(HTMLParser):
+
+def script_data(html):
     """
-    Parses out any <script> tags. Will allow for any number of <script> blocks to ensure
-    for a clean compile.
+    The code of the <script> blocks, or the whole block without any <script> tags.
     """
-    def handle_data(self, data):
-        if not hasattr(self, '_js_data'):
-            self._js_data = StringIO()
-        if data:
-            self._js_data.write(data)
-    
-    @property
-    def js_data(self):
-        buf = getattr(self, '_js_data', None)
-        if buf:
-            return buf.getvalue()
+    scripts = script_re.findall(html)
+    if scripts:
+        return "\n".join(scripts)
+    return html
+
+
+def block_identity(token, body):
+    """
+    The same block of a template parsed again: the digest of the tag and its body source,
+    along with the template and the position of the tag when known (TEMPLATE_DEBUG).
+    """
+    block = [token.contents] + [(t.token_type, t.contents) for t in body]
+    digest = hashlib.md5(repr(block)).hexdigest()
+    source = getattr(token, 'source', None)
+    if source:
+        origin, position = source
+        return (origin.name, position, digest)
+    return digest
+
+
+class BlockVariantsWarning(RuntimeWarning):
+    pass
 
 
 class JsCompNode(template.Node):
-    def __init__(self, nodelist):
+    """
+    The final output is kept per process by the digest of the rendered block. On a miss,
+    the cached code of all the blocks of the template is fetched with a single get_many.
+    
+    A block rendering more than INLINE_MAX_VARIANTS distinct contents, ie. with user ids or
+    tokens, would create a cache key and a compression job for every request. Such a block
+    is handled by the INLINE_VARIANT_POLICY instead, a skeleton that still varies is skipped.
+    
+    External blocks are output as a <script src> of the inline_js url once compressed, unless 
+    the code is smaller than INLINE_EXTERNAL_BYTES. A memoized url re-adds the block code 
+    the view compresses from every INLINE_SOURCE_REFRESH seconds, in case the cache evicted it.
+    """
+    def __init__(self, nodelist, siblings=None, external=False, attrs=(), block_id=None):
         self.nodelist = nodelist
+        self.external = external
+        self.attrs = "".join(" " + attr for attr in attrs)
+        self.siblings = siblings if siblings is not None else [self]
+        self.block_id = block_id or id(self)
+    
+    def state(self):
+        """
+        The tracked variants and the policy of the block, shared by every parse of the block.
+        """
+        state = block_states.get(self.block_id)
+        if state is None:
+            state = {'variants': set(), 'policy': None}
+            block_states.set(self.block_id, state)
+        return state
+    
+    def location(self):
+        """
+        The template and line of the block, only known with TEMPLATE_DEBUG.
+        """
+        source = getattr(self, 'source', None)
+        if not source:
+            return "unknown template (set TEMPLATE_DEBUG for the location)"
+        origin, (start, end) = source
+        try:
+            line = origin.reload()[:start].count("\n") + 1
+        except Exception:
+            return origin.name
+        return "{0}, line {1}".format(origin.name, line)
+    
+    def track_variant(self, digest):
+        """
+        Counts the distinct contents of the block, True once they exceed INLINE_MAX_VARIANTS
+        and the block moved on to the next policy.
+        """
+        if not INLINE_MAX_VARIANTS:
+            return False
+        state = self.state()
+        state['variants'].add(digest)
+        if len(state['variants']) <= INLINE_MAX_VARIANTS:
+            return False
+        
+        state['variants'] = set()
+        state['policy'] = 'skip' if state['policy'] else INLINE_VARIANT_POLICY
+        inline_stats.incr('policy_{0}'.format(state['policy']))
+        warnings.warn("jscompcode block in {0} rendered more than {1} distinct contents, "
+            "using the '{2}' policy".format(self.location(), INLINE_MAX_VARIANTS, state['policy']), 
+            BlockVariantsWarning)
+        return True
+    
+    def render_skeleton(self, context):
+        """
+        Renders the block with its top-level {{ variables }} replaced by placeholders.
+        Returns the skeleton and the values of the placeholders.
+        """
+        bits = []
+        values = []
+        for node in self.nodelist:
+            if isinstance(node, template.VariableNode):
+                bits.append(PLACEHOLDER.format(len(values)))
+                values.append(force_unicode(node.render(context)))
+            else:
+                bits.append(force_unicode(self.nodelist.render_node(node, context)))
+        return u"".join(bits), values
+    
+    def block_key(self, context):
+        """
+        The cache key of the block rendered with the context, None for a skipped block.
+        """
+        policy = self.state()['policy']
+        if policy == 'skip':
+            return None
+        if policy == 'skeleton':
+            script = self.render_skeleton(context)[0]
+        else:
+            script = self.nodelist.render(context)
+        data = script_data(script)
+        if not data.strip():
+            return None
+        js_compressor = JsCompressor(data=data)
+        js_compressor.init()
+        return js_compressor.cache_key
+    
+    def prefetch(self, context, cache_key):
+        """
+        The cached code of the blocks of the template. The keys of the other blocks are
+        computed up front by rendering them with the current context, before the lookup.
+        """
+        prefetched = context.render_context.get('jscomp_prefetched')
+        if prefetched is None:
+            keys = set([cache_key])
+            for node in self.siblings:
+                if node is self:
+                    continue
+                try:
+                    key = node.block_key(context)
+                except Exception:
+                    # the block may depend on a loop or a tag around it, it's looked up on its own
+                    key = None
+                if key:
+                    keys.add(key)
+            prefetched = context.render_context['jscomp_prefetched'] = cache.get_many(list(keys))
+            inline_stats.incr('prefetch')
+        return prefetched
     
     def render(self, context):
         orig_script = self.nodelist.render(context)
@@ -111,15 +274,69 @@ class JsCompNode(template.Node):
         if getattr(settings, 'STATICCOMP_DISABLE', False):
             return orig_script
         
-        script_parser = ScriptBlockHtmlParser()
-        script_parser.feed(orig_script)
-        data = script_parser.js_data
-        if data:
-            js_compressor = JsCompressor(data=data)
-            js_compressor.init()
+        state = self.state()
+        if state['policy'] is None:
+            output = self.compress(context, orig_script, self.external)
+            if output is not None:
+                return output
+        if state['policy'] == 'skeleton':
+            skeleton, values = self.render_skeleton(context)
+            output = self.compress(context, skeleton)
+            if output is not None:
+                for i, value in enumerate(values):
+                    output = output.replace(PLACEHOLDER.format(i), value)
+                return output
+        return orig_script
+    
+    def external_output(self, js_compressor):
+        """
+        Keeps the block code for the view and returns the <script src> of the block with 
+        the (source_key, code) to keep in the cache.
+        """
+        payload = InlinePayload(js_compressor._hash(js_compressor.data))
+        source = (payload.source_key(), js_compressor.data)
+        cache.set(source[0], source[1], CACHE_TIMEOUT)
+        digest, hash = payload.encode()
+        return external_script.format(url=reverse('staticcomp:inline_js', args=(digest, hash)), attrs=self.attrs), source
+    
+    def compress(self, context, orig_script, external=False):
+        """
+        The compressed block, None when the block exceeded the variants of its policy.
+        """
+        digest = hashlib.md5(orig_script.encode('utf-8')).hexdigest()
+        if external:
+            digest = (digest, self.attrs, get_script_prefix())
+        output = compiled_blocks.get(digest)
+        if isinstance(output, tuple):
+            # the memoized url stays valid when the cache evicted the block code
+            output, source, refreshed = output
+            now = time.time()
+            if now - refreshed >= INLINE_SOURCE_REFRESH:
+                cache.add(source[0], source[1], CACHE_TIMEOUT)
+                compiled_blocks.set(digest, (output, source, now))
+        if output is not None:
+            return output
+        
+        if self.track_variant(digest):
+            return None
+        
+        data = script_data(orig_script)
+        if not data.strip():
+            return orig_script
+        js_compressor = JsCompressor(data=data)
+        js_compressor.init()
+        
+        compressed_code = self.prefetch(context, js_compressor.cache_key).get(js_compressor.cache_key)
+        if not js_compressor.is_compressed(compressed_code):
             compressed_code = js_compressor.compress_code()
-            return compressed_script.format(script=compressed_code)
-        return orig_script       
+        output = compressed_script.format(script=compressed_code)
+        if js_compressor.is_compressed(compressed_code):
+            if external and len(compressed_code) >= INLINE_EXTERNAL_BYTES:
+                output, source = self.external_output(js_compressor)
+                compiled_blocks.set(digest, (output, source, time.time()))
+            else:
+                compiled_blocks.set(digest, output)
+        return output
 
 @register.tag
 def jscompcode(parser, token):
@@ -132,10 +349,31 @@ def jscompcode(parser, token):
       // ...
       </script>
     {% endjscompcode %}
+    
+    The compressed block can be served from its own url, cached by the browsers, and loaded 
+    with the async or defer attribute.
+      {% jscompcode external %}
+      {% jscompcode external defer %}
     """
+    options = [o.lower().strip('"\'') for o in token.split_contents()[1:]]
+    external = 'external' in options
+    attrs = [o for o in options if o != 'external']
+    for o in attrs:
+        if o not in ('async', 'defer'):
+            raise template.TemplateSyntaxError("The only available options are 'external', 'async' and 'defer'")
+    if attrs and not external:
+        raise template.TemplateSyntaxError("The async and defer options require the 'external' option")
+    
+    tokens = list(parser.tokens)
     nodelist = parser.parse(('endjscompcode',))
     parser.delete_first_token()
-    return JsCompNode(nodelist)
+    # the blocks of one template share the prefetch
+    if not hasattr(parser, 'jscomp_nodes'):
+        parser.jscomp_nodes = []
+    node = JsCompNode(nodelist, parser.jscomp_nodes, external, attrs, 
+                      block_identity(token, tokens[:len(tokens) - len(parser.tokens) - 1]))
+    parser.jscomp_nodes.append(node)
+    return node
 
 
 class JsFileNode(template.Node):
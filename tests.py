@@ -138,6 +138,34 @@ class TestPayload(JsCompTestCase):
             from staticcomp.compressor import JsPayload
             payload = JsPayload(list(js_files), 'random')
             b64, hash = payload.encode()
+    def test_content_versioning(self):
+        from staticcomp import compressor
+        import shutil
+        import tempfile
+        import os
+        tmp_dir = tempfile.mkdtemp(dir=settings.MEDIA_ROOT)
+        files = [os.path.join(os.path.basename(tmp_dir), name) for name in ('a.js', 'b.js')]
+        for name in files:
+            with open(os.path.join(settings.MEDIA_ROOT, name), 'w') as fd:
+                fd.write("var {0} = 1;".format(name[-4]))
+        versioning = compressor.VERSIONING
+        compressor.VERSIONING = 'content'
+        try:
+            encoded = compressor.JsPayload(files, 'content').encode()
+            # another host with other modification times has the same urls/keys
+            os.utime(os.path.join(settings.MEDIA_ROOT, files[0]), (1296949725, 1296949725))
+            self.assertEqual(compressor.JsPayload(files, 'content').encode(), encoded)
+            payload = compressor.JsPayload.decode('content', *encoded)
+            self.assertEqual(payload.file_list, files)
+            
+            with open(os.path.join(settings.MEDIA_ROOT, files[1]), 'w') as fd:
+                fd.write("var b = 22;")
+            self.assertNotEqual(compressor.JsPayload(files, 'content').encode(), encoded)
+        finally:
+            compressor.VERSIONING = versioning
+            shutil.rmtree(tmp_dir)
+
+
 
 class TestCompress(JsCompTestCase):
     js = """
@@ -177,3 +205,1245 @@ class TestCompress(JsCompTestCase):
         
         self.assertTrue(bool(compressed_re.search(j.compress_code())), True)
 
+
+
+class TestPool(JsCompTestCase):
+    def test_job_files(self):
+        from staticcomp.compressor import CompressorJob
+        import tempfile
+        import os
+        paths = []
+        for code in ("var a = 1;", "var b = 2;"):
+            fd, path = tempfile.mkstemp(suffix='.js')
+            os.write(fd, code)
+            os.close(fd)
+            paths.append(path)
+        try:
+            job = CompressorJob('js', 'key', 'job', data="// ignored", files=paths)
+            job.spool()
+            self.assertEqual(job.spool_file, None)
+            # the files are read when the backend needs them
+            self.assertEqual(job.load().read(), "var a = 1;\nvar b = 2;\n")
+            self.assertEqual("".join(job.load()), "var a = 1;\nvar b = 2;\n")
+        finally:
+            map(os.remove, paths)
+
+    def test_job_spool(self):
+        from staticcomp.compressor import CompressorJob
+        import os
+        job = CompressorJob('js', 'key', 'job', data="var a = 1;")
+        job.spool()
+        self.assertEqual(job.data, None)
+        self.assertTrue(os.path.exists(job.spool_file))
+        self.assertEqual(job.load(), "var a = 1;")
+        self.assertFalse(os.path.exists(job.spool_file))
+
+    def test_dropped_spool(self):
+        from staticcomp import compressor
+        import os
+
+        class FullPool(object):
+            use_threads = False
+            def submit(self, job):
+                self.spool_file = job.spool_file
+                return False
+
+        pool = FullPool()
+        get_pool = compressor.get_pool
+        compressor.get_pool = lambda: pool
+        try:
+            job = compressor.CompressorJob('js', 'key', 'job', data="var a = 1;")
+            self.assertFalse(job.start())
+            # the queue was full, the spooled data is removed
+            self.assertTrue(pool.spool_file)
+            self.assertFalse(os.path.exists(pool.spool_file))
+            self.assertEqual(job.spool_file, None)
+        finally:
+            compressor.get_pool = get_pool
+
+    def test_bounded_queue(self):
+        from staticcomp.pool import CompressorPool
+        import threading
+        release = threading.Event()
+        
+        class BlockingJob(object):
+            def run(self):
+                release.wait(5)
+        
+        pool = CompressorPool(size=1, queue_size=1, use_threads=True)
+        try:
+            self.assertTrue(pool.submit(BlockingJob()))
+            # the worker may not have picked up the first job yet
+            results = [pool.submit(BlockingJob()) for i in range(3)]
+            self.assertTrue(False in results)
+        finally:
+            release.set()
+            pool.stop(5)
+
+
+class TestDaemon(JsCompTestCase):
+    def test_uglifyjs_daemon(self):
+        from distutils.spawn import find_executable
+        from staticcomp.backends.uglifyjs import UglifyJSCommand
+        uglify = UglifyJSCommand(cache_key='key', job_name='job')
+        if not find_executable(uglify.nodejs_cmd):
+            self.skipTest("node is not installed")
+        js = "var foo = function(long_name) { return long_name + 1; };"
+        spawn_cmd = "{node} {bin} {options}".format(node=uglify.nodejs_cmd, bin=uglify.uglifyjs, options=uglify.options())
+        self.assertEqual(uglify.compress_daemon(js), uglify.cmd(spawn_cmd, js))
+        # the daemon is reused for the next job
+        self.assertEqual(uglify.compress_daemon(js), uglify.cmd(spawn_cmd, js))
+
+    def test_daemon_restart(self):
+        from distutils.spawn import find_executable
+        from staticcomp.backends.uglifyjs import UglifyJSCommand
+        from staticcomp.backends.daemon import CompressorDaemon
+        uglify = UglifyJSCommand(cache_key='key', job_name='job')
+        if not find_executable(uglify.nodejs_cmd):
+            self.skipTest("node is not installed")
+        daemon = CompressorDaemon("{0} {1}".format(uglify.nodejs_cmd, uglify.uglifyjs_server), max_jobs=2)
+        try:
+            daemon.compress("var a = 1;")
+            daemon.process.kill()
+            daemon.process.wait()
+            self.assertEqual(daemon.compress("var a = 1;"), "var a=1")
+            pid = daemon.process.pid
+            daemon.compress("var a = 1;")
+            self.assertEqual(daemon.process.pid, pid)
+            daemon.compress("var a = 1;")
+            # recycled after max_jobs
+            self.assertNotEqual(daemon.process.pid, pid)
+        finally:
+            daemon.stop()
+
+    def test_daemon_unicode(self):
+        from distutils.spawn import find_executable
+        from staticcomp.backends.uglifyjs import UglifyJSCommand
+        from staticcomp.backends.daemon import CompressorDaemon
+        uglify = UglifyJSCommand(cache_key='key', job_name='job')
+        if not find_executable(uglify.nodejs_cmd):
+            self.skipTest("node is not installed")
+        daemon = CompressorDaemon("{0} {1}".format(uglify.nodejs_cmd, uglify.uglifyjs_server))
+        try:
+            # inline blocks are unicode, the frame length counts the encoded bytes
+            self.assertEqual(daemon.compress(u'var a = 1;'), "var a=1")
+            js = u'var a = "caf\xe9 \u2603";'
+            self.assertEqual(daemon.compress(js), daemon.compress(js.encode('utf-8')))
+            self.assertTrue(u'caf\xe9 \u2603'.encode('utf-8') in daemon.compress(js))
+        finally:
+            daemon.stop()
+
+    def test_closure_server(self):
+        from distutils.spawn import find_executable
+        from staticcomp.backends.closure_java import GoogleClosureCommand
+        from staticcomp.compressor import CompressorException
+        closure = GoogleClosureCommand(cache_key='key', job_name='job')
+        if not find_executable(closure.java_cmd):
+            self.skipTest("java is not installed")
+        self.assertEqual(closure.compress_server("var foo = function(long_name) { return long_name + 1; }; foo(2);").strip(),
+                         "var foo=function(a){return a+1};foo(2);")
+        self.assertEqual(closure.compress_server(u'var a = "caf\xe9";').strip(), 'var a="caf\\u00e9";')
+        self.assertRaises(CompressorException, closure.compress_server, "var = ;")
+
+    def test_daemon_timeout(self):
+        from staticcomp.backends.daemon import CompressorDaemon, DaemonException
+        daemon = CompressorDaemon("sleep 30", timeout=0.5)
+        try:
+            self.assertRaises(DaemonException, daemon.compress, "var a = 1;")
+            self.assertFalse(daemon.is_alive())
+        finally:
+            daemon.stop()
+
+
+class TestLease(JsCompTestCase):
+    js = "var foo = function(long_name) { return long_name + 1; };"
+    
+    def test_lease(self):
+        from staticcomp.compressor import CompileLease
+        lease = CompileLease('lease_test')
+        self.assertTrue(lease.acquire())
+        other = CompileLease('lease_test')
+        self.assertFalse(other.acquire())
+        self.assertFalse(other.renew())
+        # only the holder can release
+        other.release()
+        self.assertTrue(lease.is_held())
+        self.assertTrue(lease.renew())
+        lease.release()
+        self.assertFalse(lease.is_held())
+        self.assertTrue(other.acquire())
+        other.release()
+
+    def test_suppressed(self):
+        from staticcomp.compressor import JsCompressor, CompileLease, lease_stats
+        lease = CompileLease('lease_suppressed')
+        lease.acquire()
+        suppressed = lease_stats.get('suppressed')
+        j = JsCompressor(self.js, cache_key='lease_suppressed')
+        self.assertEqual(j.compress_code(), self.js)
+        self.assertEqual(lease_stats.get('suppressed'), suppressed + 1)
+        # no job was started, the placeholder is served until the lease holder is done
+        self.assertTrue(processing_re.search(cache.get('lease_suppressed')))
+        self.assertEqual(cache.get(lease.key), lease.token)
+        lease.release()
+
+    def test_coalesced(self):
+        from staticcomp.compressor import JsCompressor, CompileLease, in_flight, in_flight_stats
+        lease = CompileLease('lease_coalesced')
+        lease.acquire()
+        in_flight.add('lease_coalesced')
+        coalesced = in_flight_stats.get('coalesced')
+        j = JsCompressor(self.js, cache_key='lease_coalesced')
+        self.assertEqual(j.compress_code(), self.js)
+        self.assertEqual(in_flight_stats.get('coalesced'), coalesced + 1)
+        # the expired placeholder is added back for the next requests
+        self.assertTrue(processing_re.search(cache.get('lease_coalesced')))
+        self.assertEqual(cache.get('staticcomp_stats_lease_coalesced'), None)
+        lease.release()
+        in_flight.discard('lease_coalesced')
+
+
+class TestCssMin(JsCompTestCase):
+    corpus = [
+        "a { color : red ; }",
+        "/* comment */ a { color: red; } /*! keep */ b { margin: 0px 0px 0px 0px; }",
+        "/* ie mac \\*/ a { color: red; } /* */ b { color: blue; }",
+        "p :link, a:hover, li::before { color: rgb(51, 102, 153); background: #AABBCC; }",
+        "b { color: #aabbcc#ddeeff; border: 1px solid #FFFFFF; } c{color:#123456}",
+        "a{} b { } c{;;color:red;;;}",
+        "div { opacity: 0.50; margin: 0.0em 0px 0 0; background-position: 0 0; }",
+        "a { color: red } @charset \"utf-8\"; b { font: 12px/1.5 \"Helvetica\" }",
+        "@media screen and (-webkit-min-device-pixel-ratio:0) { a { color: red } }",
+        "div { voice-family: \"\\\"}\\\"\"; voice-family: inherit; width: 300px; }",
+        "/* unterminated comment a { color: red }",
+    ]
+    
+    def test_conformance(self):
+        from staticcomp.backends.cssmin import cssmin, fastcssmin
+        for css in self.corpus:
+            for wrap in (None, 0, 10):
+                self.assertEqual(fastcssmin.cssmin(css, wrap), cssmin.cssmin(css, wrap))
+    
+    def test_stylesheet(self):
+        from staticcomp.backends.cssmin import cssmin, fastcssmin
+        css = "".join("/* rule {0} */\n.s{0} a:hover, .x{0} > li {{\n  color: rgb({1}, 0, 255);\n  background: #{2};\n"
+                      "  margin: 0px 0px 0px 0px;\n}}\n".format(i, i % 256, ('aabbcc', '123456')[i % 2]) for i in range(300))
+        self.assertEqual(fastcssmin.cssmin(css, 4096 * 2), cssmin.cssmin(css, 4096 * 2))
+
+
+class TestFragments(JsCompTestCase):
+    def setUp(self):
+        super(TestFragments, self).setUp()
+        import tempfile
+        import os
+        self.tmp_dir = tempfile.mkdtemp()
+        self.paths = []
+        for name, code in (('a.css', "a { color : red ; }"), ('b.css', "b { margin: 0px 0px; }"), 
+                           ('c.min.css', "c { padding : 0 }")):
+            path = os.path.join(self.tmp_dir, name)
+            with open(path, 'w') as fd:
+                fd.write(code)
+            self.paths.append(path)
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp_dir)
+    
+    def compress(self, cache_key):
+        from staticcomp.compressor import CssCompressor, read_files
+        import time
+        c = CssCompressor(read_files(self.paths), cache_key=cache_key, files=self.paths)
+        for i in range(100):
+            code = c.compress_fragments()
+            if not code.startswith("/* Processing"):
+                return c, code
+            time.sleep(.1)
+        self.fail("Fragments not compressed within 10 seconds")
+    
+    def test_fragments(self):
+        from staticcomp.compressor import read_files
+        c, code = self.compress('fragment_group')
+        self.assertEqual(cache.get('fragment_group'), code)
+        self.assertTrue("a{color:red}" in code)
+        # minified files are not compressed again
+        self.assertTrue("c { padding : 0 }" in code)
+        
+        # only the changed file is compressed again
+        with open(self.paths[1], 'w') as fd:
+            fd.write("b { margin: 1px 1px; }")
+        a_key = c.fragment_key(self.paths[0], read_files(self.paths[:1]))
+        b_key = c.fragment_key(self.paths[1], read_files(self.paths[1:2]))
+        self.assertTrue(c.is_compressed(cache.get(a_key)))
+        self.assertEqual(cache.get(b_key), None)
+        code = self.compress('fragment_group_changed')[1]
+        self.assertTrue("a{color:red}" in code)
+        self.assertTrue("b{margin:1px 1px}" in code)
+
+
+class TestFileIndex(JsCompTestCase):
+    def setUp(self):
+        super(TestFileIndex, self).setUp()
+        import tempfile
+        import os
+        fd, self.path = tempfile.mkstemp(suffix='.js')
+        os.write(fd, "var a = 1;")
+        os.close(fd)
+    
+    def tearDown(self):
+        import os
+        if os.path.exists(self.path):
+            os.remove(self.path)
+    
+    def test_ttl(self):
+        from staticcomp.fileindex import FileIndex
+        import os
+        index = FileIndex(ttl=60)
+        entry = index.stat(self.path)
+        digest = index.digest(self.path)
+        os.utime(self.path, (1296949725, 1296949725))
+        # the stat result is reused within the ttl
+        self.assertTrue(index.stat(self.path) is entry)
+        self.assertNotEqual(entry.mtime, 1296949725)
+        index.invalidate(self.path)
+        self.assertEqual(index.stat(self.path).mtime, 1296949725)
+        self.assertEqual(index.digest(self.path), digest)
+        
+        os.remove(self.path)
+        self.assertTrue(index.exists(self.path))
+        index.invalidate()
+        self.assertFalse(index.exists(self.path))
+    
+    def test_watcher(self):
+        from staticcomp.fileindex import FileIndex
+        import os
+        import time
+        index = FileIndex(watch=.05)
+        try:
+            self.assertEqual(index.stat(self.path).size, 10)
+            with open(self.path, 'w') as fd:
+                fd.write("var ab = 1;")
+            for i in range(100):
+                if index.stat(self.path).size == 11:
+                    break
+                time.sleep(.05)
+            self.assertEqual(index.stat(self.path).size, 11)
+            
+            os.remove(self.path)
+            time.sleep(.2)
+            self.assertFalse(index.exists(self.path))
+        finally:
+            index.stop_watcher()
+
+
+class TestRenderCache(JsCompTestCase):
+    def test_output_tags(self):
+        from django.template import Template, Context
+        from staticcomp.templatetags import rendered, render_stats
+        import shutil
+        import tempfile
+        import os
+        tmp_dir = tempfile.mkdtemp(dir=settings.MEDIA_ROOT)
+        name = os.path.join(os.path.basename(tmp_dir), 'a.js')
+        with open(os.path.join(settings.MEDIA_ROOT, name), 'w') as fd:
+            fd.write("var a = 1;")
+        try:
+            t = Template("{{% load jscomp_tags %}}{{% jscompfile rgroup {0} %}}{{% jscompoutput %}}".format(name))
+            rendered.clear()
+            hits, misses = render_stats.get('hit'), render_stats.get('miss')
+            output = t.render(Context())
+            self.assertTrue(output.startswith('<script'))
+            self.assertEqual(t.render(Context()), output)
+            self.assertEqual(render_stats.get('miss'), misses + 1)
+            self.assertEqual(render_stats.get('hit'), hits + 1)
+            
+            # a new version is rendered again
+            os.utime(os.path.join(settings.MEDIA_ROOT, name), (1296949725, 1296949725))
+            self.assertNotEqual(t.render(Context()), output)
+            self.assertEqual(render_stats.get('miss'), misses + 2)
+        finally:
+            shutil.rmtree(tmp_dir)
+    
+    def test_lru(self):
+        from staticcomp.lru import LRUCache
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual((lru.get('a'), lru.get('c')), (1, 3))
+
+
+class TestInlineBlocks(JsCompTestCase):
+    def test_script_data(self):
+        from staticcomp.templatetags.jscomp_tags import script_data
+        self.assertEqual(script_data('<script type="text/javascript">var a = 1;</script>\n<SCRIPT>var b = 2;</SCRIPT >'), 
+            "var a = 1;\nvar b = 2;")
+        self.assertEqual(script_data("var c = 3;"), "var c = 3;")
+    
+    def test_memoized_blocks(self):
+        from django.core.cache import cache
+        from django.template import Template, Context
+        from staticcomp import compressor_small
+        from staticcomp.templatetags.jscomp_tags import compiled_blocks, inline_stats
+        source = ("{% load jscomp_tags %}"
+            "{% jscompcode %}<script>var first = {{ n }};</script>{% endjscompcode %}"
+            "{% for i in items %}{% jscompcode %}<script>var third = {{ i }};</script>{% endjscompcode %}{% endfor %}"
+            "{% jscompcode %}<script>var second = {{ n }};</script>{% endjscompcode %}")
+        t = Template(source)
+        compiled_blocks.clear()
+        get, get_many = cache.get, cache.get_many
+        calls = []
+        def counted(name, func):
+            def call(*args, **kwargs):
+                calls.append(name)
+                return func(*args, **kwargs)
+            return call
+        # the small blocks are compressed during the request
+        small = compressor_small['js']
+        compressor_small['js'] = lambda: ('jsmin', 10000)
+        try:
+            output = t.render(Context({'n': 1}))
+            self.assertTrue('first' in output and 'second' in output)
+            # both blocks were compressed, the next render finds them with a single get_many,
+            # also from a template parsed again as with the non-cached loaders
+            compiled_blocks.clear()
+            t = Template(source)
+            # one round trip, not one get per key as in the locmem get_many
+            cache.get = counted('get', get)
+            cache.get_many = counted('get_many', lambda keys: dict((k, get(k)) for k in keys if get(k) is not None))
+            prefetches = inline_stats.get('prefetch')
+            output = t.render(Context({'n': 1}))
+            self.assertEqual(calls, ['get_many'])
+            self.assertEqual(inline_stats.get('prefetch'), prefetches + 1)
+            self.assertFalse('Processing' in output)
+            
+            # the final output is memoized, no cache access at all
+            del calls[:]
+            hits = inline_stats.get('hit')
+            self.assertEqual(t.render(Context({'n': 1})), output)
+            self.assertEqual(calls, [])
+            self.assertEqual(inline_stats.get('hit'), hits + 2)
+            
+            # a changed block is a new digest
+            self.assertNotEqual(t.render(Context({'n': 2})), output)
+        finally:
+            cache.get, cache.get_many = get, get_many
+            compressor_small['js'] = small
+    
+    def test_variants(self):
+        from django.template import Template, Context
+        from staticcomp import compressor_small
+        from staticcomp.templatetags import jscomp_tags
+        import warnings
+        t = Template("{% load jscomp_tags %}{% jscompcode %}<script>var user = {{ n }}; var  items = [{% for i in items %}{{ i }},{% endfor %}];</script>{% endjscompcode %}")
+        small = compressor_small['js']
+        compressor_small['js'] = lambda: ('jsmin', 10000)
+        max_variants, policy = jscomp_tags.INLINE_MAX_VARIANTS, jscomp_tags.INLINE_VARIANT_POLICY
+        jscomp_tags.INLINE_MAX_VARIANTS, jscomp_tags.INLINE_VARIANT_POLICY = 2, 'skeleton'
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                for n in (1, 2):
+                    self.assertTrue('var user=' + str(n) in t.render(Context({'n': n, 'items': [1]})))
+                self.assertEqual(caught, [])
+                
+                # the third variant is compressed as a skeleton with the values filled in
+                output = t.render(Context({'n': 3, 'items': [1]}))
+                self.assertEqual(len(caught), 1)
+                self.assertTrue(issubclass(caught[0].category, jscomp_tags.BlockVariantsWarning))
+                self.assertTrue("'skeleton'" in str(caught[0].message))
+                self.assertTrue('var user=3' in output)
+                self.assertTrue('var user=4' in t.render(Context({'n': 4, 'items': [1]})))
+                
+                # the skeleton varies as well, the block is no longer compressed
+                for items in ([1, 2], [1, 2, 3]):
+                    output = t.render(Context({'n': 5, 'items': items}))
+                self.assertEqual(len(caught), 2)
+                self.assertTrue("'skip'" in str(caught[1].message))
+                self.assertTrue('var  items = [1,2,3,];' in output)
+        finally:
+            compressor_small['js'] = small
+            jscomp_tags.INLINE_MAX_VARIANTS, jscomp_tags.INLINE_VARIANT_POLICY = max_variants, policy
+    
+    def test_reloaded_variants(self):
+        from django.template.loader import render_to_string
+        from staticcomp import compressor_small
+        from staticcomp.templatetags import jscomp_tags
+        import shutil
+        import tempfile
+        import warnings
+        import os
+        template_dir = tempfile.mkdtemp()
+        with open(os.path.join(template_dir, 'variants.html'), 'w') as fd:
+            fd.write("{% load jscomp_tags %}{% jscompcode %}<script>var  token = '{{ n }}';</script>{% endjscompcode %}")
+        template_dirs = settings.TEMPLATE_DIRS
+        settings.TEMPLATE_DIRS = (template_dir,)
+        small = compressor_small['js']
+        compressor_small['js'] = lambda: ('jsmin', 10000)
+        max_variants, policy = jscomp_tags.INLINE_MAX_VARIANTS, jscomp_tags.INLINE_VARIANT_POLICY
+        jscomp_tags.INLINE_MAX_VARIANTS, jscomp_tags.INLINE_VARIANT_POLICY = 2, 'skip'
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                # the template is parsed again for every render, the block is still counted
+                for n in (1, 2):
+                    self.assertTrue("var token='{0}';".format(n) in render_to_string('variants.html', {'n': n}))
+                self.assertEqual(caught, [])
+                output = render_to_string('variants.html', {'n': 3})
+                self.assertEqual(len(caught), 1)
+                self.assertTrue("'skip'" in str(caught[0].message))
+                self.assertTrue("var  token = '3';" in output)
+                self.assertTrue("var  token = '4';" in render_to_string('variants.html', {'n': 4}))
+        finally:
+            settings.TEMPLATE_DIRS = template_dirs
+            shutil.rmtree(template_dir)
+            compressor_small['js'] = small
+            jscomp_tags.INLINE_MAX_VARIANTS, jscomp_tags.INLINE_VARIANT_POLICY = max_variants, policy
+    
+    def test_external(self):
+        from django.core.cache import cache
+        from django.template import Template, Context, TemplateSyntaxError
+        from staticcomp import compressor_small
+        from staticcomp.compressor import InlinePayload, PayloadException
+        from staticcomp.templatetags import jscomp_tags
+        import re
+        self.assertRaises(TemplateSyntaxError, Template, "{% load jscomp_tags %}{% jscompcode defer %}{% endjscompcode %}")
+        self.assertRaises(TemplateSyntaxError, Template, "{% load jscomp_tags %}{% jscompcode external later %}{% endjscompcode %}")
+        
+        t = Template("{% load jscomp_tags %}{% jscompcode external defer %}<script>var  {{ name }} = 1;</script>{% endjscompcode %}")
+        small = compressor_small['js']
+        compressor_small['js'] = lambda: ('jsmin', 10000)
+        external_bytes, refresh = jscomp_tags.INLINE_EXTERNAL_BYTES, jscomp_tags.INLINE_SOURCE_REFRESH
+        jscomp_tags.INLINE_EXTERNAL_BYTES = 100
+        try:
+            # small blocks stay inline
+            self.assertTrue('var a=1;' in t.render(Context({'name': 'a'})))
+            
+            output = t.render(Context({'name': 'a_longer_variable_name'}))
+            match = re.search(r'<script type="text/javascript" src="(/j/code/([0-9a-f]+)/([0-9a-f]+)\.js)" defer></script>', output)
+            self.assertTrue(match, output)
+            url, digest, hash = match.groups()
+            payload = InlinePayload.decode(digest, hash)
+            self.assertRaises(PayloadException, InlinePayload.decode, digest, 'a' + hash[1:])
+            
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.content.endswith('var a_longer_variable_name=1;'))
+            self.assertTrue('immutable' in response['Cache-Control'])
+            self.assertFalse(response.has_header('Last-Modified'))
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+            
+            # compressed again from the block code after an eviction
+            cache.delete(payload.cache_key())
+            response = self.client.get(url)
+            self.assertEqual(response['X-Staticcomp-Stage'], 'final')
+            self.assertTrue(response.content.endswith('var a_longer_variable_name=1;'))
+
+            # the memoized url puts back the evicted block code, once per refresh interval
+            cache.delete(payload.cache_key())
+            cache.delete(payload.source_key())
+            self.assertEqual(t.render(Context({'name': 'a_longer_variable_name'})), output)
+            self.assertEqual(cache.get(payload.source_key()), None)
+            jscomp_tags.INLINE_SOURCE_REFRESH = 0
+            self.assertEqual(t.render(Context({'name': 'a_longer_variable_name'})), output)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.content.endswith('var a_longer_variable_name=1;'))
+
+            cache.delete(payload.cache_key())
+            cache.delete(payload.source_key())
+            debug, settings.DEBUG = settings.DEBUG, False
+            try:
+                response = self.client.get(url)
+            finally:
+                settings.DEBUG = debug
+            self.assertEqual(response.status_code, 500)
+            self.assertEqual(response['Cache-Control'], 'no-cache')
+        finally:
+            compressor_small['js'] = small
+            jscomp_tags.INLINE_EXTERNAL_BYTES, jscomp_tags.INLINE_SOURCE_REFRESH = external_bytes, refresh
+
+
+class TestEncodings(JsCompTestCase):
+    def test_accepted_encoding(self):
+        from staticcomp import compressor
+        encodings = compressor.ENCODINGS
+        compressor.ENCODINGS = ['gzip', 'br']
+        try:
+            self.assertEqual(compressor.accepted_encoding("gzip, deflate, br"), 'br')
+            self.assertEqual(compressor.accepted_encoding("gzip;q=0.5, br;q=0"), 'gzip')
+            self.assertEqual(compressor.accepted_encoding("identity"), None)
+            compressor.ENCODINGS = ['gzip']
+            self.assertEqual(compressor.accepted_encoding("*"), 'gzip')
+        finally:
+            compressor.ENCODINGS = encodings
+    
+    def test_gzip_variant(self):
+        from django.core.urlresolvers import reverse
+        from staticcomp import compressor
+        from StringIO import StringIO
+        import gzip
+        encodings = compressor.ENCODINGS
+        compressor.ENCODINGS = ['gzip']
+        try:
+            payload = compressor.JsPayload(['js/a.js'], 'encgroup')
+            b64, hash = payload.encode()
+            url = reverse('staticcomp:append_js', args=('encgroup', b64, hash))
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(response['Vary'], 'Accept-Encoding')
+            self.assertFalse(response.has_header('Content-Encoding'))
+            
+            # the append request stored the variant, gzip is served from now on
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.GzipFile(fileobj=StringIO(response.content)).read(), payload.dump())
+            response = self.client.get(url)
+            self.assertEqual(response.content, payload.dump())
+        finally:
+            compressor.ENCODINGS = encodings
+
+
+class TestPrecompile(JsCompTestCase):
+    def test_precompile(self):
+        from django.core.management import call_command
+        from staticcomp.compressor import CssPayload
+        from StringIO import StringIO
+        import shutil
+        import tempfile
+        import os
+        template_dir = tempfile.mkdtemp()
+        with open(os.path.join(template_dir, 'page.html'), 'w') as fd:
+            fd.write("{% load csscomp_tags %}{% csscompfile pre css/a.css %}{% csscompfile preapp css/a.css append %}"
+                     "<p>{% csscompoutput %}</p>")
+        template_dirs = settings.TEMPLATE_DIRS
+        settings.TEMPLATE_DIRS = (template_dir,)
+        try:
+            out = StringIO()
+            call_command('staticcomp_precompile', jobs=1, stdout=out)
+            self.assertTrue(" compressed (1 files)" in out.getvalue(), out.getvalue())
+            self.assertTrue(" appended (1 files)" in out.getvalue())
+            
+            payload = CssPayload(['css/a.css'], 'pre')
+            payload.encode()
+            self.assertTrue(" Compressed: " in cache.get(payload.cache_key()))
+            
+            # only the groups that are not cached yet
+            out = StringIO()
+            call_command('staticcomp_precompile', jobs=1, stdout=out)
+            self.assertEqual(out.getvalue().count(" cached ("), 2)
+        finally:
+            settings.TEMPLATE_DIRS = template_dirs
+            shutil.rmtree(template_dir)
+
+
+class TestOutputStore(JsCompTestCase):
+    def setUp(self):
+        super(TestOutputStore, self).setUp()
+        import tempfile
+        self.root = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.root)
+    
+    def test_filesystem(self):
+        from staticcomp.compressor import FilesystemOutputStore
+        import os
+        import stat
+        store = FilesystemOutputStore(self.root, max_bytes=0)
+        store.save('out_a1', "var a = 1;", lineage='a:js/a.js')
+        path = os.path.join(self.root, 'out_a1')
+        self.assertEqual(open(path).read(), "var a = 1;")
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0644)
+        
+        # evicted from the cache, read back from the file
+        cache.delete('out_a1')
+        self.assertEqual(store.load('out_a1'), "var a = 1;")
+        self.assertEqual(cache.get('out_a1'), "var a = 1;")
+        
+        # a new version of the payload removes the previous one
+        store.save('out_a2', "var a = 2;", lineage='a:js/a.js')
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'out_a2')))
+    
+    def test_max_bytes(self):
+        from staticcomp.compressor import FilesystemOutputStore
+        import os
+        store = FilesystemOutputStore(self.root, max_bytes=25)
+        for i, key in enumerate(('out_b', 'out_c', 'out_d')):
+            store.save(key, "var {0} = 1;".format(key[-1]))
+            os.utime(os.path.join(self.root, key), (1296949725 + i, 1296949725 + i))
+        self.assertEqual(sorted(os.listdir(self.root)), ['.lineage', 'out_c', 'out_d'])
+    
+    def test_running_total(self):
+        from staticcomp.compressor import FilesystemOutputStore
+        import os
+        store = FilesystemOutputStore(self.root, max_bytes=25)
+        listdir = os.listdir
+        listed = []
+        os.listdir = lambda path: listed.append(path) or listdir(path)
+        try:
+            store.save('out_e', "var e = 1;")
+            store.save('out_f', "var f = 1;", lineage='f:js/f.js')
+            store.save('out_f2', "var f = 2;", lineage='f:js/f.js')
+            # listed once for the initial total, the superseded file is subtracted
+            self.assertEqual(len(listed), 1)
+            self.assertEqual(store._total, 20)
+            
+            # over the limit, the recently written files are kept
+            store.save('out_g', "var g = 1;")
+            self.assertEqual(len(listed), 2)
+            self.assertEqual(sorted(os.listdir(self.root)), ['.lineage', 'out_e', 'out_f2', 'out_g'])
+        finally:
+            os.listdir = listdir
+        
+        os.utime(os.path.join(self.root, 'out_e'), (1296949725, 1296949725))
+        store.save('out_h', "var h = 1;")
+        self.assertEqual(sorted(os.listdir(self.root)), ['.lineage', 'out_f2', 'out_g', 'out_h'])
+
+
+class TestSharedMemory(JsCompTestCase):
+    def setUp(self):
+        super(TestSharedMemory, self).setUp()
+        import tempfile
+        import os
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+    
+    def tearDown(self):
+        import os
+        os.remove(self.path)
+    
+    def test_lru(self):
+        from staticcomp.shm import SharedMemoryCache, shm_stats
+        shared = SharedMemoryCache(self.path, size=64 + 2 * 1024, slot_size=1024)
+        self.assertEqual(shared.slots, 2)
+        hits = shm_stats.get('hit')
+        shared.set('a', "var a = 1;")
+        shared.set('b', "var b = 1;")
+        self.assertEqual(shared.get('a'), "var a = 1;")
+        shared.set('c', "var c = 1;")
+        # b was the least recently used
+        self.assertEqual(shared.get('b'), None)
+        self.assertEqual((shared.get('a'), shared.get('c')), ("var a = 1;", "var c = 1;"))
+        self.assertEqual(shm_stats.get('hit'), hits + 3)
+        
+        shared.set('a', "var a = 2;")
+        self.assertEqual(shared.get('a'), "var a = 2;")
+        self.assertFalse(shared.set('d', "x" * 1024))
+        shared.delete('a')
+        self.assertEqual(shared.get('a'), None)
+    
+    def test_processes(self):
+        from staticcomp.shm import SharedMemoryCache
+        import os
+        shared = SharedMemoryCache(self.path, size=64 + 4 * 1024, slot_size=1024)
+        shared.set('a', "var a = 1;")
+        pid = os.fork()
+        if not pid:
+            # the child maps the file again
+            status = 0 if shared.get('a') == "var a = 1;" else 1
+            shared.set('b', "var b = 1;")
+            os._exit(status)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(SharedMemoryCache(self.path, size=64 + 4 * 1024, slot_size=1024).get('b'), "var b = 1;")
+    
+    def test_indexed(self):
+        from staticcomp.shm import SharedMemoryCache, SHM_PROBES
+        import hashlib
+        shared = SharedMemoryCache(self.path, size=64 + 1000 * 128, slot_size=128)
+        for i in xrange(200):
+            shared.set('key{0}'.format(i), "var a = {0};".format(i))
+        self.assertEqual([shared.get('key{0}'.format(i)) for i in xrange(200)], ["var a = {0};".format(i) for i in xrange(200)])
+        # a key is looked up in the slots from its own, not in every slot
+        probes = shared._probes(hashlib.sha1('key1').digest())
+        self.assertEqual(len(probes), SHM_PROBES)
+        self.assertTrue(shared._find(hashlib.sha1('key1').digest())[0] in probes)
+    
+    def test_layouts(self):
+        from staticcomp.shm import SharedMemoryCache, default_path
+        import os
+        self.assertNotEqual(default_path(4, 1024), default_path(2, 1024))
+        self.assertNotEqual(default_path(4, 1024), default_path(4, 2048))
+        shared = SharedMemoryCache(self.path, size=64 + 4 * 1024, slot_size=1024)
+        shared.set('a', "var a = 1;")
+        # a smaller layout on the same file doesn't cut the mapping of the other workers
+        smaller = SharedMemoryCache(self.path, size=64 + 2 * 1024, slot_size=1024)
+        smaller.set('b', "var b = 1;")
+        self.assertEqual(os.path.getsize(self.path), shared.size)
+        self.assertEqual(smaller.get('b'), "var b = 1;")
+        shared.get('a')
+
+
+class TestConditional(JsCompTestCase):
+    def url(self, name, group):
+        from django.core.urlresolvers import reverse
+        from staticcomp.compressor import JsPayload
+        payload = JsPayload(['js/a.js'], group)
+        b64, hash = payload.encode()
+        return reverse(name, args=(group, b64, hash)), payload
+    
+    def test_etag(self):
+        url, payload = self.url('staticcomp:append_js', 'etag')
+        response = self.client.get(url)
+        self.assertEqual(response['ETag'], '"{0}"'.format(payload.hash))
+        self.assertTrue('immutable' in response['Cache-Control'])
+        self.assertEqual(int(response['Content-Length']), len(payload.dump()))
+        self.assertEqual(response['X-Staticcomp-Stage'], 'final')
+        
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, "")
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+    
+    def test_processing(self):
+        url, payload = self.url('staticcomp:compressed_js', 'etagproc')
+        response = self.client.get(url)
+        self.assertFalse(response.has_header('ETag'))
+        self.assertEqual(response['Cache-Control'], 'public, max-age=10')
+        self.assertEqual(response['X-Staticcomp-Stage'], 'processing')
+        # not final, the client has no etag of the compressed code
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"{0}-p"'.format(payload.hash))
+        self.assertEqual(response.status_code, 200)
+
+
+class TestStreaming(JsCompTestCase):
+    def test_cmd_stream(self):
+        from staticcomp.compressor import CompressorService, CompressorException, FileSource, iter_files, read_files
+        import tempfile
+        import os
+        paths = []
+        for code in ("var a = 1;" * 20000, "var b = 2;"):
+            fd, path = tempfile.mkstemp(suffix='.js')
+            os.write(fd, code)
+            os.close(fd)
+            paths.append(path)
+        try:
+            source = FileSource(paths)
+            self.assertEqual("".join(iter_files(paths, 1000)), read_files(paths))
+            self.assertEqual(len(source), len(read_files(paths)))
+            service = CompressorService(cache_key=None, job_name='stream')
+            self.assertEqual(service.cmd("cat", source), read_files(paths))
+            self.assertRaises(CompressorException, service.cmd, "false", source)
+        finally:
+            map(os.remove, paths)
+
+
+class TestSendfile(JsCompTestCase):
+    def test_sendfile(self):
+        from django.core.urlresolvers import reverse
+        from staticcomp import views
+        from staticcomp.compressor import FilesystemOutputStore, JsPayload
+        import shutil
+        import tempfile
+        import os
+        root = tempfile.mkdtemp()
+        sendfile, store = views.SENDFILE, views._sendfile_store
+        views._sendfile_store = FilesystemOutputStore(root)
+        try:
+            payload = JsPayload(['js/a.js', 'js/b.js'], 'sendfile')
+            b64, hash = payload.encode()
+            url = reverse('staticcomp:append_js', args=('sendfile', b64, hash))
+            
+            views.SENDFILE = 'x-sendfile'
+            response = self.client.get(url)
+            file_path = os.path.join(root, payload.cache_key())
+            self.assertEqual(response['X-Sendfile'], file_path)
+            self.assertEqual(response['Content-Type'], 'application/javascript')
+            self.assertEqual(response.content, "")
+            self.assertEqual(open(file_path).read(), payload.dump())
+            
+            views.SENDFILE = 'x-accel-redirect'
+            response = self.client.get(url)
+            self.assertEqual(response['X-Accel-Redirect'], '/staticcomp-files/' + payload.cache_key())
+            # the signature is still verified
+            response = self.client.get(url.replace(hash, '0' + hash[1:]))
+            self.assertEqual(response.status_code, 500)
+        finally:
+            views.SENDFILE, views._sendfile_store = sendfile, store
+            shutil.rmtree(root)
+
+
+class TestErrors(JsCompTestCase):
+    def setUp(self):
+        super(TestErrors, self).setUp()
+        from django.test.client import RequestFactory
+        self.request = RequestFactory().get('/j/foo/bar/c/0000.js', REMOTE_ADDR='10.0.0.1')
+    
+    def fail_request(self, recorder, message):
+        try:
+            raise ValueError(message)
+        except ValueError:
+            recorder.record(self.request)
+    
+    def test_aggregate(self):
+        from staticcomp.errors import ErrorRecorder
+        from staticcomp.models import StaticCompError
+        recorder = ErrorRecorder(flush_interval=60)
+        for i in range(5):
+            self.fail_request(recorder, "bad signature {0}".format(i))
+        try:
+            raise KeyError("other")
+        except KeyError:
+            recorder.record(self.request)
+        self.assertEqual(recorder.pending(), 2)
+        self.assertEqual(StaticCompError.objects.count(), 0)
+        self.assertEqual(recorder.flush(), 2)
+        self.assertEqual(recorder.pending(), 0)
+        
+        self.fail_request(recorder, "bad signature again")
+        recorder.flush()
+        errors = StaticCompError.objects.order_by('-count')
+        self.assertEqual([e.count for e in errors], [6, 1])
+        self.assertTrue("bad signature 0" in errors[0].stack)
+        self.assertEqual(errors[0].ip_address, '10.0.0.1')
+    
+    def test_sample_and_bound(self):
+        from staticcomp.errors import ErrorRecorder
+        from staticcomp.models import StaticCompError
+        recorder = ErrorRecorder(flush_interval=60, sample_rate=0.5, max_pending=1)
+        import random
+        random.seed(1)
+        for i in range(100):
+            self.fail_request(recorder, "sampled")
+        try:
+            raise KeyError("dropped")
+        except KeyError:
+            recorder.record(self.request)
+        self.assertEqual(recorder.pending(), 1)
+        recorder.flush()
+        count = StaticCompError.objects.get().count
+        self.assertTrue(70 < count < 130, count)
+    
+    def test_prune(self):
+        from staticcomp.errors import prune
+        from staticcomp.models import StaticCompError
+        from datetime import datetime, timedelta
+        now = datetime.now()
+        for days in (0, 1, 2, 40):
+            StaticCompError.objects.create(signature=str(days), request='', ip_address='10.0.0.1', user_agent='', 
+                                           last_seen=now - timedelta(days=days))
+        self.assertEqual(prune(days=30, max_rows=2), 2)
+        self.assertEqual(sorted(StaticCompError.objects.values_list('signature', flat=True)), ['0', '1'])
+
+
+class TestBreaker(JsCompTestCase):
+    def test_backoff(self):
+        from staticcomp.breaker import CircuitBreaker, open_breakers
+        breaker = CircuitBreaker('backend', threshold=2, base_delay=10, max_delay=30)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.failure("error"), 0)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.failure("error"), 10)
+        self.assertFalse(breaker.allow())
+        self.assertEqual([name for name, state in open_breakers()], ['backend'])
+        self.assertEqual(breaker.failure("error"), 20)
+        self.assertEqual(breaker.failure("error"), 30)
+        
+        # half-open, a single probe
+        state = breaker.state()
+        state['open_until'] = 0
+        cache.set(breaker.key, state)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.success()
+        self.assertTrue(breaker.allow())
+        self.assertEqual(open_breakers(), [])
+    
+    def test_failed_job(self):
+        from staticcomp.compressor import CodeCompressorThread, JsCompressor, BackendException, FAILED_HEADER
+        from staticcomp.breaker import CircuitBreaker
+        
+        class FailingThread(CodeCompressorThread):
+            def run_svc(self):
+                raise BackendException("node: not found")
+        
+        compressor = JsCompressor("var a = 1;")
+        self.assertRaises(BackendException, FailingThread(compressor.cache_key, "var a = 1;", "failing").run)
+        self.assertTrue(cache.get(compressor.cache_key).startswith(FAILED_HEADER.split("{0}")[0]))
+        self.assertTrue(CircuitBreaker(compressor.cache_key).is_open())
+        self.assertEqual(FailingThread.backend_breaker().state()['failures'], 1)
+        
+        # evicted, still no job until the delay passed
+        cache.delete(compressor.cache_key)
+        self.assertFalse(compressor.queue_compression())
+        self.assertTrue(compressor.compress_code().startswith(FAILED_HEADER.split("{0}")[0]))
+
+    def test_rejected_code(self):
+        from staticcomp.compressor import CodeCompressorThread, CompressorException
+        from staticcomp.breaker import CircuitBreaker
+
+        class RejectingThread(CodeCompressorThread):
+            def run_svc(self):
+                raise CompressorException("Command failed: 1")
+
+        # the retries of one broken group never stop the backend
+        for attempt in range(5):
+            self.assertRaises(CompressorException, RejectingThread('broken_key', "var = ;", "broken").run)
+        self.assertTrue(CircuitBreaker('broken_key').is_open())
+        self.assertEqual(RejectingThread.backend_breaker().state()['failures'], 0)
+        self.assertTrue(RejectingThread.backend_breaker().allow())
+
+    def test_notify(self):
+        from staticcomp.breaker import notify_admins
+        from django.core import mail
+        admins = settings.ADMINS
+        settings.ADMINS = (('admin', 'admin@example.com'),)
+        try:
+            self.assertTrue(notify_admins("failed", "first"))
+            self.assertFalse(notify_admins("failed", "second"))
+            self.assertFalse(notify_admins("failed", "third"))
+            self.assertEqual(len(mail.outbox), 1)
+            cache.delete('staticcomp_breaker_mail')
+            self.assertTrue(notify_admins("failed", "fourth"))
+            self.assertTrue("2 more failures" in mail.outbox[1].body)
+        finally:
+            settings.ADMINS = admins
+
+
+class TestCmdLimits(JsCompTestCase):
+    def setUp(self):
+        super(TestCmdLimits, self).setUp()
+        import tempfile
+        self.tempdir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tempdir)
+    
+    def script(self, source):
+        import os
+        path = os.path.join(self.tempdir, "cmd.sh")
+        with open(path, 'w') as fd:
+            fd.write("#!/bin/sh\n" + source)
+        os.chmod(path, 0755)
+        return path
+    
+    def test_timeout(self):
+        from staticcomp.compressor import CompressorService, CompressorTimeout, FileSource
+        import os
+        import time
+        pid_file = os.path.join(self.tempdir, "pid")
+        service = CompressorService(cache_key=None, job_name='timeout')
+        service.timeout = .5
+        cmdline = self.script("sleep 30 &\necho $! > {0}\nsleep 30\n".format(pid_file))
+        for data in ("var a = 1;", FileSource([])):
+            start = time.time()
+            self.assertRaises(CompressorTimeout, service.cmd, cmdline, data)
+            self.assertTrue(time.time() - start < 5)
+            # the whole process group is killed (gone or a zombie of init)
+            time.sleep(.1)
+            with open(pid_file) as fd:
+                stat_file = "/proc/{0}/stat".format(int(fd.read()))
+            if os.path.exists(stat_file):
+                with open(stat_file) as fd:
+                    self.assertEqual(fd.read().split(") ")[1][0], "Z")
+    
+    def test_limits(self):
+        from staticcomp import compressor
+        from staticcomp.compressor import CompressorService, CompressorTimeout
+        import os
+        service = CompressorService(cache_key=None, job_name='limits')
+        cpu_seconds, nice = compressor.CMD_CPU_SECONDS, compressor.CMD_NICE
+        compressor.CMD_CPU_SECONDS, compressor.CMD_NICE = 1, 5
+        try:
+            self.assertEqual(int(service.cmd(self.script("nice\n"), "")), os.nice(0) + 5)
+            self.assertRaises(CompressorTimeout, service.cmd, self.script("while :; do :; done\n"), "")
+        finally:
+            compressor.CMD_CPU_SECONDS, compressor.CMD_NICE = cpu_seconds, nice
+
+
+class TestClosureWeb(JsCompTestCase):
+    def setUp(self):
+        super(TestClosureWeb, self).setUp()
+        from staticcomp.backends import closure_web
+        from staticcomp.backends.closure_web_fake import FakeClosureServer
+        self.server = FakeClosureServer().start()
+        self.retry_delay = closure_web.RETRY_DELAY
+        closure_web.RETRY_DELAY = .01
+        self.service = closure_web.GoogleClosureWebService(cache_key=None, job_name='closure')
+        self.service.closure_url = self.server.url
+    
+    def tearDown(self):
+        from staticcomp.backends import closure_web
+        closure_web.RETRY_DELAY = self.retry_delay
+        self.service.pool().close()
+        self.server.stop()
+    
+    def test_keep_alive(self):
+        for i in range(3):
+            self.assertTrue(self.service.compress_string("  var a = 1;\n\n  var b = 2;").endswith("var a = 1;\nvar b = 2;"))
+        self.assertEqual(self.server.counts, {'connections': 1, 'requests': 3})
+    
+    def test_retry(self):
+        from staticcomp.backends.closure_web import ClosureRequestError
+        self.server.fail(2, status=503)
+        self.assertTrue(self.service.compress_string("var a = 1;").endswith("var a = 1;"))
+        self.assertEqual(self.server.counts['requests'], 3)
+        
+        # not retried
+        self.server.fail(1, status=400)
+        self.assertRaises(ClosureRequestError, self.service.compress_string, "var a = 1;")
+        self.assertEqual(self.server.counts['requests'], 4)
+        
+        # the server closed the idle connection
+        self.service.pool().idle.queue[0].sock.shutdown(2)
+        self.assertTrue(self.service.compress_string("var a = 1;").endswith("var a = 1;"))
+    
+    def test_timeout(self):
+        from staticcomp.backends.closure_web import ConnectionPool
+        from staticcomp.compressor import CompressorTimeout
+        pool = ConnectionPool(self.server.url, read_timeout=.1)
+        self.service.pool = lambda: pool
+        self.server.delay = .3
+        try:
+            self.assertRaises(CompressorTimeout, self.service.compress_string, "var a = 1;")
+        finally:
+            self.server.delay = 0
+        self.assertEqual(self.server.counts['requests'], 3)
+
+
+# each snippet sets the result, compared between the source, jsmin and UglifyJS
+jsmin_corpus = [
+    'function f(s) { return /a b\\/[/]/g.test(s) }\nresult = [f("a b/"), f("x"), /[/]/.source];',
+    'var a = 10, b = 2, g = 5;\nresult = [a / b / g, 4 /2/ 1, a /b/ g];',
+    'var a = 1\nvar b = a\n++a\nresult = [a, b]',
+    'function f() {\n  return\n  42\n}\nresult = typeof f()',
+    'var a = 1, b = 2;\nresult = [a + +b, a - -b, a++ + b, a + ++b, a-- - b, a - --b]',
+    'result = "a  // b /* c */" + \'d\\\'  e\' + "\\\n  f"',
+    'result = 1 .toString() + 5..toFixed(1) + 0x1F + .5e1',
+    'var a = 1/*\n*/var b = 2; result = a + b',
+    'if (true) {}\n/x/.test("x") && (result = "regex after block")',
+    'var r = 0\n;(function() { r = 5 })()\nresult = r',
+    'var caf\xc3\xa9 = 1; result = caf\xc3\xa9 + "\xc3\xa9"',
+    'outer: for (var i = 0; i < 3; i++) {\n  for (var j = 0; j < 3; j++) {\n    if (j == 1) continue outer\n    if (i == 2) break outer\n  }\n}\nresult = [i, j]',
+    'var f = function(x) { return function() { return x } }\nvar r = f\n(1)()\nresult = r',
+    'var a = 3, b = 1; result = [a < !--b, b]',
+    'var x = 2\n-1\nresult = x',
+    'var o = { get a() { return 1 }, "b c": 2, d: typeof /re/ }\nresult = [o.a, o["b c"], o.d]',
+    '/*! license */\n// line comment\nvar s = "x"; /* block */ result = s\n// end',
+    'var i = 0, a = []\ndo a.push(i++)\nwhile (i < 3)\nresult = a',
+    'var x = 5\nvar y = x\n/2/1\nresult = y',
+    'result = [typeof void 0, "a" in {a: 1}, [] instanceof Array, -(-1), + +"2"]',
+    'var y = "a  b", n = 0\nif (y) /a  b/.test(y) && n++\nfor (var i = 0; i < 1; i++) /a  b/.test(y) && n++\n'
+    'while (!n) /x/\nresult = [n, (y.length) /2/ 1, f(y) / 2]\nfunction f(s) { return s.length }',
+    'var a = 4, b = 4, x = a++ / 2 // c\n;var y = 1\nvar z = b-- /2/ 1, w = a+++b\nresult = [x, y, z, w, a, b]',
+]
+
+
+class TestJsMin(JsCompTestCase):
+    def run_node(self, sources):
+        import json
+        import subprocess
+        runner = ("var vm = require('vm'), input = JSON.parse(require('fs').readFileSync('/dev/stdin', 'utf8'));"
+                  "process.stdout.write(JSON.stringify(input.map(function(src) {"
+                  "  try { var ctx = {}; vm.runInNewContext(src, ctx); return JSON.stringify(ctx.result); }"
+                  "  catch (e) { return 'error: ' + e; } })));")
+        p = subprocess.Popen(["node", "-e", runner], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        return json.loads(p.communicate(json.dumps([s.decode('utf-8') for s in sources]))[0])
+    
+    def test_minify(self):
+        from staticcomp.backends.jsmin import minify, JsMinError
+        self.assertEqual(minify("var a = 1 , b = a + +1;\n// c\nreturn /a b/g.test(s) / 2"), 
+                         "var a=1,b=a+ +1;return/a b/g.test(s)/2")
+        self.assertEqual(minify("a\n++b\nc = d\n.e"), "a\n++b\nc=d.e")
+        self.assertTrue(minify(jsmin_corpus[16]).startswith("/*! license */"))
+        self.assertRaises(JsMinError, minify, "var a = 'abc")
+        self.assertRaises(JsMinError, minify, "var a = 1; /* abc")
+    
+    def test_corpus(self):
+        from distutils.spawn import find_executable
+        from staticcomp.backends.jsmin import minify
+        from staticcomp.backends.uglifyjs import UglifyJSCommand
+        if not find_executable('node'):
+            self.skipTest("node is not installed")
+        uglify = UglifyJSCommand(cache_key=None, job_name='corpus')
+        minified = [minify(js) for js in jsmin_corpus]
+        uglified = [uglify.compress_daemon(js) for js in jsmin_corpus]
+        expected = self.run_node(jsmin_corpus)
+        self.assertFalse([result for result in expected if result is None or result.startswith('error')])
+        self.assertEqual(self.run_node(minified), expected)
+        # UglifyJS 1.x keeps the escaped line break of a string continuation and writes a<!--b (a comment)
+        uglify_differs = [js for js, result, source_result in zip(jsmin_corpus, self.run_node(uglified), expected) 
+                          if result != source_result]
+        self.assertEqual(uglify_differs, [jsmin_corpus[5], jsmin_corpus[13]])
+        self.assertTrue(sum(map(len, minified)) < sum(map(len, jsmin_corpus)))
+    
+    def test_routing(self):
+        from staticcomp import CodeCompressorThreadFactory, compressor_small
+        from staticcomp.compressor import JsCompressor
+        from staticcomp.backends.jsmin import JsMinThread
+        from staticcomp.backends.uglifyjs import UglifyJSThread
+        small = compressor_small['js']
+        compressor_small['js'] = lambda: ('jsmin', 100)
+        try:
+            self.assertEqual(CodeCompressorThreadFactory.get_class('js', 99), JsMinThread)
+            self.assertEqual(CodeCompressorThreadFactory.get_class('js', 100), UglifyJSThread)
+            self.assertEqual(CodeCompressorThreadFactory.get_class('js'), UglifyJSThread)
+            self.assertTrue(isinstance(CodeCompressorThreadFactory.create('js', 'key', "var a;", 'job'), JsMinThread))
+            
+            # compressed during the first request
+            data = JsCompressor("var  a = 1;").compress_code()
+            self.assertTrue(bool(compressed_re.search(data)))
+            self.assertTrue(data.endswith("var a=1;"))
+        finally:
+            compressor_small['js'] = small
+
+
+class TestProgressive(JsCompTestCase):
+    def test_first_pass(self):
+        from staticcomp.compressor import CodeCompressorThread, JsCompressor, code_stage, store_code
+        import threading
+        import time
+        release = threading.Event()
+        
+        class SlowThread(CodeCompressorThread):
+            def run_svc(self):
+                release.wait(10)
+                store_code(self.cache_key, "final", 60)
+        
+        js = "var  a = 1; // comment\n\n  var b = 2;"
+        compressor = JsCompressor(js)
+        thread = SlowThread(compressor.cache_key, js, 'slow', first_pass='js')
+        thread.start()
+        for i in range(100):
+            data = cache.get(compressor.cache_key)
+            if data:
+                break
+            time.sleep(.05)
+        self.assertEqual(code_stage(data), 'first-pass')
+        self.assertTrue(bool(processing_re.search(data)))
+        self.assertTrue(data.endswith("var a=1;var b=2;"))
+        self.assertFalse(compressor.is_compressed(data))
+        
+        release.set()
+        thread.join()
+        self.assertEqual(code_stage(cache.get(compressor.cache_key)), 'final')
+        self.assertEqual(code_stage(compressor.processing_data()), 'processing')
+    
+    def test_fragment_jobs(self):
+        from staticcomp import compressor
+        jobs = []
+
+        class RecordingJob(compressor.CompressorJob):
+            def start(self):
+                jobs.append(self)
+                return True
+
+        progressive, job_class = compressor.PROGRESSIVE, compressor.CompressorJob
+        compressor.PROGRESSIVE, compressor.CompressorJob = True, RecordingJob
+        try:
+            compressor.JsCompressor("var a = 1;").queue_compression()
+            # the raw file is served until the fragment is compressed, no first pass
+            compressor.JsCompressor("var b = 2;", cache_key='fragment_key', fragment=True).queue_compression()
+        finally:
+            compressor.PROGRESSIVE, compressor.CompressorJob = progressive, job_class
+        self.assertEqual([job.first_pass for job in jobs], ['js', None])
+
+    def test_css_first_pass(self):
+        from staticcomp.compressor import first_pass
+        self.assertEqual(first_pass('css', "a {  color: #ffffff; }\n/* c */"), "a{color:#fff}")
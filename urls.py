@@ -31,6 +31,9 @@ urlpatterns = patterns('staticcomp.views',
     # JavaScript compression
     url(r'^j/(?P<group>[A-Za-z0-9]+)/(?P<b64_js>[A-Za-z0-9=]+)/c/(?P<hash>[0-9a-fA-F]+).js$', 'compressed_js', {'klass': JsCompressor}, name='compressed_js'),
     url(r'^j/(?P<group>[A-Za-z0-9]+)/(?P<b64_js>[A-Za-z0-9=]+)/a/(?P<hash>[0-9a-fA-F]+).js$', 'append_js', name='append_js'),
+    
+    # external {% jscompcode %} blocks
+    url(r'^j/code/(?P<digest>[0-9a-f]{32})/(?P<hash>[0-9a-f]+).js$', 'inline_js', name='inline_js'),
 
     # CSS compression
     url(r'^c/(?P<group>[A-Za-z0-9]+)/(?P<b64_css>[A-Za-z0-9=]+)/c/(?P<hash>[0-9a-fA-F]+).css$', 'compressed_css', {'klass': CssCompressor}, name='compressed_css'),
@@ -25,11 +25,21 @@ THE SOFTWARE.
 
 from django.conf import settings
 from django.core.cache import cache
+from django.http import HttpResponse
 
-from staticcomp.decorators import js_payload, css_payload
-from staticcomp.compressor import JsCompressor, CACHE_TIMEOUT
+import os
 
-KEY_FORMAT = getattr(settings, 'STATICCOMP_CACHE_KEY', 'staticcomp_{group}_{hash}')
+from staticcomp.decorators import js_payload, css_payload, inline_js_payload
+from staticcomp.compressor import (JsCompressor, FilesystemOutputStore, PayloadException, CACHE_TIMEOUT, 
+                                   get_output_store, store_code)
+
+# serve the append requests from files with 'x-accel-redirect' (nginx) or 'x-sendfile' (apache, lighttpd)
+SENDFILE = getattr(settings, 'STATICCOMP_SENDFILE', None)
+
+# the internal nginx location of the STATICCOMP_SENDFILE_ROOT
+SENDFILE_URL = getattr(settings, 'STATICCOMP_SENDFILE_URL', '/staticcomp-files/')
+
+_sendfile_store = None
 
 
 def _staticcomp_key(payload):
@@ -39,39 +49,98 @@ def _staticcomp_key(payload):
     
     Default Format: staticcomp_[group]_[hash]
     """
-    return KEY_FORMAT.format(group=payload.group, hash=payload.hash)
+    return payload.cache_key()
 
 
 
 def compress_code(request, payload, klass=JsCompressor):
-    data = payload.dump()
-    
     # kill switch for the compression request
     if getattr(settings, 'STATICCOMP_DISABLE', False):
-        return data
+        return payload.stream()
     
-    # execute the compression 
-    code_compressor = klass(data, cache_key=_staticcomp_key(payload), job_name=payload.name)
+    # execute the compression, the files are only read when the code isn't cached
+    code_compressor = klass(None, cache_key=_staticcomp_key(payload), job_name=payload.name, files=payload.paths(),
+                            lineage=payload.lineage())
     code_compressor.init()
-    return code_compressor.compress_code()
+    code = code_compressor.compress_code()
+    if code is not code_compressor.cached_data:
+        # the code is replaced once compressed, see decorators.code_response()
+        request.staticcomp_processing = True
+    return code
 
 
 compressed_css = css_payload(compress_code)
 compressed_js = js_payload(compress_code)
 
 
+def inline_code(request, payload, klass=JsCompressor):
+    """
+    Serves an external {% jscompcode %} block. The block code is only read from the cache 
+    when the compressed code is not cached.
+    """
+    code_compressor = klass(None, cache_key=payload.cache_key(), job_name=payload.name)
+    code_compressor.init()
+    if not getattr(settings, 'STATICCOMP_DISABLE', False):
+        code_compressor.cached_data = code_compressor.load_cached()
+        if code_compressor.cached_data:
+            return code_compressor.cached_data
+    
+    code_compressor.data = cache.get(payload.source_key())
+    if code_compressor.data is None:
+        raise PayloadException("Code Block Expired: {0}".format(payload.digest))
+    if getattr(settings, 'STATICCOMP_DISABLE', False):
+        return code_compressor.data
+    
+    code = code_compressor.compress_code()
+    if code is not code_compressor.cached_data:
+        request.staticcomp_processing = True
+    return code
+
+
+inline_js = inline_js_payload(inline_code)
+
+
+def get_sendfile_store():
+    global _sendfile_store
+    if _sendfile_store is None:
+        _sendfile_store = FilesystemOutputStore(getattr(settings, 'STATICCOMP_SENDFILE_ROOT', None))
+    return _sendfile_store
+
+
+def sendfile_response(payload):
+    """
+    Writes the appended files once as the file of the cache key, the webserver sends the 
+    file. The payload is never read into memory.
+    """
+    store = get_sendfile_store()
+    cache_key = _staticcomp_key(payload)
+    file_path = store.path(cache_key)
+    if not os.path.exists(file_path):
+        store.save_files(cache_key, payload.paths(), payload.lineage())
+    
+    response = HttpResponse()
+    if SENDFILE == 'x-sendfile':
+        response['X-Sendfile'] = file_path
+    else:
+        response['X-Accel-Redirect'] = SENDFILE_URL.rstrip('/') + '/' + cache_key
+    return response
+
+
 def append_code(request, payload):
     """
     Process the append request. The payload is not compressed, just appended in order.    
     """
     if getattr(settings, 'STATICCOMP_DISABLE', False):
-        return payload.dump()
+        return payload.stream()
+    
+    if SENDFILE:
+        return sendfile_response(payload)
         
     cache_key = _staticcomp_key(payload)
-    cached_css = cache.get(cache_key)
+    cached_css = get_output_store().load(cache_key)
     if not cached_css:
         cached_css = payload.dump()
-        cache.set(cache_key, cached_css, CACHE_TIMEOUT)
+        store_code(cache_key, cached_css, CACHE_TIMEOUT, payload.lineage())
     return cached_css
 
 